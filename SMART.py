@@ -1,56 +1,211 @@
-import os
+import subprocess
+import json
+import time
+import threading
+import logging
+from collections import namedtuple, deque
+
+from smart_scheduler import SMARTCTL_STANDBY_EXIT_CODE
 
 # S.M.A.R.T. (Self-Monitoring, Analysis and Reporting Technology) for hard drives
+#
+# All information for a device comes from a single "smartctl --json -a" call,
+# which works the same for SATA, USB bridges (SAT) and NVMe devices.
+#
+# Ref: https://www.smartmontools.org/wiki/json_output
+
+logger = logging.getLogger(__name__)
+
+# A full SMART pull is slow, so only do it every few hours (and only when the drive is spinning)
+FULL_SMART_INTERVAL_SECONDS = 6 * 3600
+# Number of raw value samples kept for each attribute
+ATTRIBUTE_HISTORY_SIZE = 32
+
+# Attributes we report a rate of change for (ATA id -> name used in the report)
+TRENDED_ATTRIBUTES = {
+    5: 'reallocated',
+    197: 'pending',
+    199: 'crc_errors',
+}
+# NVMe health log fields mapped onto the same report names
+NVME_TRENDED_FIELDS = {
+    'media_errors': 'reallocated',
+    'num_err_log_entries': 'crc_errors',
+}
+
+SmartAttribute = namedtuple('SmartAttribute', ['id', 'name', 'value', 'worst', 'thresh', 'raw', 'failing'])
+
 
 class SMART:
-    #to run a smartctl command
-    def RunSmartCtl(self, strArgs):
-        #get the command with strArgs as the argument
-        cmdString = "smartctl " + strArgs
-        #get command output and store each line in a list
-        output = os.popen(cmdString).read()
-        lines = str.splitlines(output)
-        
-        return lines
-
-    #get device health
-    def GetDeviceHealth(self, deviceId):
-        deviceInfoLines = self.RunSmartCtl("-H " + deviceId)
-        return deviceInfoLines[-2]
-    
-
-    #get device attributes
-    def GetDeviceAttributes(self, deviceId):
-        deviceInfoLines = self.RunSmartCtl("-A " + deviceId)
-        
-        for i in range(len(deviceInfoLines)):
-            if deviceInfoLines[i].startswith('ID#'):
-                index = i+1
-                break
-        
+
+    def __init__(self, fullInterval=FULL_SMART_INTERVAL_SECONDS, historySize=ATTRIBUTE_HISTORY_SIZE):
+        self.fullInterval = fullInterval
+        self.historySize = historySize
+        # deviceId -> (timestamp, report)
+        self.reportCache = {}
+        # deviceId -> timestamp of the last full pull that failed
+        self.failedPulls = {}
+        # deviceId -> {attribute id -> deque((timestamp, raw))}
+        self.history = {}
+        self.lock = threading.Lock()
+
+    #to run a smartctl command and return the parsed json output
+    def RunSmartCtl(self, args):
+        cmd = ["smartctl", "--json"] + args
+        try:
+            p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               universal_newlines=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error("smartctl %s failed: %s", args, e)
+            return None
+        if p.returncode == SMARTCTL_STANDBY_EXIT_CODE:
+            return None
+        try:
+            return json.loads(p.stdout)
+        except ValueError:
+            logger.error("smartctl %s returned invalid json", args)
+            return None
+
+    #pull everything for a device, never waking a drive in standby
+    def GetDeviceData(self, deviceId):
+        return self.RunSmartCtl(["-n", "standby,{}".format(SMARTCTL_STANDBY_EXIT_CODE), "-a", deviceId])
+
+    #get device health from the json output
+    def GetDeviceHealth(self, deviceId, data=None):
+        if data is None:
+            data = self.GetDeviceData(deviceId)
+        if data is None:
+            return None
+        status = data.get('smart_status')
+        if status is None:
+            return None
+        return 'PASSED' if status.get('passed') else 'FAILED'
+
+    #get device attributes as a dict of attribute id -> SmartAttribute
+    def GetDeviceAttributes(self, deviceId, data=None):
+        if data is None:
+            data = self.GetDeviceData(deviceId)
+        if data is None:
+            return {}
+
         infoDict = dict()
-        for i in range(index, len(deviceInfoLines)-1):
-            x = deviceInfoLines[i].strip().split()
-            infoDict[x[0]] = x[0:len(x)]
-        
+        table = data.get('ata_smart_attributes', {}).get('table', [])
+        for entry in table:
+            attr = SmartAttribute(
+                id=entry['id'],
+                name=entry.get('name'),
+                value=entry.get('value'),
+                worst=entry.get('worst'),
+                thresh=entry.get('thresh'),
+                raw=entry.get('raw', {}).get('value'),
+                failing=entry.get('when_failed', '') not in ('', None))
+            infoDict[attr.id] = attr
+
+        # NVMe devices have a health log instead of an attribute table
+        nvmeLog = data.get('nvme_smart_health_information_log')
+        if nvmeLog is not None:
+            for field, value in nvmeLog.items():
+                if isinstance(value, int):
+                    infoDict[field] = SmartAttribute(id=field, name=field, value=None, worst=None,
+                                                     thresh=None, raw=value, failing=False)
         return infoDict
 
+    def recordHistory(self, deviceId, attributes, now):
+        deviceHistory = self.history.setdefault(deviceId, {})
+        for attrId, attr in attributes.items():
+            if attr.raw is None:
+                continue
+            samples = deviceHistory.get(attrId)
+            if samples is None:
+                samples = deque(maxlen=self.historySize)
+                deviceHistory[attrId] = samples
+            # Only keep a new sample when the raw value changed (plus the latest time seen)
+            # so a slowly changing counter only uses a couple of slots
+            if len(samples) >= 2 and samples[-1][1] == attr.raw and samples[-2][1] == attr.raw:
+                samples[-1] = (now, attr.raw)
+            else:
+                samples.append((now, attr.raw))
+
+    def GetAttributeHistory(self, deviceId, attrId):
+        with self.lock:
+            samples = self.history.get(deviceId, {}).get(attrId)
+            return list(samples) if samples is not None else []
+
+    def GetRates(self, deviceId):
+        """
+        Rate of change (per day) over the kept history for the trended counters
+        """
+        rates = {}
+        with self.lock:
+            deviceHistory = self.history.get(deviceId, {})
+            for attrId, name in list(TRENDED_ATTRIBUTES.items()) + list(NVME_TRENDED_FIELDS.items()):
+                samples = deviceHistory.get(attrId)
+                if not samples:
+                    continue
+                firstTime, firstRaw = samples[0]
+                lastTime, lastRaw = samples[-1]
+                elapsed = lastTime - firstTime
+                rates[name] = lastRaw
+                rates[name + '_per_day'] = round((lastRaw - firstRaw) * 86400 / elapsed, 3) if elapsed > 0 else 0.0
+        return rates
+
+    def GetDeviceReport(self, deviceId, spinning, now=None):
+        """
+        Return the cached report for the device, refreshing it with a full
+        SMART pull if it is older than fullInterval and the drive is spinning.
+        A failed pull is not retried for fullInterval either.
+        """
+        if now is None:
+            now = time.time()
+        cached = self.reportCache.get(deviceId)
+        if cached is not None and (not spinning or (now - cached[0]) < self.fullInterval):
+            return cached[1]
+        failedAt = self.failedPulls.get(deviceId)
+        if not spinning or (failedAt is not None and (now - failedAt) < self.fullInterval):
+            return cached[1] if cached is not None else None
+
+        data = self.GetDeviceData(deviceId)
+        if data is None:
+            self.failedPulls[deviceId] = now
+            return cached[1] if cached is not None else None
+        self.failedPulls.pop(deviceId, None)
+
+        attributes = self.GetDeviceAttributes(deviceId, data)
+        with self.lock:
+            self.recordHistory(deviceId, attributes, now)
+        report = {
+            'smart_health': self.GetDeviceHealth(deviceId, data),
+            'smart_failing': sorted(str(a.name) for a in attributes.values() if a.failing),
+            'smart_timestamp': now,
+        }
+        report.update(self.GetRates(deviceId))
+        self.reportCache[deviceId] = (now, report)
+        return report
+
+    def forgetDevice(self, deviceId):
+        with self.lock:
+            self.reportCache.pop(deviceId, None)
+            self.failedPulls.pop(deviceId, None)
+            self.history.pop(deviceId, None)
+
+
 if __name__ == '__main__':
     smart_features = SMART()
     deviceid = input("Enter device id: ")
+    data = smart_features.GetDeviceData(deviceid)
+    if data is None:
+        print("Device is in standby or could not be read")
+        exit(1)
     #fetchig disk health
-    devHealth = smart_features.GetDeviceHealth(deviceid)
+    devHealth = smart_features.GetDeviceHealth(deviceid, data)
     #printing device health information
     print("Disk Health Information")
     print(devHealth)
 
     #fetching attributes details
-    devAttr=smart_features.GetDeviceAttributes(deviceid)
+    devAttr=smart_features.GetDeviceAttributes(deviceid, data)
     #printing attributes information
     print("Disk attribute Informaion")
-    print("ID#      ATTRIBUTE_NAME         FLAG   VALUE  WORST  THRESH")
-    for attributes in devAttr:
-        print('\t'.join(devAttr[attributes][:6]))
-
-    print (devAttr)
-    #print("Drive temperature: "+devAttr['Temperature_Celsius'])
\ No newline at end of file
+    print("ID#      ATTRIBUTE_NAME         VALUE  WORST  THRESH  RAW")
+    for attr in devAttr.values():
+        print('\t'.join(str(x) for x in (attr.id, attr.name, attr.value, attr.worst, attr.thresh, attr.raw)))
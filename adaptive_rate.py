@@ -0,0 +1,95 @@
+"""
+Adaptive sampling interval for a collector
+
+Each collector is sampled as slowly as its signals allow.  After every
+sample the watched metrics are compared with their running average
+(EWMA); a change larger than 'change' (relative), or a value close to an
+alert threshold, halves the interval down to minSeconds.  While the signals
+stay flat the interval grows by 'backoff' up to maxSeconds.
+
+So a drive spin-up current spike or a rising enclosure temperature is
+followed closely, while filesystem capacity is only looked at every few
+minutes.
+
+collectors:
+  sampling:
+    power:
+      minSeconds: 5
+      maxSeconds: 30
+      change: 0.05
+      metrics: [rpi_current, drive1_current, drive2_current, rpi_psu_voltage]
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CHANGE = 0.05
+DEFAULT_BACKOFF = 1.5
+EWMA_ALPHA = 0.3
+# Values around 0 (e.g., an idle drive's current) are compared against this
+# instead of their tiny average
+MIN_SCALE = 0.01
+
+
+def flattenMetrics(prefix, value, names, out=None):
+    """
+    Numeric leaves of a snapshot section whose key is in names, keyed by
+    their dotted path (the same paths the alert rules use).
+    """
+    if out is None:
+        out = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            path = prefix + '.' + key
+            if isinstance(item, dict):
+                flattenMetrics(path, item, names, out)
+            elif key in names and isinstance(item, (int, float)) and not isinstance(item, bool):
+                out[path] = float(item)
+    return out
+
+
+class AdaptiveRate:
+
+    def __init__(self, minSeconds, maxSeconds, metrics, change=DEFAULT_CHANGE, backoff=DEFAULT_BACKOFF):
+        if minSeconds > maxSeconds:
+            raise ValueError("minSeconds {} is above maxSeconds {}".format(minSeconds, maxSeconds))
+        self.minSeconds = minSeconds
+        self.maxSeconds = maxSeconds
+        self.metrics = frozenset(metrics)
+        self.change = change
+        self.backoff = backoff
+        # Start fast, the averages need a few samples before they mean anything
+        self.interval = minSeconds
+        self.averages = {}
+
+    def update(self, values, nearThreshold=False):
+        """Feed the latest sample ({metric: value}), returns the new interval"""
+        volatile = nearThreshold
+        for metric, value in values.items():
+            average = self.averages.get(metric)
+            if average is None:
+                self.averages[metric] = value
+                volatile = True
+                continue
+            if abs(value - average) > max(abs(average), MIN_SCALE) * self.change:
+                volatile = True
+            self.averages[metric] = average + EWMA_ALPHA * (value - average)
+
+        if volatile:
+            interval = max(self.minSeconds, self.interval / 2)
+        else:
+            interval = min(self.maxSeconds, self.interval * self.backoff)
+        if interval != self.interval:
+            logger.debug("Sampling interval %0.1f -> %0.1f sec", self.interval, interval)
+        self.interval = interval
+        return interval
+
+    def getState(self):
+        return {'interval': self.interval, 'averages': dict(self.averages)}
+
+    def restoreState(self, state):
+        """Continue from a saved getState() (warm restart)"""
+        self.interval = min(self.maxSeconds, max(self.minSeconds, state.get('interval', self.minSeconds)))
+        self.averages.update(state.get('averages', {}))
@@ -0,0 +1,259 @@
+"""
+In-process threshold / alert rules
+
+Rules are declared in config.yml and evaluated against every new sample.
+An event is only produced when a rule changes state (ok -> firing or
+firing -> ok), so consumers get edge-triggered events instead of having to
+re-evaluate every snapshot.
+
+alerts:
+  - name: drive1_hot
+    metric: filesystem.data1.temperature_current
+    above: 50           # fire when the value goes above 50
+    clear: 47           # ... and only clear again below 47 (hysteresis)
+    forSeconds: 120     # condition must hold this long before firing
+  - name: psu_low
+    metric: power.rpi_psu_voltage
+    below: 4.85
+    clear: 4.95
+  - name: data1_filling_fast
+    metric: filesystem.data1.spaceusedpercent
+    rateAbove: 2.0      # percent per ratePerSeconds
+    ratePerSeconds: 3600
+    rateWindowSeconds: 600
+
+Each rule only looks at its own metric, and samples are routed by metric
+name, so the cost per sample is a dict lookup plus a few comparisons.
+
+A rule whose metric disappears goes to 'unknown' (an event if it was
+firing) and starts over when the metric comes back.
+"""
+
+import logging
+import time
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+STATE_OK = 'ok'
+STATE_PENDING = 'pending'
+STATE_FIRING = 'firing'
+# The metric is gone from its section (e.g., a drive was unplugged)
+STATE_UNKNOWN = 'unknown'
+
+DEFAULT_RATE_PER_SECONDS = 3600
+DEFAULT_RATE_WINDOW_SECONDS = 300
+# Within this fraction of a threshold a value counts as near it
+NEAR_THRESHOLD_MARGIN = 0.05
+
+
+class AlertRule:
+
+    def __init__(self, ruleConfig):
+        self.name = ruleConfig['name']
+        self.metric = ruleConfig['metric']
+        self.path = self.metric.split('.')
+        self.above = ruleConfig.get('above')
+        self.below = ruleConfig.get('below')
+        self.rateAbove = ruleConfig.get('rateAbove')
+        self.rateBelow = ruleConfig.get('rateBelow')
+        self.clear = ruleConfig.get('clear')
+        self.forSeconds = ruleConfig.get('forSeconds', 0)
+        self.clearForSeconds = ruleConfig.get('clearForSeconds', 0)
+        self.ratePerSeconds = ruleConfig.get('ratePerSeconds', DEFAULT_RATE_PER_SECONDS)
+        self.rateWindowSeconds = ruleConfig.get('rateWindowSeconds', DEFAULT_RATE_WINDOW_SECONDS)
+        self.usesRate = self.rateAbove is not None or self.rateBelow is not None
+        if self.above is None and self.below is None and not self.usesRate:
+            raise ValueError("alert rule {} needs one of above, below, rateAbove, rateBelow".format(self.name))
+
+        self.state = STATE_OK
+        self.conditionSince = None
+        self.clearSince = None
+        self.lastValue = None
+        # Reference sample for the rate of change
+        self.rateRefTime = None
+        self.rateRefValue = None
+        self.rate = None
+
+    def updateRate(self, value, now):
+        if self.rateRefTime is None:
+            self.rateRefTime = now
+            self.rateRefValue = value
+            return
+        elapsed = now - self.rateRefTime
+        if elapsed >= self.rateWindowSeconds:
+            self.rate = (value - self.rateRefValue) * self.ratePerSeconds / elapsed
+            self.rateRefTime = now
+            self.rateRefValue = value
+
+    def triggered(self, value):
+        if self.above is not None and value > self.above:
+            return True
+        if self.below is not None and value < self.below:
+            return True
+        if self.rate is not None:
+            if self.rateAbove is not None and self.rate > self.rateAbove:
+                return True
+            if self.rateBelow is not None and self.rate < self.rateBelow:
+                return True
+        return False
+
+    def cleared(self, value):
+        """While firing, the value has to get past the clear level (hysteresis)"""
+        if self.above is not None:
+            level = self.clear if self.clear is not None else self.above
+            if value > level:
+                return False
+        if self.below is not None:
+            level = self.clear if self.clear is not None else self.below
+            if value < level:
+                return False
+        if self.usesRate and self.rate is not None:
+            if self.rateAbove is not None and self.rate > self.rateAbove:
+                return False
+            if self.rateBelow is not None and self.rate < self.rateBelow:
+                return False
+        return True
+
+    def markMissing(self):
+        """No value for the metric, returning STATE_UNKNOWN if the rule was firing"""
+        wasFiring = self.state == STATE_FIRING
+        self.state = STATE_UNKNOWN
+        self.conditionSince = None
+        self.clearSince = None
+        self.lastValue = None
+        self.rateRefTime = None
+        self.rateRefValue = None
+        self.rate = None
+        return STATE_UNKNOWN if wasFiring else None
+
+    def update(self, value, now):
+        """Feed a sample, returning the new state on a transition or None"""
+        self.lastValue = value
+        if self.usesRate:
+            self.updateRate(value, now)
+
+        if self.state != STATE_FIRING:
+            if not self.triggered(value):
+                self.state = STATE_OK
+                self.conditionSince = None
+                return None
+            if self.conditionSince is None:
+                self.conditionSince = now
+            if (now - self.conditionSince) < self.forSeconds:
+                self.state = STATE_PENDING
+                return None
+            self.state = STATE_FIRING
+            self.clearSince = None
+            return STATE_FIRING
+
+        if not self.cleared(value):
+            self.clearSince = None
+            return None
+        if self.clearSince is None:
+            self.clearSince = now
+        if (now - self.clearSince) < self.clearForSeconds:
+            return None
+        self.state = STATE_OK
+        self.conditionSince = None
+        return STATE_OK
+
+
+class AlertEngine:
+
+    def __init__(self, rulesConfig, onTransition=None):
+        self.rules = []
+        self.rulesByMetric = {}
+        for ruleConfig in rulesConfig or []:
+            rule = AlertRule(ruleConfig)
+            self.rules.append(rule)
+            self.rulesByMetric.setdefault(rule.metric, []).append(rule)
+        self.onTransition = onTransition
+        self.lock = threading.Lock()
+
+    def observe(self, metric, value, now=None):
+        """Feed a single sample (e.g., straight from a collector at its sample rate)"""
+        rules = self.rulesByMetric.get(metric)
+        if rules is None or value is None:
+            return
+        if now is None:
+            now = time.time()
+        with self.lock:
+            events = []
+            for rule in rules:
+                newState = rule.update(value, now)
+                if newState is not None:
+                    events.append(self.buildEvent(rule, newState, now))
+        for event in events:
+            self.publish(event)
+
+    def evaluateSnapshot(self, stats, now=None, skip=()):
+        """
+        Feed every rule's metric from a full stats snapshot (a Snapshot or its
+        dict).  The rules on the sections in skip (collectors that were not
+        sampled again, whose values were already fed) are left alone.
+        """
+        if now is None:
+            now = time.time()
+        missing = []
+        for metric, rules in self.rulesByMetric.items():
+            path = rules[0].path
+            if path[0] in skip:
+                continue
+            # The section, then the keys within it
+            value = stats.get(path[0])
+            for key in path[1:]:
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.observe(metric, value, now)
+            else:
+                missing.append(rules)
+        if missing:
+            self.markMissing(missing, now)
+
+    def markMissing(self, rulesLists, now):
+        with self.lock:
+            events = []
+            for rules in rulesLists:
+                for rule in rules:
+                    if rule.state != STATE_UNKNOWN:
+                        newState = rule.markMissing()
+                        if newState is not None:
+                            events.append(self.buildEvent(rule, newState, now))
+        for event in events:
+            self.publish(event)
+
+    def buildEvent(self, rule, newState, now):
+        return {
+            'name': rule.name,
+            'metric': rule.metric,
+            'state': newState,
+            'value': rule.lastValue,
+            'rate': round(rule.rate, 4) if rule.rate is not None else None,
+            'timestampEpoc': now,
+        }
+
+    def publish(self, event):
+        logger.warning("Alert %s is %s (%s=%s)", event['name'], event['state'], event['metric'], event['value'])
+        if self.onTransition is not None:
+            try:
+                self.onTransition(event)
+            except Exception as e:
+                logger.error("Failed to publish alert %s: %s", event['name'], e)
+
+    def isNearThreshold(self, metric, value, margin=NEAR_THRESHOLD_MARGIN):
+        """True if value is close to one of the metric's thresholds, or a rule on it is pending or firing"""
+        for rule in self.rulesByMetric.get(metric, ()):
+            if rule.state in (STATE_PENDING, STATE_FIRING):
+                return True
+            for level in (rule.above, rule.below):
+                if level is not None and abs(value - level) <= abs(level) * margin:
+                    return True
+        return False
+
+    def getFiring(self):
+        return [rule.name for rule in self.rules if rule.state == STATE_FIRING]
@@ -0,0 +1,323 @@
+"""
+Per systemd service and Docker container CPU, memory and I/O (cgroup v2)
+
+The cgroups that are reported live in a few known directories:
+
+    system.slice/<name>.service          systemd services
+    system.slice/docker-<id>.scope       containers (systemd cgroup driver)
+    docker/<id>                          containers (cgroupfs cgroup driver)
+    machine.slice/libpod-<id>.scope      podman containers
+
+Those directories are listed once at startup and then watched with inotify,
+so a service or container starting (mkdir) or stopping (rmdir) is picked up
+without listing the tree again.  Each reported cgroup keeps its cpu.stat,
+memory.current and io.stat open, a collection is one pread() per file and
+the rates are computed against the previous sample:
+
+    cpu_percent            usage_usec delta, 100 = one full CPU
+    memory_bytes           memory.current
+    read_bytes_per_sec     rbytes delta of all devices in io.stat
+    write_bytes_per_sec    wbytes delta
+
+memory.current and io.stat only exist when the memory and io controllers
+are enabled for the subtree (the default with systemd on cgroup v2).  On a
+hybrid (v1 + v2) system only the CPU usage from /sys/fs/cgroup/unified is
+available.
+
+Config (config.yml):
+    cgroups:
+      enabled: true
+      # fnmatch patterns of the services reported, all of them by default
+      services: ['smbd', 'nfs-server', 'docker']
+
+Ref: https://www.kernel.org/doc/html/latest/admin-guide/cgroup-v2.html
+"""
+
+import errno
+import fnmatch
+import json
+import logging
+import os
+import time
+
+from dir_index import Inotify, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVED_FROM, IN_MOVED_TO, \
+    IN_ONLYDIR, IN_ISDIR, IN_IGNORED, IN_Q_OVERFLOW
+
+logger = logging.getLogger(__name__)
+
+
+# The unified hierarchy, or its mount on a hybrid system
+CGROUP_ROOTS = ('/sys/fs/cgroup', '/sys/fs/cgroup/unified')
+DOCKER_CONTAINERS_DIR = '/var/lib/docker/containers'
+# Directories holding the reported cgroups, relative to the root ('' is the root,
+# watched so docker/ and machine.slice/ are seen when they are created)
+PARENT_DIRS = ('', 'system.slice', 'docker', 'machine.slice')
+STAT_FILES = ('cpu.stat', 'memory.current', 'io.stat')
+# io.stat has a line per device
+READ_SIZE = 16 * 1024
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR
+
+KIND_SERVICE = 'services'
+KIND_CONTAINER = 'containers'
+CONTAINER_ID_LENGTH = 12
+
+
+def findCgroupRoot():
+    for root in CGROUP_ROOTS:
+        if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+            return root
+    return None
+
+
+def classifyCgroup(relPath):
+    """(kind, id) of a cgroup path relative to the root, None if it is not reported"""
+    parent, _, leaf = relPath.rpartition('/')
+    if parent == 'system.slice':
+        if leaf.startswith('docker-') and leaf.endswith('.scope'):
+            return KIND_CONTAINER, leaf[len('docker-'):-len('.scope')]
+        if leaf.endswith('.service'):
+            return KIND_SERVICE, leaf[:-len('.service')]
+    elif parent == 'docker':
+        return KIND_CONTAINER, leaf
+    elif parent == 'machine.slice' and leaf.startswith('libpod-') and leaf.endswith('.scope'):
+        return KIND_CONTAINER, leaf[len('libpod-'):-len('.scope')]
+    return None
+
+
+def containerName(containerId, containersDir=DOCKER_CONTAINERS_DIR):
+    """Docker's name for a container (read once, when it starts), or its short id"""
+    try:
+        with open(os.path.join(containersDir, containerId, 'config.v2.json'), 'r') as f:
+            name = json.load(f).get('Name')
+    except (OSError, ValueError):
+        name = None
+    return name.lstrip('/') if name else containerId[:CONTAINER_ID_LENGTH]
+
+
+def parseKeyedLine(text, key):
+    """Value of 'key <value>' in a flat keyed file (cpu.stat)"""
+    for line in text.splitlines():
+        name, _, value = line.partition(' ')
+        if name == key:
+            return int(value)
+    return None
+
+
+def parseIoStat(text):
+    """(rbytes, wbytes) of io.stat, all devices"""
+    readBytes = 0
+    writeBytes = 0
+    for line in text.split():
+        if line.startswith('rbytes='):
+            readBytes += int(line[7:])
+        elif line.startswith('wbytes='):
+            writeBytes += int(line[7:])
+    return readBytes, writeBytes
+
+
+class Cgroup:
+
+    __slots__ = ('kind', 'name', 'path', 'fds', 'cpuUsec', 'readBytes', 'writeBytes', 'sampleTime')
+
+    def __init__(self, kind, name, path):
+        self.kind = kind
+        self.name = name
+        self.path = path
+        # file -> open fd, only for the files this cgroup has
+        self.fds = {}
+        self.cpuUsec = None
+        self.readBytes = None
+        self.writeBytes = None
+        self.sampleTime = None
+
+    def open(self):
+        for fileName in STAT_FILES:
+            try:
+                self.fds[fileName] = os.open(os.path.join(self.path, fileName), os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                pass
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    def read(self, fileName):
+        fd = self.fds.get(fileName)
+        if fd is None:
+            return None
+        # The kernel regenerates the contents on every read from offset 0
+        return os.pread(fd, READ_SIZE, 0).decode('ascii')
+
+    def sample(self, now):
+        """Values and rates since the previous sample, OSError once the cgroup is gone"""
+        cpuStat = self.read('cpu.stat')
+        memory = self.read('memory.current')
+        ioStat = self.read('io.stat')
+        cpuUsec = parseKeyedLine(cpuStat, 'usage_usec') if cpuStat is not None else None
+        readBytes, writeBytes = parseIoStat(ioStat) if ioStat is not None else (None, None)
+
+        result = {}
+        if memory is not None:
+            result['memory_bytes'] = int(memory)
+        elapsed = now - self.sampleTime if self.sampleTime is not None else 0
+        if elapsed > 0:
+            if cpuUsec is not None and self.cpuUsec is not None:
+                result['cpu_percent'] = round((cpuUsec - self.cpuUsec) / (elapsed * 1e6) * 100, 1)
+            if readBytes is not None and self.readBytes is not None:
+                result['read_bytes_per_sec'] = round((readBytes - self.readBytes) / elapsed, 1)
+                result['write_bytes_per_sec'] = round((writeBytes - self.writeBytes) / elapsed, 1)
+        self.cpuUsec = cpuUsec
+        self.readBytes = readBytes
+        self.writeBytes = writeBytes
+        self.sampleTime = now
+        return result
+
+
+class CgroupMonitor:
+
+    def __init__(self, config, root=None, containersDir=DOCKER_CONTAINERS_DIR):
+        self.root = root if root is not None else findCgroupRoot()
+        self.containersDir = containersDir
+        # None: all services
+        self.servicePatterns = config.get('services')
+        # Path relative to the root -> Cgroup
+        self.cgroups = {}
+        self.inotify = None
+        # wd -> parent directory (relative), and back
+        self.watches = {}
+        self.watchByDir = {}
+
+    def startup(self):
+        if self.root is None:
+            logger.info("No cgroup v2 hierarchy, services and containers are not reported")
+            return
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            # The parent directories are listed at every collection instead
+            logger.warning("No inotify, cgroups are relisted every collection: %s", e)
+        self.rescan()
+
+    def shutdown(self):
+        for cgroup in self.cgroups.values():
+            cgroup.close()
+        self.cgroups = {}
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = {}
+        self.watchByDir = {}
+
+    def isReported(self, kind, cgroupId):
+        if kind != KIND_SERVICE or self.servicePatterns is None:
+            return True
+        return any(fnmatch.fnmatchcase(cgroupId, pattern) for pattern in self.servicePatterns)
+
+    def addCgroup(self, relPath):
+        if relPath in self.cgroups:
+            return
+        classified = classifyCgroup(relPath)
+        if classified is None or not self.isReported(*classified):
+            return
+        kind, cgroupId = classified
+        name = containerName(cgroupId, self.containersDir) if kind == KIND_CONTAINER else cgroupId
+        cgroup = Cgroup(kind, name, os.path.join(self.root, relPath))
+        cgroup.open()
+        if not cgroup.fds:
+            # Gone already
+            return
+        self.cgroups[relPath] = cgroup
+        logger.info("cgroup %s added (%s %s)", relPath, kind, name)
+
+    def removeCgroup(self, relPath):
+        cgroup = self.cgroups.pop(relPath, None)
+        if cgroup is not None:
+            cgroup.close()
+            logger.info("cgroup %s removed", relPath)
+
+    def watchDir(self, parent):
+        if self.inotify is None or parent in self.watchByDir:
+            return
+        try:
+            wd = self.inotify.addWatch(os.path.join(self.root, parent), WATCH_MASK)
+        except OSError:
+            # Does not exist (yet), the watch on the root tells us when it does
+            return
+        self.watches[wd] = parent
+        self.watchByDir[parent] = wd
+
+    def scanDir(self, parent):
+        """Watch a parent directory and add the reported cgroups in it"""
+        self.watchDir(parent)
+        try:
+            entries = [entry.name for entry in os.scandir(os.path.join(self.root, parent)) if entry.is_dir()]
+        except OSError:
+            return set()
+        found = set()
+        for name in entries:
+            relPath = name if not parent else parent + '/' + name
+            if relPath in PARENT_DIRS:
+                continue
+            found.add(relPath)
+            self.addCgroup(relPath)
+        return found
+
+    def rescan(self):
+        """List the parent directories and sync the open cgroups with them"""
+        found = set()
+        for parent in PARENT_DIRS:
+            found |= self.scanDir(parent)
+        for relPath in list(self.cgroups):
+            if relPath not in found:
+                self.removeCgroup(relPath)
+
+    def applyEvents(self):
+        """mkdir/rmdir of cgroups since the last collection"""
+        while True:
+            events = self.inotify.readEvents(0)
+            if not events:
+                return
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflow, relisting cgroups")
+                    self.rescan()
+                    continue
+                parent = self.watches.get(wd)
+                if parent is None:
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory itself is gone (e.g., docker/ when the daemon stopped)
+                    del self.watches[wd]
+                    del self.watchByDir[parent]
+                    continue
+                if not mask & IN_ISDIR or not name:
+                    continue
+                relPath = name if not parent else parent + '/' + name
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if relPath in PARENT_DIRS:
+                        self.scanDir(relPath)
+                    else:
+                        self.addCgroup(relPath)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.removeCgroup(relPath)
+
+    def collect(self):
+        """The 'cgroups' section, None without a cgroup v2 hierarchy"""
+        if self.root is None:
+            return None
+        if self.inotify is not None:
+            self.applyEvents()
+        else:
+            self.rescan()
+        now = time.monotonic()
+        result = {KIND_SERVICE: {}, KIND_CONTAINER: {}}
+        for relPath, cgroup in list(self.cgroups.items()):
+            try:
+                result[cgroup.kind][cgroup.name] = cgroup.sample(now)
+            except OSError as e:
+                # Removed before its inotify event was read (ENODEV)
+                if e.errno != errno.ENODEV:
+                    logger.error("cgroup %s: %s", relPath, e)
+                self.removeCgroup(relPath)
+        return result
@@ -0,0 +1,213 @@
+"""
+Run each stats collector with a deadline
+
+A hung I2C transaction or a stuck smartctl can't be interrupted from Python,
+so every collector gets its own worker thread.  The caller waits for at most
+the collector's deadline; if the collector has not returned by then its
+last good value is used and the section is marked stale.  A collector that is
+still stuck from a previous cycle is not started again (no pile up of hung
+threads) and not waited for until it returns.
+
+A collector that failed, timed out or is still stuck is retried after its
+current interval, doubled for every further failure up to maxSeconds, so a
+broken sensor does not make every cycle due.
+
+A collector with an AdaptiveRate (see adaptive_rate.py) is only started
+when its interval has passed; until then its last value is reused (and not
+marked stale).
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from adaptive_rate import flattenMetrics
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_DEADLINE_SECONDS = 10
+
+
+class Collector:
+
+    def __init__(self, name, func, deadline=DEFAULT_DEADLINE_SECONDS, rate=None):
+        self.name = name
+        self.func = func
+        self.deadline = deadline
+        self.rate = rate
+        # Monotonic times
+        self.lastStart = None
+        self.nextDue = 0
+        # Set when a new value arrived that the rate has not seen yet
+        self.sampled = False
+        self.stale = True
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='collect-' + name)
+        self.future = None
+        self.lastValue = None
+        self.lastSuccessTime = None
+        self.timeouts = 0
+        self.errors = 0
+        # Consecutive failed cycles, for the retry backoff
+        self.failures = 0
+
+    def start(self, *args):
+        """Start a collection unless the previous one is still running"""
+        if self.future is not None and not self.future.done():
+            return False
+        self.lastStart = time.monotonic()
+        self.future = self.executor.submit(self.func, *args)
+        return True
+
+    def isDue(self, monotonicNow):
+        return monotonicNow >= self.nextDue
+
+    def scheduleRetry(self):
+        """No new value this cycle: next attempt after a backoff instead of right away"""
+        self.failures += 1
+        if self.rate is None:
+            return
+        backoff = min(self.rate.interval * (2 ** (self.failures - 1)), self.rate.maxSeconds)
+        self.nextDue = time.monotonic() + backoff
+
+    def wait(self, waitUntil, now):
+        """
+        Wait until the monotonic time waitUntil for the running collection.
+        Returns (value, stale).
+        """
+        future = self.future
+        self.stale = True
+        if future is None:
+            return self.lastValue, True
+        try:
+            value = future.result(timeout=max(0, waitUntil - time.monotonic()))
+        except TimeoutError:
+            self.timeouts += 1
+            logger.error("Collector %s did not finish within %0.1f sec, using stale value", self.name, self.deadline)
+            self.scheduleRetry()
+            return self.lastValue, True
+        except Exception as e:
+            self.errors += 1
+            self.future = None
+            logger.error("Collector %s failed: %s", self.name, e)
+            self.scheduleRetry()
+            return self.lastValue, True
+        self.future = None
+        self.failures = 0
+        self.lastValue = value
+        self.lastSuccessTime = now
+        self.sampled = True
+        self.stale = False
+        return value, False
+
+    def getAge(self, now):
+        if self.lastSuccessTime is None:
+            return None
+        return round(now - self.lastSuccessTime, 1)
+
+    def shutdown(self):
+        # Don't wait for a hung collector
+        self.executor.shutdown(wait=False)
+
+
+class CollectorSet:
+    """Run a set of collectors concurrently, each bounded by its own deadline"""
+
+    def __init__(self):
+        self.collectors = []
+
+    def add(self, name, func, deadline=DEFAULT_DEADLINE_SECONDS, rate=None):
+        collector = Collector(name, func, deadline, rate)
+        self.collectors.append(collector)
+        return collector
+
+    def anyDue(self, only=None):
+        begin = time.monotonic()
+        return any(collector.isDue(begin) for collector in self.collectors
+                   if only is None or collector.name in only)
+
+    def getOlderThan(self, maxAge, now, only=None):
+        """Names of the collectors whose last value is older than maxAge seconds"""
+        return [c.name for c in self.collectors
+                if (only is None or c.name in only) and
+                (c.lastSuccessTime is None or now - c.lastSuccessTime > maxAge)]
+
+    def anyRunning(self):
+        """True while a collection (e.g., a hung one) has not returned"""
+        return any(c.future is not None and not c.future.done() for c in self.collectors)
+
+    def getNextDue(self):
+        """Monotonic time the next collector is due"""
+        return min((collector.nextDue for collector in self.collectors), default=0)
+
+    def collect(self, now, only=None, force=False):
+        """
+        Run the collectors that are due (or all of them with force), limited
+        to the names in only.  Returns ({name: value}, [stale names]).
+        Total time is bounded by the largest deadline.
+        """
+        begin = time.monotonic()
+        due = [collector for collector in self.collectors
+               if (only is None or collector.name in only) and (force or collector.isDue(begin))]
+        started = []
+        for collector in due:
+            if collector.start(now):
+                started.append(collector)
+            else:
+                # Waiting for it again would only block this cycle for its deadline
+                logger.warning("Collector %s is still running from a previous cycle", collector.name)
+                collector.stale = True
+                collector.scheduleRetry()
+        results = {}
+        stale = []
+        for collector in self.collectors:
+            if collector in started:
+                value, isStale = collector.wait(begin + collector.deadline, now)
+            else:
+                value, isStale = collector.lastValue, collector.stale
+            results[collector.name] = value
+            if isStale:
+                stale.append(collector.name)
+        return results, stale
+
+    def adapt(self, stats, nearThreshold=None):
+        """
+        Feed the new samples in the (converted) snapshot to each collector's
+        rate and schedule its next run.  nearThreshold(metric, value) tells
+        whether a value is close to an alert threshold.
+        """
+        for collector in self.collectors:
+            if not collector.sampled:
+                continue
+            collector.sampled = False
+            if collector.rate is None:
+                continue
+            values = flattenMetrics(collector.name, stats.get(collector.name), collector.rate.metrics)
+            near = nearThreshold is not None and any(nearThreshold(metric, value) for metric, value in values.items())
+            collector.nextDue = collector.lastStart + collector.rate.update(values, near)
+
+    def restoreValues(self, values):
+        """
+        Last values from a previous run ({name: value}), used (as stale) until
+        each collector delivers a new one.
+        """
+        for collector in self.collectors:
+            if collector.lastValue is None and values.get(collector.name) is not None:
+                collector.lastValue = values[collector.name]
+
+    def getSampled(self):
+        """Names of the collectors with a new value since the last adapt()"""
+        return [c.name for c in self.collectors if c.sampled]
+
+    def getIntervals(self):
+        """Current sampling interval (seconds) of each collector"""
+        return {c.name: round(c.rate.interval, 1) for c in self.collectors if c.rate is not None}
+
+    def getStatus(self, now):
+        return {c.name: {'age': c.getAge(now), 'timeouts': c.timeouts, 'errors': c.errors,
+                         'interval': round(c.rate.interval, 1) if c.rate is not None else None}
+                for c in self.collectors}
+
+    def shutdown(self):
+        for collector in self.collectors:
+            collector.shutdown()
@@ -0,0 +1,521 @@
+"""
+Incremental directory-size index for shared folders
+
+A "du" over multi-TB USB drives takes minutes and keeps the disks spinning,
+so each configured share root is scanned only once (at idle I/O priority),
+the result is persisted, and from then on inotify events tell us which
+directories changed.  Only those directories are re-read.
+
+A share is only restored from the state file if its scan completed (a scan
+interrupted by a stop is redone).  While nasmon was not running, files and
+directories may have been added, removed, renamed or rewritten in place (which
+does not change the directory mtime): at startup every restored directory is
+read again, the ones that are gone are dropped and the ones whose mtime or
+file signature (count, sizes, newest file mtime) changed are updated.
+
+When inotify runs out of watches (fs.inotify.max_user_watches) a share is
+only partly watched: it is not trusted as complete and is checked the same
+way every UNWATCHED_RESCAN_SECONDS, re-trying the missing watches.
+
+For every directory we keep the bytes used by the files directly in it
+("own" bytes) and the recursive total.  A change to one directory
+propagates its delta up to the share root, so share totals are always
+current and reading them is O(1).
+
+Ref: https://man7.org/linux/man-pages/man7/inotify.7.html
+"""
+
+import logging
+import os
+import time
+import json
+import errno
+import struct
+import select
+import ctypes
+import heapq
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TOP_N = 10
+# Changed directories are collected for this long before they are re-read
+DIRTY_FLUSH_SECONDS = 5
+# Minimum time between recomputing the top-N largest directories
+TOP_N_REFRESH_SECONDS = 60
+# How often the index is written back to the state file (if it changed)
+PERSIST_INTERVAL_SECONDS = 600
+# How often a share without a watch on every directory is checked for changes
+UNWATCHED_RESCAN_SECONDS = 3600
+
+STATE_FILE_VERSION = 3
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY so a file still being written (e.g., a long copy) is accounted
+# before it is closed, the dirty set collapses the events
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Minimal inotify wrapper using libc through ctypes"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def addWatch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def removeWatch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def readEvents(self, timeout):
+        """Return a list of (wd, mask, cookie, name) waiting up to timeout seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def setIdleIoPriority():
+    """Put the calling thread in the idle I/O class and lowest CPU priority"""
+    tid = threading.get_native_id()
+    try:
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+        subprocess.run(["ionice", "-c", "3", "-p", str(tid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        logger.warning("Unable to lower I/O priority: %s", e)
+
+
+def scanDir(path):
+    """
+    Return (own bytes, sub directories, mtime, files) for a single directory
+    without recursing.  Sizes are allocated blocks like "du" reports, files is
+    [count, total size, newest mtime] of the files in it.
+    """
+    own = 0
+    subdirs = []
+    mtime = None
+    files = [0, 0, 0]
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        st = entry.stat(follow_symlinks=False)
+                        own += st.st_blocks * 512
+                        files[0] += 1
+                        files[1] += st.st_size
+                        files[2] = max(files[2], st.st_mtime_ns)
+                except OSError:
+                    # File removed while scanning, a later event will fix it up
+                    pass
+    except OSError as e:
+        logger.debug("scanDir %s: %s", path, e)
+    return own, subdirs, mtime, files
+
+
+class Share:
+    """Index for a single share root"""
+
+    def __init__(self, name, root):
+        self.name = name
+        self.root = os.path.normpath(root)
+        self.ownBytes = {}
+        self.totalBytes = {}
+        self.children = {}
+        # Directory mtimes (ns) when they were last read
+        self.mtimes = {}
+        # File signatures (see scanDir) when they were last read
+        self.files = {}
+        # Set once a full scan (or the check of a restored index) finished
+        self.complete = False
+        # Cleared when a directory could not be watched (out of inotify watches)
+        self.watched = True
+        self.summary = {'bytes': 0, 'directories': 0, 'top': []}
+
+    def setOwn(self, path, own, mtime=None, files=None):
+        delta = own - self.ownBytes.get(path, 0)
+        self.ownBytes[path] = own
+        if mtime is not None:
+            self.mtimes[path] = mtime
+        if files is not None:
+            self.files[path] = files
+        if path not in self.children:
+            self.children[path] = set()
+            if path != self.root:
+                self.children.setdefault(os.path.dirname(path), set()).add(path)
+        if delta == 0:
+            return
+        # Propagate the change up to the share root
+        p = path
+        while True:
+            self.totalBytes[p] = self.totalBytes.get(p, 0) + delta
+            if p == self.root:
+                break
+            p = os.path.dirname(p)
+
+    def removeTree(self, path):
+        """Remove a directory and everything below it, returning the removed paths"""
+        removed = []
+        stack = [path]
+        while stack:
+            p = stack.pop()
+            if p not in self.ownBytes:
+                continue
+            stack.extend(self.children.get(p, ()))
+            self.setOwn(p, 0)
+            removed.append(p)
+        for p in removed:
+            del self.ownBytes[p]
+            self.mtimes.pop(p, None)
+            self.files.pop(p, None)
+            self.totalBytes.pop(p, None)
+            self.children.pop(p, None)
+        parent = self.children.get(os.path.dirname(path))
+        if parent is not None:
+            parent.discard(path)
+        return removed
+
+    def refreshSummary(self, topN):
+        top = heapq.nlargest(topN, ((size, path) for path, size in self.totalBytes.items() if path != self.root))
+        rootLen = len(self.root)
+        # Replace the dict in one step so readers never see a partial update
+        self.summary = {
+            'bytes': self.totalBytes.get(self.root, 0),
+            'directories': len(self.ownBytes),
+            'top': [{'path': path[rootLen:] or '/', 'bytes': size} for size, path in top],
+        }
+
+
+class DirIndex:
+    """
+    Keep per-share directory sizes current using inotify.
+    Config example (config.yml):
+        shares:
+          stateFile: /var/lib/nasmon/dirindex.json
+          topN: 10
+          roots:
+            media: /srv/dev-disk-by-label-data1/media
+    """
+
+    def __init__(self, config):
+        self.stateFile = config.get('stateFile')
+        self.topN = config.get('topN', DEFAULT_TOP_N)
+        self.shares = {}
+        for name, root in config.get('roots', {}).items():
+            self.shares[name] = Share(name, root)
+        self.inotify = None
+        self.watches = {}
+        self.watchByPath = {}
+        self.dirty = set()
+        self.changed = False
+        self.persistPending = False
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        if not self.shares:
+            return
+        self.thread = threading.Thread(target=self.indexThread, name='dirIndex')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+        self.saveState()
+
+    ######################################################################
+    # O(1) accessors used by the stats collection
+    ######################################################################
+    def getShareSummary(self, name):
+        share = self.shares.get(name)
+        return share.summary if share is not None else None
+
+    def getSharesForMountpoint(self, mountpoint):
+        """Return {share name: summary} for shares located under mountpoint"""
+        result = {}
+        for share in self.shares.values():
+            if share.root == mountpoint or share.root.startswith(mountpoint.rstrip('/') + '/'):
+                result[share.name] = share.summary
+        return result
+
+    ######################################################################
+    # Index maintenance (runs on the dirIndex thread)
+    ######################################################################
+    def addWatch(self, share, path):
+        if self.inotify is None or path in self.watchByPath:
+            return
+        try:
+            wd = self.inotify.addWatch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                # Changes below path go unnoticed, the share is rescanned periodically instead
+                if share.watched:
+                    logger.warning("Share %s: out of inotify watches at %s (raise fs.inotify.max_user_watches), "
+                                   "rescanning every %d sec", share.name, path, UNWATCHED_RESCAN_SECONDS)
+                share.watched = False
+            else:
+                logger.warning("inotify watch failed for %s: %s", path, e)
+            return
+        self.watches[wd] = (share, path)
+        self.watchByPath[path] = wd
+
+    def removeWatch(self, path):
+        wd = self.watchByPath.pop(path, None)
+        if wd is not None:
+            self.watches.pop(wd, None)
+            self.inotify.removeWatch(wd)
+
+    def addTree(self, share, path):
+        """Returns False if it was interrupted by a stop (the share is then incomplete)"""
+        stack = [path]
+        while stack and not self.thread_stop.is_set():
+            p = stack.pop()
+            # Watch before reading so nothing created in between is missed
+            self.addWatch(share, p)
+            own, subdirs, mtime, files = scanDir(p)
+            with self.lock:
+                share.setOwn(p, own, mtime, files)
+            stack.extend(subdirs)
+        self.changed = True
+        if stack:
+            share.complete = False
+            return False
+        return True
+
+    def verifyShare(self, share):
+        """
+        Catch up with a restored index (or a partly watched share): drop the
+        directories that are gone, update the ones whose mtime (entries added,
+        removed or renamed) or file signature (files rewritten) changed.
+        Returns False if the share can't be trusted as complete.
+        """
+        if not os.path.isdir(share.root):
+            # Not mounted: keep the old values, check again on the next start
+            logger.warning("Share %s: %s is not available", share.name, share.root)
+            return False
+        # Parents first, a removed parent takes its children with it
+        for path in sorted(share.ownBytes, key=len):
+            if self.thread_stop.is_set():
+                return False
+            if path not in share.ownBytes:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self.removeTree(share, path)
+                continue
+            self.addWatch(share, path)
+            own, subdirs, mtime, files = scanDir(path)
+            if mtime == share.mtimes.get(path) and files == share.files.get(path):
+                continue
+            with self.lock:
+                share.setOwn(path, own, mtime, files)
+            for subdir in subdirs:
+                if subdir not in share.ownBytes and not self.addTree(share, subdir):
+                    return False
+            self.changed = True
+        return True
+
+    def removeTree(self, share, path):
+        with self.lock:
+            removed = share.removeTree(path)
+        for p in removed:
+            self.removeWatch(p)
+        self.changed = True
+
+    def rescanDirty(self):
+        dirty = self.dirty
+        self.dirty = set()
+        for share, path in dirty:
+            if path not in share.ownBytes:
+                continue
+            own, subdirs, mtime, files = scanDir(path)
+            with self.lock:
+                share.setOwn(path, own, mtime, files)
+            # Pick up directories we missed (e.g., after a queue overflow)
+            for subdir in subdirs:
+                if subdir not in share.ownBytes:
+                    self.addTree(share, subdir)
+        if dirty:
+            self.changed = True
+
+    def handleEvent(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflow, rescanning all indexed directories")
+            for share in self.shares.values():
+                self.dirty.update((share, path) for path in share.ownBytes)
+            return
+        watch = self.watches.get(wd)
+        if watch is None:
+            return
+        share, path = watch
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            self.watchByPath.pop(path, None)
+            return
+        if mask & IN_ISDIR and name:
+            subdir = os.path.join(path, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.addTree(share, subdir)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.removeTree(share, subdir)
+            return
+        if mask & IN_DELETE_SELF:
+            self.removeTree(share, path)
+            return
+        self.dirty.add((share, path))
+
+    def indexThread(self):
+        setIdleIoPriority()
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logger.error("inotify unavailable, directory index disabled: %s", e)
+            return
+
+        restored = self.loadState()
+        for share in self.shares.values():
+            beginTime = time.time()
+            if share.name in restored:
+                # Re-arm the watches and re-read what changed while we were down
+                share.complete = self.verifyShare(share) and share.watched
+                logger.info("Check of restored share %s done in %0.1f sec", share.name, time.time() - beginTime)
+            else:
+                logger.info("Full scan of share %s at %s", share.name, share.root)
+                share.complete = self.addTree(share, share.root) and os.path.isdir(share.root) and share.watched
+                logger.info("Full scan of share %s done in %0.1f sec (complete: %s)",
+                            share.name, time.time() - beginTime, share.complete)
+            share.refreshSummary(self.topN)
+        self.saveState()
+
+        lastFlush = lastSummary = lastPersist = lastUnwatched = time.time()
+        while not self.thread_stop.is_set():
+            for wd, mask, cookie, name in self.inotify.readEvents(1.0):
+                self.handleEvent(wd, mask, name)
+            now = time.time()
+            if self.dirty and (now - lastFlush) >= DIRTY_FLUSH_SECONDS:
+                self.rescanDirty()
+                lastFlush = now
+            if (now - lastUnwatched) >= UNWATCHED_RESCAN_SECONDS:
+                for share in self.shares.values():
+                    if not share.watched and not self.thread_stop.is_set():
+                        # Watches may have been freed meanwhile, verifyShare re-tries them
+                        share.watched = True
+                        share.complete = self.verifyShare(share) and share.watched
+                lastUnwatched = now
+            if self.changed and (now - lastSummary) >= TOP_N_REFRESH_SECONDS:
+                with self.lock:
+                    for share in self.shares.values():
+                        share.refreshSummary(self.topN)
+                lastSummary = now
+                self.changed = False
+                self.persistPending = True
+            if self.persistPending and (now - lastPersist) >= PERSIST_INTERVAL_SECONDS:
+                self.saveState()
+                lastPersist = now
+
+        self.inotify.close()
+        self.inotify = None
+
+    ######################################################################
+    # Persistence
+    ######################################################################
+    def saveState(self):
+        if self.stateFile is None:
+            return
+        with self.lock:
+            state = {
+                'version': STATE_FILE_VERSION,
+                'shares': {name: {'root': share.root, 'complete': share.complete,
+                                  'own': share.ownBytes, 'mtime': share.mtimes, 'files': share.files}
+                           for name, share in self.shares.items()},
+            }
+            tmpFile = self.stateFile + '.tmp'
+            try:
+                with open(tmpFile, 'w') as f:
+                    json.dump(state, f, separators=(',', ':'))
+                os.replace(tmpFile, self.stateFile)
+            except OSError as e:
+                logger.error("Unable to save directory index to %s: %s", self.stateFile, e)
+                return
+        self.persistPending = False
+
+    def loadState(self):
+        """Restore persisted shares, returning the names of the shares restored"""
+        restored = set()
+        if self.stateFile is None:
+            return restored
+        try:
+            with open(self.stateFile, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return restored
+        if state.get('version') != STATE_FILE_VERSION:
+            return restored
+        with self.lock:
+            for name, saved in state.get('shares', {}).items():
+                share = self.shares.get(name)
+                if share is None or saved.get('root') != share.root:
+                    continue
+                if not saved.get('complete'):
+                    logger.info("Share %s was not completely scanned, scanning again", name)
+                    continue
+                mtimes = saved.get('mtime', {})
+                files = saved.get('files', {})
+                # Parents before children so the child sets are built in order
+                for path in sorted(saved['own'], key=len):
+                    share.setOwn(path, saved['own'][path], mtimes.get(path), files.get(path))
+                restored.add(name)
+        return restored
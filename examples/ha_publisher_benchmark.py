@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+"""
+Benchmark the Home Assistant REST publisher against a local stand-in server.
+
+Compares the old approach (a new connection per POST, one entity at a time,
+like examples/ha-update-info.py) with HaPublisher (pooled keep-alive
+connections, concurrent updates).
+
+Run from the repo root:
+    python3 examples/ha_publisher_benchmark.py [entities] [rounds] [latency ms]
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+import http.client
+import http.server
+import socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ha_publisher import HaPublisher
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts POST /api/states/<entity> like Home Assistant"""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; without this delayed ACK stalls keep-alive requests
+    disable_nagle_algorithm = True
+    latency = 0.0
+    connections = 0
+
+    def setup(self):
+        StandInHandler.connections += 1
+        super().setup()
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.rfile.read(length)
+        if self.latency:
+            time.sleep(self.latency)
+        body = b'{"state": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def naivePost(port, entityId, state):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/api/states/' + entityId, json.dumps({'state': state}),
+                 {'Authorization': 'Bearer x', 'Content-Type': 'application/json'})
+    conn.getresponse().read()
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    entityCount = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    StandInHandler.latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000
+
+    server = StandInServer(('127.0.0.1', 0), StandInHandler)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    entities = {'sensor.bench_{}'.format(i): 'values.v{}'.format(i) for i in range(entityCount)}
+
+    # Old approach: new connection, one entity at a time
+    StandInHandler.connections = 0
+    latencies = []
+    begin = time.perf_counter()
+    for r in range(rounds):
+        start = time.perf_counter()
+        for i in range(entityCount):
+            naivePost(port, 'sensor.bench_{}'.format(i), str(r))
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+    naiveConnections = StandInHandler.connections
+    print("naive:     {:8.1f} updates/s  round p50 {:6.1f} ms  p99 {:6.1f} ms  connections {}".format(
+        entityCount * rounds / elapsed, percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000, naiveConnections))
+
+    # HaPublisher: pooled keep-alive, concurrent
+    publisher = HaPublisher({'url': 'http://127.0.0.1:{}'.format(port), 'access_token': 'x',
+                             'entities': entities})
+    StandInHandler.connections = 0
+    latencies = []
+    begin = time.perf_counter()
+    for r in range(rounds):
+        stats = {'values': {'v{}'.format(i): r for i in range(entityCount)}}
+        start = time.perf_counter()
+        sent, failed = publisher.sendChanged(stats)
+        assert sent == entityCount and failed == 0
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - begin
+    print("pooled:    {:8.1f} updates/s  round p50 {:6.1f} ms  p99 {:6.1f} ms  connections {}".format(
+        entityCount * rounds / elapsed, percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000, StandInHandler.connections))
+
+    # Unchanged snapshot: nothing is sent
+    start = time.perf_counter()
+    sent, failed = publisher.sendChanged(stats)
+    print("unchanged: {} sent in {:.3f} ms".format(sent, (time.perf_counter() - start) * 1000))
+
+    publisher.shutdown()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
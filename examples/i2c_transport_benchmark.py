@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""
+Benchmark the /dev/i2c-N transport (i2c_transport.I2CBus) against the
+Adafruit Blinka stack: import time and per-transaction latency of the
+register accesses the sensor drivers make.
+
+Works on any Linux box with the i2c-stub kernel module standing in for the
+sensors (si7021 0x40, INA3221 0x41, BME280 0x76):
+
+    sudo modprobe i2c-dev
+    sudo modprobe i2c-stub chip_addr=0x40,0x41,0x76
+
+Run from the repo root (the stub bus is found by name, or give the number):
+    sudo python3 examples/i2c_transport_benchmark.py [bus] [iterations]
+
+i2c-stub only implements SMBus commands, so there I2CBus maps the
+transactions to SMBus ioctls and Blinka's I2C_RDWR based register reads
+fail (they are shown as n/a).  On a Raspberry Pi, bus 1 with the real
+sensors measures the I2C_RDWR path of both.
+
+Blinka is measured through its generic Linux I2C class (what busio.I2C
+wraps on a Pi), so the benchmark also runs where board can't be imported.
+That class has no try_lock/unlock, the benchmark adds Blinka's Lockable
+like busio.I2C does.
+"""
+
+import glob
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from i2c_transport import I2CBus
+
+try:
+    from adafruit_bus_device.i2c_device import I2CDevice
+except ImportError:
+    I2CDevice = None
+
+try:
+    from adafruit_blinka import Lockable
+    from adafruit_blinka.microcontroller.generic_linux.i2c import I2C as GenericLinuxI2C
+
+    class BlinkaI2C(Lockable, GenericLinuxI2C):
+        """The generic Linux I2C with busio.I2C's locking, which I2CDevice needs"""
+except ImportError:
+    BlinkaI2C = None
+
+
+STUB_ADAPTER_NAME = 'SMBus stub driver'
+INA3221_ADDRESS = 0x41
+BME280_ADDRESS = 0x76
+DEFAULT_ITERATIONS = 5000
+
+IMPORTS = [
+    ('i2c_transport', 'import i2c_transport'),
+    ('blinka board', 'import board'),
+    ('blinka busio', 'import busio'),
+]
+
+
+def findStubBus():
+    for path in glob.glob('/sys/class/i2c-adapter/i2c-*/name'):
+        with open(path) as f:
+            if f.read().strip() == STUB_ADAPTER_NAME:
+                return int(os.path.basename(os.path.dirname(path))[4:])
+    return None
+
+
+def importTime(statement):
+    """Seconds for statement in a fresh interpreter, None if it fails"""
+    # logging is already loaded in nasmon, it is not counted
+    code = ('import sys, time, logging; sys.path.insert(0, {!r}); t = time.perf_counter(); {}; '
+            'print(time.perf_counter() - t)').format(os.getcwd(), statement)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip())
+
+
+def registerOps(devices):
+    """The driver transactions, as (name, function)"""
+    out1 = bytearray(1)
+    in2 = bytearray(3)
+    in8 = bytearray(8)
+    config = bytearray((0x00, 0x71, 0x27))
+    out1[0] = 0x02
+
+    def readWord():
+        # INA3221 bus voltage: register pointer, then 2 bytes (driver's in_start=1 layout)
+        with devices[INA3221_ADDRESS] as i2c:
+            i2c.write_then_readinto(out1, in2, out_end=1, in_start=1)
+
+    def writeWord():
+        # INA3221 config register
+        with devices[INA3221_ADDRESS] as i2c:
+            i2c.write(config)
+
+    def readBurst():
+        # BME280 pressure/temperature/humidity burst at 0xF7
+        with devices[BME280_ADDRESS] as i2c:
+            i2c.write_then_readinto(bytes((0xF7,)), in8)
+
+    return [('read 2 byte register', readWord),
+            ('write 2 byte register', writeWord),
+            ('read 8 byte burst', readBurst)]
+
+
+def timeOp(function, iterations):
+    """Microseconds per call, None if the transport can't do it"""
+    try:
+        function()
+    except OSError:
+        return None
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    bus = int(sys.argv[1]) if len(sys.argv) > 1 else findStubBus()
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_ITERATIONS
+
+    print("{:20s} {:>12s}".format('import', 'ms'))
+    for name, statement in IMPORTS:
+        seconds = importTime(statement)
+        print("{:20s} {:>12s}".format(name, 'n/a' if seconds is None else '{:.1f}'.format(seconds * 1000)))
+
+    if bus is None:
+        print("\nNo I2C bus: sudo modprobe i2c-dev; sudo modprobe i2c-stub chip_addr=0x40,0x41,0x76")
+        return
+    if I2CDevice is None:
+        print("\nadafruit_bus_device is not installed, only imports measured")
+        return
+
+    transports = [('i2c_transport', I2CBus(bus))]
+    if BlinkaI2C is not None:
+        transports.append(('blinka', BlinkaI2C(bus)))
+
+    print("\n/dev/i2c-{}, {} iterations".format(bus, iterations))
+    print("{:24s}".format('us per transaction') + ''.join("{:>16s}".format(name) for name, _ in transports))
+    results = []
+    for name, i2c in transports:
+        devices = {address: I2CDevice(i2c, address, probe=False)
+                   for address in (INA3221_ADDRESS, BME280_ADDRESS)}
+        results.append([(opName, timeOp(function, iterations)) for opName, function in registerOps(devices)])
+    for row in zip(*results):
+        print("{:24s}".format(row[0][0]) +
+              ''.join("{:>16s}".format('n/a' if us is None else '{:.1f}'.format(us)) for _, us in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,767 @@
+#!/usr/bin/python3
+"""
+End-to-end load harness for the HTTP server and the MQTT publishing path.
+
+Starts nasmon in a child process with simulated sensors (NasStats is
+replaced by SimulatedStats, which publishes a snapshot shaped like the real
+one every --interval seconds) and a local MQTT broker stand-in, then runs
+the phases of a scenario against it:
+  - N HTTP clients, keep-alive or a new connection per request
+  - slow HTTP clients (trickle the request, read the response slowly)
+  - M MQTT subscribers on the status topic
+  - broker outages
+
+Per phase it reports HTTP requests/s, errors and p50/p99 latency, the
+publish-to-receive latency seen by the subscribers (snapshot timestamp to
+arrival) and the daemon's CPU (% of one core) and peak RSS.
+
+nasmon has no server-sent events endpoint, the stream subscribers are MQTT
+subscribers.
+
+Run from the repo root (needs the daemon's packages: paho-mqtt, PyYAML, psutil, pytz):
+    python3 examples/load_harness.py --list
+    python3 examples/load_harness.py --scenario dashboard_storm
+    python3 examples/load_harness.py --scenario my_scenario.json --json results.json
+
+A scenario file is a JSON list of phases, the keys are those of PHASE_DEFAULTS:
+    [{"name": "busy", "seconds": 10, "httpClients": 20, "subscribers": 5},
+     {"name": "outage", "seconds": 15, "httpClients": 20, "brokerDown": true}]
+"""
+
+import os
+import sys
+import time
+import json
+import copy
+import types
+import queue
+import random
+import signal
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psutil
+import yaml
+import paho.mqtt.client as mqtt
+
+
+QUEUE_NAMESPACE = 'loadharness'
+STATUS_TOPIC_FILTER = QUEUE_NAMESPACE + '/device/+/+/+/+/status'
+
+DEFAULT_PUBLISH_INTERVAL = 2
+HTTP_TIMEOUT_SECONDS = 10
+DAEMON_START_SECONDS = 30
+DAEMON_STOP_SECONDS = 30
+MONITOR_INTERVAL_SECONDS = 0.5
+# Per subscriber, the broker drops messages for a subscriber this far behind
+BROKER_QUEUE_SIZE = 1000
+SLOW_CLIENT_BYTE_SECONDS = 0.05
+SLOW_CLIENT_READ_BYTES = 256
+
+PHASE_DEFAULTS = {
+    'name': None,
+    'seconds': 10,
+    'httpClients': 0,
+    # False: a new connection for every request
+    'keepAlive': True,
+    'paths': ['/v1/data'],
+    # Pause between the requests of one client, 0 is as fast as possible
+    'requestGap': 0.0,
+    'slowClients': 0,
+    'subscribers': 0,
+    'brokerDown': False,
+}
+
+SCENARIOS = {
+    'baseline': [
+        {'name': 'idle', 'seconds': 10, 'subscribers': 1},
+        {'name': 'light', 'seconds': 10, 'httpClients': 2, 'requestGap': 0.5, 'subscribers': 2},
+    ],
+    'dashboard_storm': [
+        {'name': 'warmup', 'seconds': 5, 'httpClients': 2, 'requestGap': 0.5, 'subscribers': 2},
+        {'name': 'storm keep-alive', 'seconds': 15, 'httpClients': 50, 'subscribers': 10,
+         'paths': ['/v1/data', '/v1/data?fields=power,enclosure', '/v1/stats']},
+        {'name': 'storm new conns', 'seconds': 15, 'httpClients': 50, 'keepAlive': False, 'subscribers': 10,
+         'paths': ['/v1/data', '/v1/data?fields=power,enclosure', '/v1/stats']},
+    ],
+    'broker_outage': [
+        {'name': 'before', 'seconds': 10, 'httpClients': 5, 'requestGap': 0.1, 'subscribers': 2},
+        {'name': 'broker down', 'seconds': 20, 'httpClients': 5, 'requestGap': 0.1, 'brokerDown': True},
+        {'name': 'after', 'seconds': 20, 'httpClients': 5, 'requestGap': 0.1, 'subscribers': 2},
+    ],
+    'slow_clients': [
+        {'name': 'normal', 'seconds': 10, 'httpClients': 5, 'subscribers': 2},
+        {'name': 'slow', 'seconds': 20, 'httpClients': 5, 'slowClients': 20, 'subscribers': 2},
+    ],
+}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+######################################################################
+# Daemon side: nasmon with simulated sensors
+######################################################################
+
+class SimulatedStats:
+    """
+    Stands in for NasStats in the daemon: no sensors, a snapshot shaped like
+    the real one (with some noise) every publishInterval seconds.
+    """
+
+    publishInterval = DEFAULT_PUBLISH_INTERVAL
+
+    def __init__(self, _nasMon):
+        from payload_encoding_benchmark import SNAPSHOT
+        from rolling_stats import RollingStats
+
+        self.nasMon = _nasMon
+        self.template = SNAPSHOT
+        self.burstCapture = None
+        self.rollingStats = RollingStats(self.nasMon.config.get('rollingStats', {}))
+        self.stats_lock = threading.Lock()
+        self.stats_cache = None
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        self.stats_cache = self.collectStats()
+        self.thread = threading.Thread(target=self.statsThread, name='statsUpdate')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def collectStats(self):
+        from snapshot import formatTimestamp
+
+        now = time.time()
+        stats = copy.deepcopy(self.template)
+        stats['timestampEpoc'] = now
+        stats['timestamp'] = formatTimestamp(now)
+        stats['os']['cpuPercent'] = round(random.uniform(1, 30), 1)
+        stats['enclosure']['temperature1'] = round(random.gauss(84, 0.5), 1)
+        power = stats['power']
+        for key in ('rpi_current', 'drive1_current', 'drive2_current'):
+            power[key] = round(max(0.0, random.gauss(power[key], 0.02)), 3)
+        power['watts'] = round(sum(power[key] for key in ('rpi_current', 'drive1_current', 'drive2_current')) * 5.1, 2)
+        for section in ('os', 'enclosure', 'power', 'filesystem'):
+            self.rollingStats.observeSection(section, stats[section], now)
+        stats['rolling'] = self.rollingStats.getSummary(now)
+        return stats
+
+    def getStats(self, sections=None, maxAge=None):
+        with self.stats_lock:
+            if maxAge is not None and time.time() - self.stats_cache['timestampEpoc'] > maxAge:
+                self.stats_cache = self.collectStats()
+            return self.stats_cache
+
+    def statsThread(self):
+        while not self.thread_stop.wait(self.publishInterval):
+            data = self.collectStats()
+            with self.stats_lock:
+                self.stats_cache = data
+            self.nasMon.pubsub.publishCurrentState(data)
+            for exporter in self.nasMon.exporters:
+                exporter.publish(data)
+            self.nasMon.watchdog.progress("simulated")
+
+
+def runDaemon(workdir, httpPort, interval):
+    """Entry point of the child process (--daemon)"""
+    os.chdir(workdir)
+    SimulatedStats.publishInterval = interval
+    # Everything that imports NasStats gets the simulated one, no sensor packages needed
+    simulated = types.ModuleType('nas_stats')
+    simulated.NasStats = SimulatedStats
+    sys.modules['nas_stats'] = simulated
+
+    import http_request
+    import nasmon
+    http_request.HttpServer.PORT = httpPort
+    nasMon = nasmon.NasMon()
+    # Blocks until SIGTERM
+    nasMon.startup()
+
+
+def writeConfig(workdir, brokerPort):
+    config = {
+        'mqtt': {
+            'host': '127.0.0.1', 'port': brokerPort, 'username': 'harness', 'password': 'harness',
+            'queue': {'queueNamespace': QUEUE_NAMESPACE, 'locationName': 'bench',
+                      'typeName': 'nas', 'deviceName': 'harness'},
+        },
+        'logging': {'level': 'WARNING'},
+    }
+    with open(os.path.join(workdir, 'config.yml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+
+def startDaemon(workdir, httpPort, interval):
+    log = open(os.path.join(workdir, 'nasmon.log'), 'w')
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), '--daemon', workdir,
+                             '--http-port', str(httpPort), '--interval', str(interval)],
+                            stdout=log, stderr=subprocess.STDOUT)
+
+
+def waitForHttp(daemon, httpPort):
+    deadline = time.monotonic() + DAEMON_START_SECONDS
+    while time.monotonic() < deadline:
+        if daemon.poll() is not None:
+            raise RuntimeError("nasmon exited with code {}".format(daemon.returncode))
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', httpPort, timeout=1)
+            conn.request('GET', '/v1/data')
+            status = conn.getresponse().status
+            conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("nasmon did not answer on port {} within {} sec".format(httpPort, DAEMON_START_SECONDS))
+
+
+def stopDaemon(daemon):
+    if daemon.poll() is not None:
+        return
+    daemon.send_signal(signal.SIGTERM)
+    try:
+        daemon.wait(DAEMON_STOP_SECONDS)
+    except subprocess.TimeoutExpired:
+        daemon.kill()
+        daemon.wait()
+
+
+######################################################################
+# MQTT broker stand-in (MQTT 3.1.1, enough for paho clients)
+######################################################################
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def encodeLength(length):
+    data = bytearray()
+    while True:
+        byte = length & 0x7f
+        length >>= 7
+        data.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(data)
+
+
+def mqttPacket(kind, body, flags=0):
+    return bytes([kind << 4 | flags]) + encodeLength(len(body)) + body
+
+
+def mqttString(data):
+    return struct.pack('>H', len(data)) + data
+
+
+def readString(body, pos):
+    length = struct.unpack_from('>H', body, pos)[0]
+    return body[pos + 2:pos + 2 + length], pos + 2 + length
+
+
+def topicMatches(topicFilter, topic):
+    filterParts = topicFilter.split('/')
+    topicParts = topic.split('/')
+    for i, part in enumerate(filterParts):
+        if part == '#':
+            return True
+        if i >= len(topicParts) or (part != '+' and part != topicParts[i]):
+            return False
+    return len(filterParts) == len(topicParts)
+
+
+class BrokerConnection:
+
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.outgoing = queue.Queue(maxsize=BROKER_QUEUE_SIZE)
+        self.subscriptions = []
+        self.will = None
+        threading.Thread(target=self.readerThread, daemon=True).start()
+        threading.Thread(target=self.writerThread, daemon=True).start()
+
+    def send(self, data):
+        try:
+            self.outgoing.put_nowait(data)
+        except queue.Full:
+            self.broker.dropped += 1
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def writerThread(self):
+        while True:
+            data = self.outgoing.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                break
+
+    def readPacket(self):
+        header = self.reader.read(1)
+        if not header:
+            raise ConnectionError("closed")
+        length = 0
+        shift = 0
+        while True:
+            byte = self.reader.read(1)
+            if not byte:
+                raise ConnectionError("closed")
+            length |= (byte[0] & 0x7f) << shift
+            if not byte[0] & 0x80:
+                break
+            shift += 7
+        body = self.reader.read(length)
+        if len(body) < length:
+            raise ConnectionError("closed")
+        return header[0], body
+
+    def readerThread(self):
+        try:
+            while self.handle(*self.readPacket()):
+                pass
+        except (OSError, ConnectionError, ValueError, struct.error):
+            pass
+        finally:
+            self.broker.remove(self)
+            if self.will is not None:
+                self.broker.publish(*self.will)
+            self.outgoing.put(None)
+            self.close()
+
+    def handle(self, header, body):
+        kind = header >> 4
+        if kind == CONNECT:
+            protocolName, pos = readString(body, 0)
+            flags = body[pos + 1]
+            clientId, pos = readString(body, pos + 4)
+            if flags & 0x04:
+                willTopic, pos = readString(body, pos)
+                willMessage, pos = readString(body, pos)
+                self.will = (willTopic.decode('utf-8'), willMessage, bool(flags & 0x20))
+            self.send(mqttPacket(CONNACK, b'\x00\x00'))
+        elif kind == PUBLISH:
+            qos = (header >> 1) & 3
+            topic, pos = readString(body, 0)
+            packetId = body[pos:pos + 2]
+            if qos:
+                pos += 2
+            self.broker.publish(topic.decode('utf-8'), body[pos:], bool(header & 1))
+            if qos == 1:
+                self.send(mqttPacket(PUBACK, packetId))
+            elif qos == 2:
+                self.send(mqttPacket(PUBREC, packetId))
+        elif kind == PUBREL:
+            self.send(mqttPacket(PUBCOMP, body[:2]))
+        elif kind == SUBSCRIBE:
+            filters = []
+            pos = 2
+            while pos < len(body):
+                topicFilter, pos = readString(body, pos)
+                filters.append(topicFilter.decode('utf-8'))
+                pos += 1
+            # Everything is granted QoS 0
+            self.send(mqttPacket(SUBACK, body[:2] + bytes(len(filters)), 0))
+            self.broker.subscribe(self, filters)
+        elif kind == UNSUBSCRIBE:
+            self.send(mqttPacket(UNSUBACK, body[:2]))
+        elif kind == PINGREQ:
+            self.send(mqttPacket(PINGRESP, b''))
+        elif kind == DISCONNECT:
+            self.will = None
+            return False
+        return True
+
+
+class BrokerStandIn:
+    """QoS 0 delivery, retained messages and wills, no authentication"""
+
+    def __init__(self, port=0):
+        self.port = port
+        self.lock = threading.Lock()
+        self.connections = []
+        self.retained = {}
+        self.listener = None
+        self.published = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.listener is not None:
+            return
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', self.port))
+        listener.listen(64)
+        self.port = listener.getsockname()[1]
+        self.listener = listener
+        threading.Thread(target=self.acceptThread, args=(listener,), daemon=True).start()
+
+    def stop(self):
+        """Close the listener and drop every client (an outage)"""
+        if self.listener is None:
+            return
+        self.listener.close()
+        self.listener = None
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
+
+    def acceptThread(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.connections.append(BrokerConnection(self, sock))
+
+    def remove(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def subscribe(self, connection, filters):
+        with self.lock:
+            connection.subscriptions.extend(filters)
+            retained = [(topic, payload) for topic, payload in self.retained.items()
+                        if any(topicMatches(f, topic) for f in filters)]
+        for topic, payload in retained:
+            connection.send(mqttPacket(PUBLISH, mqttString(topic.encode('utf-8')) + payload, 1))
+
+    def publish(self, topic, payload, retain=False):
+        data = mqttPacket(PUBLISH, mqttString(topic.encode('utf-8')) + payload)
+        with self.lock:
+            self.published += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            targets = [c for c in self.connections if any(topicMatches(f, topic) for f in c.subscriptions)]
+        for connection in targets:
+            connection.send(data)
+
+
+######################################################################
+# Load generators
+######################################################################
+
+class PhaseResults:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.publishLatencies = []
+        self.messages = 0
+        self.firstMessage = None
+
+    def addRequest(self, seconds, ok):
+        with self.lock:
+            if ok:
+                self.latencies.append(seconds)
+            else:
+                self.errors += 1
+
+    def addMessage(self, latency):
+        with self.lock:
+            if self.firstMessage is None:
+                self.firstMessage = time.monotonic()
+            self.messages += 1
+            self.publishLatencies.append(latency)
+
+
+def httpClient(port, phase, results, stop):
+    paths = phase['paths']
+    headers = {} if phase['keepAlive'] else {'Connection': 'close'}
+    conn = None
+    count = 0
+    while not stop.is_set():
+        path = paths[count % len(paths)]
+        count += 1
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=HTTP_TIMEOUT_SECONDS)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            ok = response.status == 200
+            if not phase['keepAlive'] or response.will_close:
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            ok = False
+            if conn is not None:
+                conn.close()
+                conn = None
+        results.addRequest(time.perf_counter() - start, ok)
+        if phase['requestGap']:
+            stop.wait(phase['requestGap'])
+    if conn is not None:
+        conn.close()
+
+
+def slowClient(port, phase, stop):
+    """Trickles the request one byte at a time, then reads the response slowly"""
+    request = 'GET {} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.format(phase['paths'][0]).encode('ascii')
+    while not stop.is_set():
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=HTTP_TIMEOUT_SECONDS) as sock:
+                for i in range(len(request)):
+                    sock.sendall(request[i:i + 1])
+                    if stop.wait(SLOW_CLIENT_BYTE_SECONDS):
+                        return
+                response = b''
+                while b'\r\n\r\n' not in response:
+                    chunk = sock.recv(SLOW_CLIENT_READ_BYTES)
+                    if not chunk:
+                        break
+                    response += chunk
+                head, _, body = response.partition(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                while len(body) < length:
+                    if stop.wait(SLOW_CLIENT_BYTE_SECONDS):
+                        return
+                    chunk = sock.recv(SLOW_CLIENT_READ_BYTES)
+                    if not chunk:
+                        break
+                    body += chunk
+        except (OSError, ValueError):
+            stop.wait(SLOW_CLIENT_BYTE_SECONDS)
+
+
+class Subscriber:
+    """MQTT subscriber on the status topic, measures publish-to-receive latency"""
+
+    def __init__(self, index, brokerPort, results):
+        self.results = results
+        self.client = mqtt.Client(client_id='loadharness-sub-{}-{}'.format(os.getpid(), index))
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect_async('127.0.0.1', brokerPort, 60)
+        self.client.loop_start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(STATUS_TOPIC_FILTER, qos=0)
+
+    def on_message(self, client, userdata, msg):
+        now = time.time()
+        # Retained copies are old on purpose, only live publishes count
+        if msg.retain:
+            return
+        try:
+            data = json.loads(msg.payload)
+        except ValueError:
+            return
+        timestampEpoc = data.get('timestampEpoc') if isinstance(data, dict) else None
+        if timestampEpoc is None or 'state' in data:
+            # Birth / shutdown messages
+            return
+        self.results.addMessage(now - timestampEpoc)
+
+    def stop(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class DaemonMonitor:
+    """CPU time and peak RSS of the daemon during a phase"""
+
+    def __init__(self, pid):
+        self.process = psutil.Process(pid)
+        self.stopEvent = threading.Event()
+        self.begin = time.monotonic()
+        self.cpuBegin = self.cpuSeconds()
+        self.peakRss = self.process.memory_info().rss
+        self.thread = threading.Thread(target=self.monitorThread, daemon=True)
+        self.thread.start()
+
+    def cpuSeconds(self):
+        times = self.process.cpu_times()
+        return times.user + times.system
+
+    def monitorThread(self):
+        while not self.stopEvent.wait(MONITOR_INTERVAL_SECONDS):
+            try:
+                self.peakRss = max(self.peakRss, self.process.memory_info().rss)
+            except psutil.Error:
+                return
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+        elapsed = time.monotonic() - self.begin
+        return {
+            'cpuPercent': round((self.cpuSeconds() - self.cpuBegin) / elapsed * 100, 1),
+            'rssMB': round(self.peakRss / 1024 / 1024, 1),
+            'threads': self.process.num_threads(),
+        }
+
+
+def runPhase(phase, daemon, httpPort, broker):
+    phase = dict(PHASE_DEFAULTS, **phase)
+    if phase['brokerDown']:
+        broker.stop()
+    else:
+        broker.start()
+
+    results = PhaseResults()
+    stop = threading.Event()
+    subscribers = []
+    if not phase['brokerDown']:
+        subscribers = [Subscriber(i, broker.port, results) for i in range(phase['subscribers'])]
+    threads = [threading.Thread(target=httpClient, args=(httpPort, phase, results, stop), daemon=True)
+               for i in range(phase['httpClients'])]
+    threads += [threading.Thread(target=slowClient, args=(httpPort, phase, stop), daemon=True)
+                for i in range(phase['slowClients'])]
+
+    monitor = DaemonMonitor(daemon.pid)
+    begin = time.monotonic()
+    for thread in threads:
+        thread.start()
+    stop.wait(phase['seconds'])
+    stop.set()
+    elapsed = time.monotonic() - begin
+    for thread in threads:
+        thread.join(HTTP_TIMEOUT_SECONDS + 1)
+    for subscriber in subscribers:
+        subscriber.stop()
+    usage = monitor.stop()
+
+    def ms(seconds):
+        return round(seconds * 1000, 2) if seconds is not None else None
+
+    with results.lock:
+        summary = {
+            'name': phase['name'],
+            'seconds': round(elapsed, 1),
+            'requests': len(results.latencies),
+            'requestsPerSecond': round(len(results.latencies) / elapsed, 1),
+            'errors': results.errors,
+            'p50ms': ms(percentile(results.latencies, 50)),
+            'p99ms': ms(percentile(results.latencies, 99)),
+            'messages': results.messages,
+            'publishP50ms': ms(percentile(results.publishLatencies, 50)),
+            'publishP99ms': ms(percentile(results.publishLatencies, 99)),
+            # How long after the phase started the subscribers got something (e.g., after an outage)
+            'firstMessageSeconds': round(results.firstMessage - begin, 2) if results.firstMessage else None,
+        }
+    summary.update(usage)
+    return summary
+
+
+def loadScenario(name):
+    if name in SCENARIOS:
+        return SCENARIOS[name]
+    with open(name, 'r') as f:
+        phases = json.load(f)
+    for phase in phases:
+        unknown = set(phase) - set(PHASE_DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown phase keys: {}".format(', '.join(sorted(unknown))))
+    return phases
+
+
+def printResults(results):
+    columns = (('name', 'phase', '{:20s}', '{:20s}'), ('requestsPerSecond', 'req/s', '{:>8s}', '{:8.1f}'),
+               ('errors', 'errors', '{:>7s}', '{:7d}'), ('p50ms', 'p50 ms', '{:>8s}', '{:8.2f}'),
+               ('p99ms', 'p99 ms', '{:>8s}', '{:8.2f}'), ('messages', 'msgs', '{:>6s}', '{:6d}'),
+               ('publishP50ms', 'pub p50 ms', '{:>11s}', '{:11.2f}'),
+               ('publishP99ms', 'pub p99 ms', '{:>11s}', '{:11.2f}'),
+               ('cpuPercent', 'cpu %', '{:>6s}', '{:6.1f}'), ('rssMB', 'rss MB', '{:>7s}', '{:7.1f}'))
+    print(' '.join(header.format(label) for key, label, header, value in columns))
+    for result in results:
+        print(' '.join(value.format(result[key]) if result[key] is not None else header.format('-')
+                       for key, label, header, value in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load harness for nasmon')
+    parser.add_argument('--scenario', default='baseline', help='scenario name or JSON file of phases')
+    parser.add_argument('--list', action='store_true', help='list the built-in scenarios')
+    parser.add_argument('--interval', type=float, default=DEFAULT_PUBLISH_INTERVAL,
+                        help='seconds between simulated snapshots')
+    parser.add_argument('--http-port', type=int, default=0, help='HTTP port of the daemon (default: any free port)')
+    parser.add_argument('--mqtt-port', type=int, default=0, help='port of the broker stand-in (default: any free port)')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--daemon', metavar='WORKDIR', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.daemon:
+        runDaemon(args.daemon, args.http_port, args.interval)
+        return
+    if args.list:
+        for name, phases in SCENARIOS.items():
+            print("{:16s} {}".format(name, ', '.join(phase['name'] for phase in phases)))
+        return
+
+    phases = loadScenario(args.scenario)
+    broker = BrokerStandIn(args.mqtt_port)
+    broker.start()
+    httpPort = args.http_port or freePort()
+    workdir = tempfile.mkdtemp(prefix='nasmon-load-')
+    writeConfig(workdir, broker.port)
+    print("nasmon http:{} mqtt:{} log: {}".format(httpPort, broker.port, os.path.join(workdir, 'nasmon.log')))
+
+    daemon = startDaemon(workdir, httpPort, args.interval)
+    results = []
+    try:
+        waitForHttp(daemon, httpPort)
+        for phase in phases:
+            results.append(runPhase(phase, daemon, httpPort, broker))
+            print("phase {} done".format(results[-1]['name']))
+    finally:
+        stopDaemon(daemon)
+        broker.stop()
+
+    printResults(results)
+    print("broker: {} published, {} dropped".format(broker.published, broker.dropped))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
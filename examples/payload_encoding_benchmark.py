@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+"""
+Benchmark the payload encodings (encode time and payload size) using a
+snapshot shaped like the one published by nasmon.
+
+Run from the repo root:
+    python3 examples/payload_encoding_benchmark.py
+MessagePack/CBOR are only measured when msgpack/cbor2 are installed.
+"""
+
+import os
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payload_encoding import encodePayload, decodePayload, availableEncodings
+
+
+def sampleFilesystem(label, kname, pkname):
+    return {
+        'label': label, 'kname': kname, 'path': '/dev/' + kname,
+        'mountpoint': '/srv/dev-disk-by-label-' + label, 'pkname': pkname,
+        'read_bytes': 123456789012, 'write_bytes': 98765432109,
+        'spacetotal': 3998833471488, 'spaceused': 2451238236160, 'spaceavail': 1547578458112,
+        'spaceusedpercent': 61.299, 'activity_read': True, 'activity_write': False,
+        'drive_state': 'active', 'temperature_current': 38, 'temperature_max': 51,
+        'temperature_min': 18, 'temperature_age': 42.3,
+    }
+
+
+SNAPSHOT = {
+    'timestampEpoc': 1603129537.1234567,
+    'timestamp': '2020-10-19 11:45:37.123456-0600',
+    'collectStatsDuration': 4.217,
+    'os': {
+        'cpuPercent': 3.4, 'cpuFreq': 600.0, 'cpuTemperature': 118.4, 'memoryUsedPercent': 21.7,
+        'bootTimestampEpoc': 1602000000.0, 'uptime': 1129537.123, 'uptimeFmt': '13 days, 1:45:37',
+        'monUptime': 86400.5, 'monUptimeFmt': '1 day, 0:00:00',
+    },
+    'enclosure': {'temperature1': 84.2, 'humidity1': 31.5, 'temperature2': 84.9, 'humidity2': 30.1, 'pressure': 842.17},
+    'power': {
+        'rpi_psu_voltage': 5.12, 'rpi_current': 0.812, 'rpi_bus_voltage': 5.08,
+        'drive1_psu_voltage': 5.1, 'drive1_current': 0.453, 'drive1_bus_voltage': 5.06,
+        'drive2_psu_voltage': 5.1, 'drive2_current': 0.447, 'drive2_bus_voltage': 5.05,
+        'watts': 8.6,
+    },
+    'filesystem': {
+        'data1': sampleFilesystem('data1', 'sda1', 'sda'),
+        'data2': sampleFilesystem('data2', 'sdb1', 'sdb'),
+    },
+}
+
+
+def main():
+    iterations = 5000
+    print("{:10s} {:>12s} {:>12s} {:>14s} {:>14s}".format(
+        'encoding', 'bytes', 'deflate', 'encode (us)', 'decode (us)'))
+    for encoding in availableEncodings():
+        data = encodePayload(SNAPSHOT, encoding)
+        assert decodePayload(data, encoding) == SNAPSHOT
+        encodeTime = timeit.timeit(lambda: encodePayload(SNAPSHOT, encoding), number=iterations)
+        decodeTime = timeit.timeit(lambda: decodePayload(data, encoding), number=iterations)
+        print("{:10s} {:12d} {:12d} {:14.1f} {:14.1f}".format(
+            encoding, len(data), len(zlib.compress(data)),
+            encodeTime / iterations * 1e6, decodeTime / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,44 @@
-#!/usr/bin/env python2
+#!/usr/bin/python3
+#
+# Check for throttling / under-voltage using the same in-process reader as nasmon
+# (firmware sysfs attribute or mailbox, no vcgencmd).
+#
+# Run from the repo root:
+#   python3 examples/pihealth.py
 
-import subprocess
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pi_throttle import defaultThrottledSource, decodeThrottled
 
-GET_THROTTLED_CMD = 'vcgencmd get_throttled'
 MESSAGES = {
-    0: 'Under-voltage!',
-    1: 'ARM frequency capped!',
-    2: 'Currently throttled!',
-    3: 'Soft temperature limit active',
-    16: 'Under-voltage has occurred since last reboot.',
-    17: 'Throttling has occurred since last reboot.',
-    18: 'ARM frequency capped has occurred since last reboot.',
-    19: 'Soft temperature limit has occurred'
+    'under_voltage': ('Under-voltage!', 'Under-voltage has occurred since last reboot.'),
+    'freq_capped': ('ARM frequency capped!', 'ARM frequency capped has occurred since last reboot.'),
+    'throttled': ('Currently throttled!', 'Throttling has occurred since last reboot.'),
+    'soft_temp_limit': ('Soft temperature limit active', 'Soft temperature limit has occurred'),
 }
 
 print("Checking for throttling issues since last reboot...")
 
-throttled_output = subprocess.check_output(GET_THROTTLED_CMD, shell=True)
-throttled_binary = bin(int(throttled_output.split('=')[1], 0))
+source = defaultThrottledSource()
+if source is None:
+    exit("No throttled state source found (not a Raspberry Pi?)")
+
+flags = decodeThrottled(source.read())
 
 warnings = 0
-for position, message in MESSAGES.iteritems():
-    # Check for the binary digits to be "on" for each warning message
-    if len(throttled_binary) > position and throttled_binary[0 - position - 1] == '1':
-        print(message)
+for name, state in flags.items():
+    nowMessage, occurredMessage = MESSAGES[name]
+    if state['now']:
+        print(nowMessage)
+        warnings += 1
+    if state['occurred']:
+        print(occurredMessage)
         warnings += 1
 
 if warnings == 0:
     print("Looking good!")
 else:
     print("Houston, we may have a problem!")
-
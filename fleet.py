@@ -0,0 +1,232 @@
+# Fleet aggregator -- consume the status of many nasmon nodes over MQTT
+#
+# Subscribes (with wildcards) to the topics published by Pubsub on every node:
+#   Node:   [NAMESPACE]/node/[NODE_NAME]/status                  (online / offline)
+#   Device: [NAMESPACE]/device/[TYPE]/[LOCATION_NAME]/[NODE_NAME]/[DEVICE_NAME]/status
+#
+# and keeps a compact in-memory table with the latest snapshot of each node plus a
+# small fixed-size history of a few key values.  Memory is bounded by the number
+# of nodes (least recently seen nodes are evicted), the payload size limit and the
+# history length.
+#
+# For the systemd watchdog the aggregator sends itself a heartbeat through the broker:
+#   [NAMESPACE]/aggregator/[CLIENT_ID]/heartbeat
+# and reports progress each time it comes back, so a wedged MQTT loop gets the
+# service restarted even when no node is publishing.
+
+import time
+import threading
+import logging
+import json
+from collections import OrderedDict, deque
+
+import paho.mqtt.client as mqtt
+
+
+logger = logging.getLogger(__name__)
+
+
+FLEET_MAX_NODES = 500
+FLEET_HISTORY_SIZE = 60
+# Snapshots larger than this are dropped rather than stored
+FLEET_MAX_PAYLOAD_BYTES = 64 * 1024
+# A node is reported stale when its last snapshot is older than this (3 publish intervals)
+FLEET_STALE_AFTER_SECONDS = 90
+# Well below half of the unit's WatchdogSec
+FLEET_HEARTBEAT_SECONDS = 30
+
+# Values (section, field) kept in the per-node history
+HISTORY_FIELDS = (
+    ('power', 'watts'),
+    ('power', 'rpi_psu_voltage'),
+    ('os', 'cpuTemperature'),
+    ('os', 'cpuPercent'),
+    ('enclosure', 'temperature1'),
+)
+
+
+class FleetNode:
+    """Latest state and history of a single node"""
+
+    __slots__ = ('node', 'typeName', 'location', 'device', 'online',
+                 'latest', 'lastSeen', 'history')
+
+    def __init__(self, node, historySize):
+        self.node = node
+        self.typeName = None
+        self.location = None
+        self.device = None
+        self.online = None
+        self.latest = None
+        self.lastSeen = None
+        self.history = deque(maxlen=historySize)
+
+
+class FleetTable:
+
+    def __init__(self, maxNodes=FLEET_MAX_NODES, historySize=FLEET_HISTORY_SIZE,
+                 staleAfter=FLEET_STALE_AFTER_SECONDS):
+        self.maxNodes = maxNodes
+        self.historySize = historySize
+        self.staleAfter = staleAfter
+        # Ordered by last update so the least recently seen node is evicted first
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getNode(self, nodeName):
+        node = self.nodes.get(nodeName)
+        if node is None:
+            node = FleetNode(nodeName, self.historySize)
+            self.nodes[nodeName] = node
+            while len(self.nodes) > self.maxNodes:
+                evicted, _ = self.nodes.popitem(last=False)
+                logger.warning("Fleet table full, evicted node %s", evicted)
+        else:
+            self.nodes.move_to_end(nodeName)
+        return node
+
+    def updateNodeState(self, nodeName, online):
+        with self.lock:
+            node = self.getNode(nodeName)
+            node.online = online
+
+    def updateStatus(self, typeName, location, nodeName, device, snapshot, now):
+        historyValues = []
+        for section, field in HISTORY_FIELDS:
+            sectionData = snapshot.get(section)
+            historyValues.append(sectionData.get(field) if isinstance(sectionData, dict) else None)
+        with self.lock:
+            node = self.getNode(nodeName)
+            node.typeName = typeName
+            node.location = location
+            node.device = device
+            node.latest = snapshot
+            node.lastSeen = now
+            if snapshot.get('state') not in ('starting', 'shutdown'):
+                node.history.append((round(now, 1),) + tuple(historyValues))
+
+    def getFleet(self, now=None, includeHistory=True):
+        if now is None:
+            now = time.time()
+        nodes = {}
+        with self.lock:
+            for name, node in self.nodes.items():
+                age = None if node.lastSeen is None else round(now - node.lastSeen, 1)
+                entry = {
+                    'type': node.typeName,
+                    'location': node.location,
+                    'device': node.device,
+                    'online': node.online,
+                    'lastSeenEpoc': node.lastSeen,
+                    'ageSeconds': age,
+                    'stale': age is None or age > self.staleAfter or node.online is False,
+                    'latest': node.latest,
+                }
+                if includeHistory:
+                    entry['history'] = {
+                        'fields': ['timestampEpoc'] + ['{}.{}'.format(s, f) for s, f in HISTORY_FIELDS],
+                        'samples': list(node.history),
+                    }
+                nodes[name] = entry
+        return {
+            'timestampEpoc': now,
+            'nodeCount': len(nodes),
+            'staleCount': sum(1 for n in nodes.values() if n['stale']),
+            'nodes': nodes,
+        }
+
+
+class FleetAggregator:
+    """
+    Subscribe to every node's status and feed the FleetTable.
+    A client can be passed in (e.g., an in-process fake for testing); it needs
+    subscribe() and the on_connect/on_message callback attributes.
+    onProgress(status) is called whenever the heartbeat made the round trip.
+    """
+
+    def __init__(self, config, table=None, client=None, onProgress=None):
+        mqttConfig = config['mqtt']
+        queueConfig = mqttConfig['queue']
+        aggregatorConfig = config.get('aggregator', {})
+
+        self.queueNamespace = queueConfig['queueNamespace']
+        typeName = aggregatorConfig.get('typeName', queueConfig['typeName'])
+        self.topicDeviceStatus = self.queueNamespace + "/device/" + typeName + "/+/+/+/status"
+        self.topicNodeStatus = self.queueNamespace + "/node/+/status"
+        clientId = aggregatorConfig.get('clientId', 'nasmon-fleet')
+        self.topicHeartbeat = self.queueNamespace + "/aggregator/" + clientId + "/heartbeat"
+        self.onProgress = onProgress
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+        if table is None:
+            table = FleetTable(maxNodes=aggregatorConfig.get('maxNodes', FLEET_MAX_NODES),
+                               historySize=aggregatorConfig.get('historySize', FLEET_HISTORY_SIZE),
+                               staleAfter=aggregatorConfig.get('staleAfterSeconds', FLEET_STALE_AFTER_SECONDS))
+        self.table = table
+
+        self.ownsClient = client is None
+        if client is None:
+            client = mqtt.Client(client_id=clientId)
+            client.enable_logger(logging.getLogger('mqtt'))
+            client.reconnect_delay_set(1, 30)
+            client.username_pw_set(mqttConfig['username'], mqttConfig['password'])
+        self.client = client
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+        if self.ownsClient:
+            self.client.connect_async(mqttConfig['host'], mqttConfig['port'], 60)
+            self.client.loop_start()
+            if self.onProgress is not None:
+                self.thread = threading.Thread(target=self.heartbeatThread, name='fleetHeartbeat')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def on_connect(self, client, userdata, flags, rc):
+        logger.info("Fleet aggregator connected with result code %s", rc)
+        self.client.subscribe([(self.topicDeviceStatus, 0), (self.topicNodeStatus, 0), (self.topicHeartbeat, 0)])
+
+    def on_message(self, client, userdata, msg):
+        try:
+            self.handleMessage(msg.topic, msg.payload, time.time())
+        except Exception as e:
+            logger.error("Fleet aggregator failed on message from %s: %s", msg.topic, e)
+
+    def handleMessage(self, topic, payload, now):
+        if topic == self.topicHeartbeat:
+            if self.onProgress is not None:
+                self.onProgress("nodes: {}".format(len(self.table.nodes)))
+            return
+        parts = topic.split('/')
+        if len(parts) == 4 and parts[1] == 'node':
+            state = payload.decode('utf-8', 'ignore') if isinstance(payload, bytes) else payload
+            self.table.updateNodeState(parts[2], state == 'online')
+            return
+        if len(parts) != 7 or parts[1] != 'device':
+            return
+        _, _, typeName, location, nodeName, device, _ = parts
+        if nodeName == 'ALL':
+            # The sync queue is a command channel, not a node status
+            return
+        if len(payload) > FLEET_MAX_PAYLOAD_BYTES:
+            logger.warning("Dropping %d byte snapshot from %s", len(payload), nodeName)
+            return
+        snapshot = json.loads(payload)
+        if not isinstance(snapshot, dict):
+            return
+        self.table.updateStatus(typeName, location, nodeName, device, snapshot, now)
+
+    def heartbeatThread(self):
+        while not self.thread_stop.wait(FLEET_HEARTBEAT_SECONDS):
+            self.client.publish(self.topicHeartbeat, str(time.time()), qos=0)
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+        if self.ownsClient:
+            logger.info("Shutdown -- disconnect fleet aggregator from MQTT broker")
+            self.client.loop_stop()
+            self.client.disconnect()
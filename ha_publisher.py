@@ -0,0 +1,211 @@
+# Home Assistant REST exporter
+#
+# Pushes selected snapshot values to Home Assistant entities using
+#   POST <url>/api/states/<entity_id>
+# HA API: https://developers.home-assistant.io/docs/api/rest/
+#
+# - keep-alive connections are pooled and re-used between snapshots
+# - independent entity updates are sent concurrently (one per pooled connection)
+# - only entities whose state changed are sent (plus a periodic refresh)
+# - failed updates are retried with exponential backoff
+#
+# Config (config.yml):
+#   homeassistant:
+#     url: http://homeassistant.local:8123
+#     access_token: 'ABCDEF'
+#     entities:
+#       input_number.bnas01_enclosure_temperature: enclosure.temperature1
+#       sensor.bnas01_watts:
+#         metric: power.watts
+#         attributes:
+#           unit_of_measurement: W
+
+import logging
+import time
+import json
+import random
+import threading
+import queue
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+HA_POOL_SIZE = 4
+HA_TIMEOUT_SECONDS = 10
+HA_MAX_RETRIES = 3
+HA_BACKOFF_BASE_SECONDS = 0.5
+HA_BACKOFF_MAX_SECONDS = 10
+# Unchanged states are still re-sent this often (HA loses them on restart)
+HA_REFRESH_SECONDS = 600
+
+
+class HaConnectionPool:
+    """Pool of persistent (keep-alive) HTTP connections to one host"""
+
+    def __init__(self, url, size=HA_POOL_SIZE, timeout=HA_TIMEOUT_SECONDS):
+        parsed = urllib.parse.urlsplit(url)
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.basePath = parsed.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            if self.https:
+                return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def put(self, conn):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HaPublisher:
+
+    def __init__(self, haConfig):
+        self.poolSize = haConfig.get('poolSize', HA_POOL_SIZE)
+        self.maxRetries = haConfig.get('maxRetries', HA_MAX_RETRIES)
+        self.refreshSeconds = haConfig.get('refreshSeconds', HA_REFRESH_SECONDS)
+        self.pool = HaConnectionPool(haConfig['url'], self.poolSize,
+                                     haConfig.get('timeoutSeconds', HA_TIMEOUT_SECONDS))
+        self.headers = {
+            "Authorization": "Bearer {}".format(haConfig['access_token']),
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        }
+
+        # [(entity_id, metric path, attributes)]
+        self.entities = []
+        for entityId, entityConfig in haConfig.get('entities', {}).items():
+            if isinstance(entityConfig, str):
+                entityConfig = {'metric': entityConfig}
+            self.entities.append((entityId, entityConfig['metric'].split('.'), entityConfig.get('attributes')))
+
+        # entity_id -> (state, time sent)
+        self.lastSent = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.poolSize, thread_name_prefix='haPublish')
+
+        # Latest snapshot waiting to be sent; the sender always takes the newest one
+        self.pending = None
+        self.pendingLock = threading.Lock()
+        self.pendingEvent = threading.Event()
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        self.thread = threading.Thread(target=self.senderThread, name='haSender')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.pendingEvent.set()
+            self.thread.join()
+            self.thread = None
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    def publish(self, stats):
+        """Queue a snapshot for sending (never blocks the caller)"""
+        with self.pendingLock:
+            self.pending = stats
+        self.pendingEvent.set()
+
+    def senderThread(self):
+        while not self.thread_stop.is_set():
+            self.pendingEvent.wait()
+            self.pendingEvent.clear()
+            with self.pendingLock:
+                stats = self.pending
+                self.pending = None
+            if stats is not None and not self.thread_stop.is_set():
+                self.sendChanged(stats)
+
+    def getChanged(self, stats, now):
+        changed = []
+        for entityId, path, attributes in self.entities:
+            value = stats
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                state = 'on' if value else 'off'
+            else:
+                state = str(value)
+            last = self.lastSent.get(entityId)
+            if last is not None and last[0] == state and (now - last[1]) < self.refreshSeconds:
+                continue
+            changed.append((entityId, state, attributes))
+        return changed
+
+    def sendChanged(self, stats, now=None):
+        """Send the changed entities concurrently, returning (sent, failed)"""
+        if now is None:
+            now = time.time()
+        changed = self.getChanged(stats, now)
+        if not changed:
+            return 0, 0
+        futures = {self.executor.submit(self.postState, entityId, state, attributes): (entityId, state)
+                   for entityId, state, attributes in changed}
+        wait(futures)
+        sent = 0
+        for future, (entityId, state) in futures.items():
+            if future.result():
+                self.lastSent[entityId] = (state, now)
+                sent += 1
+        failed = len(futures) - sent
+        if failed:
+            logger.warning("Home Assistant update: %d sent, %d failed", sent, failed)
+        return sent, failed
+
+    def postState(self, entityId, state, attributes):
+        body = {'state': state}
+        if attributes:
+            body['attributes'] = attributes
+        data = json.dumps(body)
+        path = "{}/api/states/{}".format(self.pool.basePath, entityId)
+        for attempt in range(self.maxRetries + 1):
+            conn = self.pool.get()
+            try:
+                conn.request('POST', path, data, self.headers)
+                response = conn.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # The connection may be half closed by the server, never re-use it
+                conn.close()
+                logger.debug("POST %s failed (attempt %d): %s", entityId, attempt + 1, e)
+            else:
+                if response.will_close:
+                    conn.close()
+                else:
+                    self.pool.put(conn)
+                if response.status < 500:
+                    if response.status >= 400:
+                        logger.error("POST %s rejected with status %d", entityId, response.status)
+                    return response.status < 400
+                logger.debug("POST %s status %d (attempt %d)", entityId, response.status, attempt + 1)
+            if attempt < self.maxRetries:
+                backoff = min(HA_BACKOFF_BASE_SECONDS * (2 ** attempt), HA_BACKOFF_MAX_SECONDS)
+                # Random jitter (50-100% of the backoff) so the concurrent retries don't line up
+                if self.thread_stop.wait(backoff * random.uniform(0.5, 1.0)):
+                    break
+        return False
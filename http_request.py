@@ -17,30 +17,53 @@ import psutil
 import os
 from functools import partial
 import subprocess
+import urllib.parse
 from nas_stats import NasStats
+from payload_encoding import encodePayload, negotiateEncoding, getSchema, SectionCache, CONTENT_TYPES, ENCODING_JSON
+from snapshot_delta import DeltaLog, CONTENT_TYPE_MERGE_PATCH
+from static_assets import AssetCache, ENCODING_IDENTITY
 
 logger = logging.getLogger('http_request')
 
+# Encoded sections of the latest snapshot, shared by all request threads
+sectionCache = SectionCache()
+# Merge patches between the snapshots served, for ?since=<seq>
+deltaLog = DeltaLog()
+# Dashboard files (static/), read once
+assetCache = AssetCache()
+
 
 class HttpServer():
 
     PORT = 81
+    # The aggregator runs without root, it can't bind below 1024
+    AGGREGATOR_PORT = 8081
     SOCKET_TIMEOUT = 60
     THREAD_POOL_SIZE = 10
 
-    def __init__(self, _nasMon):
+    def __init__(self, _nasMon, port=None):
 
+        self.port = port if port is not None else HttpServer.PORT
         endpointsGET = { 
             "/": "status",
             "/favicon.ico": "favicon",
+            "/favicon.svg": "favicon",
             "/v1/data": "v1_data",
             "/v1/nasStats": "v1_nasStats",
+            "/v1/fleet": "v1_fleet",
+            "/v1/schema": "v1_schema",
+            "/v1/debug/memory": "v1_debug_memory",
+            "/v1/power/bursts": "v1_power_bursts",
+            "/v1/stats": "v1_stats",
+            # Prefix: /v1/stats/<metric>
+            "/v1/stats/": "v1_stats_metric",
             "/test": "test",
             "/log": "log",
             }
 
         endpointsPOST = { 
             # "/v1/lightState": "lightState"
+            "/v1/debug/memory": "v1_debug_memory",
             }
 
         socketserver.TCPServer.allow_reuse_address = True
@@ -48,10 +71,10 @@ class HttpServer():
         handler = partial(GetRequestHandler, _nasMon, endpointsGET, endpointsPOST)
 
         #self.httpd = socketserver.TCPServer(('0.0.0.0', PORT), handler)
-        self.httpd = ThreadedHTTPServer(('0.0.0.0', HttpServer.PORT), handler)
+        self.httpd = ThreadedHTTPServer(('0.0.0.0', self.port), handler)
 
     def run(self):
-        logger.info("serving at port: %d", HttpServer.PORT)
+        logger.info("serving at port: %d", self.port)
         #self.httpd.serve_forever(poll_interval=5)
         self.httpd.serve_forever()
         logger.info("after serve_forever")
@@ -81,7 +104,7 @@ class GetRequestHandler(http.server.SimpleHTTPRequestHandler):
 
     def setup(self):
         "Sets a timeout on the socket"
-        logger.info("Set timeout on the socket")
+        logger.debug("Set timeout on the socket")
         # TOOD: How does this work with keep-alive?  A keep-alive socket is getting timed out
         self.request.settimeout(HttpServer.SOCKET_TIMEOUT)
         http.server.SimpleHTTPRequestHandler.setup(self)
@@ -92,6 +115,8 @@ class GetRequestHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         pathOnly = self.path.split('?')[0]
         methodSuffix = self.endpointsGET.get(pathOnly, None)
+        if methodSuffix is None and pathOnly.startswith('/v1/stats/'):
+            methodSuffix = self.endpointsGET['/v1/stats/']
         if methodSuffix is not None:
             handlerMethodName = "get_" + methodSuffix
             handlerMethod = getattr(self, handlerMethodName)
@@ -112,7 +137,7 @@ class GetRequestHandler(http.server.SimpleHTTPRequestHandler):
 
         postDataStr = self.rfile.read(content_length).decode(encoding="utf-8")
 
-        logger.info("postDataStr: %s", postDataStr)
+        logger.debug("postDataStr: %s", postDataStr)
 
         post_data = json.loads(postDataStr)
 
@@ -150,17 +175,55 @@ class GetRequestHandler(http.server.SimpleHTTPRequestHandler):
     #     return
 
     def get_status(self):
-        # serve the file!
-        self.path = "status.html"
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        self.__send_asset("status.html")
 
     def get_favicon(self):
-        # serve the file!
-        self.path = "images/favicon.ico"
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        self.__send_asset("favicon.svg")
+
+    def __send_asset(self, name):
+        asset = assetCache.get(name)
+        if asset is None:
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        variant = asset.selectVariant(self.headers.get('Accept-Encoding'))
+
+        self.protocol_version = 'HTTP/1.1'
+        ifNoneMatch = self.headers.get('If-None-Match')
+        if ifNoneMatch is not None and (ifNoneMatch.strip() == '*' or variant.etag in
+                                        (tag.strip().replace('W/', '', 1) for tag in ifNoneMatch.split(','))):
+            self.send_response(304)
+            self.send_header('Connection', 'Keep-Alive')
+            self.send_header('ETag', variant.etag)
+            self.send_header('Cache-Control', asset.cacheControl)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        self.send_response(200, 'OK')
+        self.send_header('Connection', 'Keep-Alive')
+        self.send_header('Content-type', asset.contentType)
+        if variant.encoding != ENCODING_IDENTITY:
+            self.send_header('Content-Encoding', variant.encoding)
+        self.send_header('Content-Length', str(variant.size))
+        self.send_header('ETag', variant.etag)
+        self.send_header('Cache-Control', asset.cacheControl)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.end_headers()
+        if variant.data is not None:
+            self.wfile.write(variant.data)
+            return
+        # Large file: straight from the page cache to the socket (os.sendfile)
+        with open(asset.path, 'rb') as f:
+            sent = self.connection.sendfile(f, 0, variant.size)
+        if sent < variant.size:
+            # Truncated since it was loaded, the client can't reuse this connection
+            self.close_connection = True
 
     def get_log(self):
-        cmd = "cat /var/log/basalt_data.log.1 /var/log/basalt_data.log  2>/dev/null  | tail -n 40"
+        logFile = self.basalt.config.get('logging', {}).get('payloadLog', '/var/log/nasmon_payload.log')
+        cmd = "cat {0}.1 {0}  2>/dev/null  | tail -n 40".format(logFile)
         self.run_command(cmd)
         
     def run_command(self, cmd):
@@ -180,19 +243,191 @@ class GetRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(bytes(cmdOutput, 'utf-8'))
 
+    def get_v1_fleet(self):
+        fleet = self.basalt.fleet
+        if fleet is None:
+            # Only available in aggregator mode
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        includeHistory = 'history=0' not in self.path.partition('?')[2].split('&')
+        response = fleet.table.getFleet(includeHistory=includeHistory)
+        self.__send_json_response(response)
+        return
+
     def get_v1_nasStats(self):
+        self.__send_stats_response()
+        return
+
+    def get_v1_data(self):
+        self.__send_stats_response()
+        return
+
+    def __send_stats_response(self):
+        # ?fields=power,filesystem.data1.spaceusedpercent returns only those,
+        # ?maxAge=N (seconds) collects the requested sections if they are older,
+        # ?since=<seq> returns a merge patch from that snapshot (see snapshot_delta.py)
+        nasStats = self.basalt.nasStats
+        if nasStats is None:
+            # No local stats in aggregator mode
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        query = urllib.parse.parse_qs(self.path.partition('?')[2])
+        fields = None
+        sections = None
+        if 'fields' in query:
+            fields = [f for value in query['fields'] for f in value.split(',') if f]
+            sections = set(f.partition('.')[0] for f in fields)
+        maxAge = None
+        if 'maxAge' in query:
+            try:
+                maxAge = float(query['maxAge'][0])
+            except ValueError:
+                maxAge = -1
+            if not maxAge >= 0:
+                self.send_response(400)
+                self.addCORSHeaders()
+                self.end_headers()
+                return
+        since = None
+        if 'since' in query:
+            try:
+                since = int(query['since'][0])
+            except ValueError:
+                self.send_response(400)
+                self.addCORSHeaders()
+                self.end_headers()
+                return
+        response = nasStats.getStats(sections=sections, maxAge=maxAge)
+        encoding = negotiateEncoding(self.headers.get('Accept'))
+        if since is not None and encoding == ENCODING_JSON:
+            seq, data = deltaLog.getSince(response, since, fields)
+            if data is not None:
+                self.__send_data(data, encoding, seq, CONTENT_TYPE_MERGE_PATCH)
+                return
+        else:
+            # Binary encodings always get the full snapshot
+            seq = deltaLog.update(response)
+        if fields is None:
+            data = encodePayload(response, encoding)
+        else:
+            data = sectionCache.encodeFields(response, fields, encoding)
+        self.__send_data(data, encoding, seq)
+        return
+
+
+    def __get_rolling_stats(self):
         nasStats = self.basalt.nasStats
-        response = nasStats.getStats()
+        rollingStats = nasStats.rollingStats if nasStats is not None else None
+        if rollingStats is None:
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+        return rollingStats
+
+    def get_v1_stats(self):
+        # Names of all metrics with window statistics
+        rollingStats = self.__get_rolling_stats()
+        if rollingStats is not None:
+            self.__send_json_response(rollingStats.getMetricNames())
+        return
+
+    def get_v1_stats_metric(self):
+        # e.g., /v1/stats/filesystem.data1.temperature_current
+        rollingStats = self.__get_rolling_stats()
+        if rollingStats is None:
+            return
+        metric = urllib.parse.unquote(self.path.split('?')[0][len('/v1/stats/'):])
+        response = rollingStats.getMetric(metric, time.time())
+        if response is None:
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
         self.__send_json_response(response)
         return
 
-    def get_v1_data(self):
-        
+    def get_v1_power_bursts(self):
+        # List of the kept spin-up captures, ?id=N for the waveform of one
         nasStats = self.basalt.nasStats
-        response = nasStats.getStats()
+        burstCapture = nasStats.burstCapture if nasStats is not None else None
+        if burstCapture is None:
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        query = urllib.parse.parse_qs(self.path.partition('?')[2])
+        if 'id' not in query:
+            self.__send_json_response(burstCapture.getCaptures())
+            return
+        try:
+            response = burstCapture.getWaveform(int(query['id'][0]))
+        except ValueError:
+            response = None
+        if response is None:
+            self.send_response(404)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        self.__send_json_response(response)
+        return
+
+    def get_v1_debug_memory(self):
+        # ?reset=1 moves the diff baseline, ?limit=N
+        query = urllib.parse.parse_qs(self.path.partition('?')[2])
+        try:
+            limit = int(query.get('limit', ['20'])[0])
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            self.send_response(400)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        response = self.basalt.memoryDebug.report(limit=limit, reset=query.get('reset') == ['1'])
         self.__send_json_response(response)
         return
 
+    def post_v1_debug_memory(self, post_data):
+        # {"tracing": true} starts tracemalloc, {"tracing": false} stops it
+        tracing = post_data.get('tracing') if isinstance(post_data, dict) else None
+        if not isinstance(tracing, bool):
+            self.send_response(400)
+            self.addCORSHeaders()
+            self.end_headers()
+            return
+        memoryDebug = self.basalt.memoryDebug
+        if tracing:
+            memoryDebug.start()
+        else:
+            memoryDebug.stop()
+        self.__send_json_response({'tracing': tracing})
+        return
+
+    def get_v1_schema(self):
+        self.__send_json_response(getSchema())
+        return
+
+    def __send_data(self, data, encoding, seq=None, contentType=None):
+        # Write the response
+        self.protocol_version = 'HTTP/1.1'
+        self.send_response(200, 'OK')
+        self.send_header('Connection', 'Keep-Alive')
+        self.addCORSHeaders()
+
+        self.send_header('Content-type', contentType or CONTENT_TYPES[encoding])
+        self.send_header('Vary', 'Accept')
+        if seq is not None:
+            # For the next ?since=
+            self.send_header('X-Snapshot-Seq', str(seq))
+            self.send_header('Access-Control-Expose-Headers', 'X-Snapshot-Seq')
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        return
 
     def __send_json_response(self, responseMap):
         data = json.dumps(responseMap)
@@ -0,0 +1,297 @@
+"""
+Thin I2C transport on /dev/i2c-N
+
+Stands in for board.I2C() (Adafruit Blinka).  Importing board runs the
+platform detection and pulls in busio, Adafruit_PureIO and their
+dependencies, and every register read then goes busio -> PureIO smbus ->
+a freshly built ctypes message array.  I2CBus implements the part of the
+busio.I2C interface that the adafruit_bus_device based drivers use
+(SI7021, BME280, INA3221) directly on the i2c-dev ioctls:
+
+  - writeto_then_readfrom() is one I2C_RDWR ioctl with a write and a read
+    message (repeated start), which is every driver's register read
+  - writeto() and readfrom_into() are a single message I2C_RDWR
+  - the message structs and buffers are allocated once per bus
+
+Adapters without plain I2C transfers (I2C_FUNCS has no I2C_FUNC_I2C, e.g.
+the i2c-stub test module) get the same transactions as SMBus commands
+(quick, byte, byte data, word data, I2C block), which covers register
+reads and writes of up to 32 bytes.
+
+Like busio.I2C the bus has to be locked (try_lock/unlock) around each
+transaction, adafruit_bus_device's I2CDevice does that.
+
+The drivers still import micropython.const, which is installed with
+Adafruit-Blinka, but board and busio are not imported.
+
+Config (config.yml):
+    i2c:
+      bus: 1
+      transport: dev      # or blinka for board.I2C()
+
+Ref: https://www.kernel.org/doc/html/latest/i2c/dev-interface.html
+"""
+
+import ctypes
+import errno
+import fcntl
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUS = 1
+TRANSPORT_DEV = 'dev'
+TRANSPORT_BLINKA = 'blinka'
+
+# From <linux/i2c-dev.h> and <linux/i2c.h>
+I2C_SLAVE = 0x0703
+I2C_FUNCS = 0x0705
+I2C_RDWR = 0x0707
+I2C_SMBUS = 0x0720
+I2C_M_RD = 0x0001
+I2C_FUNC_I2C = 0x00000001
+
+I2C_SMBUS_WRITE = 0
+I2C_SMBUS_READ = 1
+I2C_SMBUS_QUICK = 0
+I2C_SMBUS_BYTE = 1
+I2C_SMBUS_BYTE_DATA = 2
+I2C_SMBUS_WORD_DATA = 3
+I2C_SMBUS_I2C_BLOCK_DATA = 8
+I2C_SMBUS_BLOCK_MAX = 32
+
+# The buffers grow when a longer transfer comes along
+INITIAL_BUFFER_SIZE = 64
+# scan() skips the reserved addresses
+SCAN_ADDRESSES = range(0x08, 0x78)
+
+
+class _I2cMsg(ctypes.Structure):
+    _fields_ = [('addr', ctypes.c_uint16),
+                ('flags', ctypes.c_uint16),
+                ('len', ctypes.c_uint16),
+                ('buf', ctypes.c_void_p)]
+
+
+class _I2cRdwrIoctlData(ctypes.Structure):
+    _fields_ = [('msgs', ctypes.c_void_p),
+                ('nmsgs', ctypes.c_uint32)]
+
+
+class _I2cSmbusData(ctypes.Union):
+    _fields_ = [('byte', ctypes.c_uint8),
+                ('word', ctypes.c_uint16),
+                # Length byte, up to 32 data bytes and a PEC byte
+                ('block', ctypes.c_uint8 * (I2C_SMBUS_BLOCK_MAX + 2))]
+
+
+class _I2cSmbusIoctlData(ctypes.Structure):
+    _fields_ = [('read_write', ctypes.c_uint8),
+                ('command', ctypes.c_uint8),
+                ('size', ctypes.c_uint32),
+                ('data', ctypes.c_void_p)]
+
+
+def _unsupported(what):
+    return OSError(errno.EOPNOTSUPP, "{} is not possible with SMBus commands".format(what))
+
+
+class I2CBus:
+
+    def __init__(self, busNumber=DEFAULT_BUS):
+        self.path = '/dev/i2c-{}'.format(busNumber)
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.lock = threading.Lock()
+
+        funcs = ctypes.c_ulong()
+        fcntl.ioctl(self.fd, I2C_FUNCS, funcs)
+        self.plainI2C = bool(funcs.value & I2C_FUNC_I2C)
+
+        self.writeBuffer = None
+        self.readBuffer = None
+        self.writeView = None
+        self.readView = None
+        self.messages = (_I2cMsg * 2)()
+        self.messages[1].flags = I2C_M_RD
+        self.rdwrRequest = _I2cRdwrIoctlData()
+        self.allocateBuffers(INITIAL_BUFFER_SIZE)
+
+        # SMBus fallback, the slave address is set with I2C_SLAVE only when it changes
+        self.address = None
+        self.smbusData = _I2cSmbusData()
+        self.smbusRequest = _I2cSmbusIoctlData(data=ctypes.addressof(self.smbusData))
+        logger.info("I2C bus %s opened (%s)", self.path, 'I2C_RDWR' if self.plainI2C else 'SMBus commands')
+
+    def allocateBuffers(self, size):
+        # bytearrays, so callers' buffers are copied with a slice assignment.
+        # The ctypes views give the kernel their address and keep them from
+        # being resized (which would move them).
+        self.writeBuffer = bytearray(size)
+        self.readBuffer = bytearray(size)
+        self.writeView = (ctypes.c_uint8 * size).from_buffer(self.writeBuffer)
+        self.readView = (ctypes.c_uint8 * size).from_buffer(self.readBuffer)
+        self.messages[0].buf = ctypes.addressof(self.writeView)
+        self.messages[1].buf = ctypes.addressof(self.readView)
+
+    # busio.I2C interface
+
+    def try_lock(self):
+        return self.lock.acquire(False)
+
+    def unlock(self):
+        self.lock.release()
+
+    def deinit(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.deinit()
+
+    def scan(self):
+        found = []
+        for address in SCAN_ADDRESSES:
+            try:
+                self.writeto(address, b'')
+            except OSError:
+                try:
+                    self.readfrom_into(address, bytearray(1))
+                except OSError:
+                    continue
+            found.append(address)
+        return found
+
+    def writeto(self, address, buffer, *, start=0, end=None, stop=True):
+        if end is None:
+            end = len(buffer)
+        self.reserve(end - start)
+        self.copyOut(buffer, start, end)
+        self.transfer(address, end - start, None)
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None, stop=True):
+        if end is None:
+            end = len(buffer)
+        self.reserve(end - start)
+        self.transfer(address, None, end - start)
+        buffer[start:end] = self.readBuffer[:end - start]
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None,
+                              in_start=0, in_end=None, stop=False):
+        if out_end is None:
+            out_end = len(buffer_out)
+        if in_end is None:
+            in_end = len(buffer_in)
+        if stop:
+            # A stop between the two: separate transactions
+            self.writeto(address, buffer_out, start=out_start, end=out_end)
+            self.readfrom_into(address, buffer_in, start=in_start, end=in_end)
+            return
+        self.reserve(max(out_end - out_start, in_end - in_start))
+        self.copyOut(buffer_out, out_start, out_end)
+        self.transfer(address, out_end - out_start, in_end - in_start)
+        buffer_in[in_start:in_end] = self.readBuffer[:in_end - in_start]
+
+    # Transfers
+
+    def reserve(self, size):
+        if size > len(self.writeBuffer):
+            self.allocateBuffers(size)
+
+    def copyOut(self, buffer, start, end):
+        self.writeBuffer[:end - start] = buffer[start:end]
+
+    def transfer(self, address, writeLength, readLength):
+        """
+        A write of writeLength bytes from writeBuffer and/or a read of
+        readLength bytes into readBuffer (None: no such message), with a
+        repeated start between the two
+        """
+        if not self.plainI2C:
+            self.smbusTransfer(address, writeLength, readLength)
+            return
+        messages = self.messages
+        first = 0 if writeLength is not None else 1
+        if writeLength is not None:
+            messages[0].addr = address
+            messages[0].len = writeLength
+        if readLength is not None:
+            messages[1].addr = address
+            messages[1].len = readLength
+        request = self.rdwrRequest
+        request.msgs = ctypes.addressof(messages) + first * ctypes.sizeof(_I2cMsg)
+        request.nmsgs = (writeLength is not None) + (readLength is not None)
+        fcntl.ioctl(self.fd, I2C_RDWR, request)
+
+    def smbusCommand(self, address, readWrite, command, size):
+        if address != self.address:
+            fcntl.ioctl(self.fd, I2C_SLAVE, address)
+            self.address = address
+        request = self.smbusRequest
+        request.read_write = readWrite
+        request.command = command
+        request.size = size
+        fcntl.ioctl(self.fd, I2C_SMBUS, request)
+
+    def smbusTransfer(self, address, writeLength, readLength):
+        data = self.smbusData
+        out = self.writeBuffer
+        if readLength is None:
+            if writeLength == 0:
+                self.smbusCommand(address, I2C_SMBUS_WRITE, 0, I2C_SMBUS_QUICK)
+            elif writeLength == 1:
+                self.smbusCommand(address, I2C_SMBUS_WRITE, out[0], I2C_SMBUS_BYTE)
+            elif writeLength == 2:
+                data.byte = out[1]
+                self.smbusCommand(address, I2C_SMBUS_WRITE, out[0], I2C_SMBUS_BYTE_DATA)
+            elif writeLength == 3:
+                # SMBus words go low byte first
+                data.word = out[1] | out[2] << 8
+                self.smbusCommand(address, I2C_SMBUS_WRITE, out[0], I2C_SMBUS_WORD_DATA)
+            elif writeLength <= I2C_SMBUS_BLOCK_MAX + 1:
+                data.block[0] = writeLength - 1
+                data.block[1:writeLength] = out[1:writeLength]
+                self.smbusCommand(address, I2C_SMBUS_WRITE, out[0], I2C_SMBUS_I2C_BLOCK_DATA)
+            else:
+                raise _unsupported("A {} byte write".format(writeLength))
+            return
+
+        if writeLength is None:
+            if readLength != 1:
+                raise _unsupported("A {} byte read without a register".format(readLength))
+            self.smbusCommand(address, I2C_SMBUS_READ, 0, I2C_SMBUS_BYTE)
+            self.readBuffer[0] = data.byte
+            return
+
+        if writeLength != 1:
+            raise _unsupported("A read after a {} byte write".format(writeLength))
+        register = out[0]
+        if readLength == 1:
+            self.smbusCommand(address, I2C_SMBUS_READ, register, I2C_SMBUS_BYTE_DATA)
+            self.readBuffer[0] = data.byte
+        elif readLength == 2:
+            self.smbusCommand(address, I2C_SMBUS_READ, register, I2C_SMBUS_WORD_DATA)
+            word = data.word
+            self.readBuffer[0] = word & 0xff
+            self.readBuffer[1] = word >> 8
+        elif readLength <= I2C_SMBUS_BLOCK_MAX:
+            data.block[0] = readLength
+            self.smbusCommand(address, I2C_SMBUS_READ, register, I2C_SMBUS_I2C_BLOCK_DATA)
+            self.readBuffer[:readLength] = data.block[1:readLength + 1]
+        else:
+            raise _unsupported("A {} byte register read".format(readLength))
+
+
+def openBus(busNumber=DEFAULT_BUS, transport=TRANSPORT_DEV):
+    """The I2C bus for the sensor drivers"""
+    if transport == TRANSPORT_BLINKA:
+        # Only imported when asked for, it takes a while
+        import board
+        return board.I2C()
+    return I2CBus(busNumber)
@@ -0,0 +1,274 @@
+"""
+Burst capture of drive spin-up transients on the INA3221
+
+The INA3221 normally runs with 128 sample averaging and 8 ms conversions
+(~6 sec for a full reading of the 3 channels), which is good for steady
+state power but hides the few seconds of high current when a USB drive
+spins up.  When a spin-up is likely to start, the chip is switched to
+single-sample 332 us conversions and the drive channels (2 and 3) are read
+back-to-back for a few seconds into preallocated buffers, then the previous
+configuration is restored.
+
+A capture is triggered by:
+  - a drive waking up: I/O in flight after the drive had been idle for
+    idleSeconds (read from /sys/block/<kname>/stat every 100 ms)
+  - a current step on a drive channel seen by the power collector
+
+Per drive the number of spin-ups, last/max peak current and the energy of
+the last spin-up are published in the 'spinup' section.  The last few
+waveforms are kept for /v1/power/bursts.
+
+Config (config.yml):
+    burstCapture:
+      enabled: true
+      seconds: 4
+      stepAmps: 0.3
+      idleSeconds: 300
+      drives:
+        drive1: sda
+        drive2: sdb
+"""
+
+import array
+import logging
+import threading
+import time
+
+from barbudor_ina3221.full import (C_REG_CONFIG, C_AVERAGING_MASK, C_VBUS_CONV_TIME_MASK,
+                                   C_SHUNT_CONV_TIME_MASK, C_MODE_MASK, C_AVERAGING_NONE,
+                                   C_VBUS_CONV_TIME_332US, C_SHUNT_CONV_TIME_332US,
+                                   C_MODE_SHUNT_AND_BUS_CONTINOUS)
+
+from smart_scheduler import readBlockStat
+
+logger = logging.getLogger(__name__)
+
+
+CONFIG_MASK = C_AVERAGING_MASK | C_VBUS_CONV_TIME_MASK | C_SHUNT_CONV_TIME_MASK | C_MODE_MASK
+BURST_CONFIG = C_AVERAGING_NONE | C_VBUS_CONV_TIME_332US | C_SHUNT_CONV_TIME_332US | C_MODE_SHUNT_AND_BUS_CONTINOUS
+
+# Drive name -> INA3221 channel
+DRIVE_CHANNELS = (('drive1', 2), ('drive2', 3))
+
+DEFAULT_BURST_SECONDS = 4
+# ~1 ms per sample of both channels (4 I2C reads)
+DEFAULT_MAX_SAMPLES = 8000
+DEFAULT_KEEP_CAPTURES = 4
+DEFAULT_STEP_AMPS = 0.3
+DEFAULT_IDLE_SECONDS = 300
+WAKE_POLL_SECONDS = 0.1
+# Ignore triggers for this long after a capture (one spin-up, one capture)
+BURST_COOLDOWN_SECONDS = 30
+
+
+class BurstBuffer:
+    """One capture, allocated once and reused"""
+
+    def __init__(self, maxSamples):
+        self.maxSamples = maxSamples
+        self.times = array.array('d', bytes(8 * maxSamples))
+        self.currents = {drive: array.array('f', bytes(4 * maxSamples)) for drive, channel in DRIVE_CHANNELS}
+        self.voltages = {drive: array.array('f', bytes(4 * maxSamples)) for drive, channel in DRIVE_CHANNELS}
+        self.id = None
+        self.timestampEpoc = None
+        self.trigger = None
+        self.count = 0
+        self.summary = {}
+
+    def getSummary(self):
+        return {
+            'id': self.id,
+            'timestampEpoc': self.timestampEpoc,
+            'trigger': self.trigger,
+            'samples': self.count,
+            'seconds': round(self.times[self.count - 1], 3) if self.count else 0,
+            'drives': self.summary,
+        }
+
+    def getWaveform(self):
+        count = self.count
+        result = self.getSummary()
+        result['t'] = [round(t, 5) for t in self.times[:count]]
+        for drive, channel in DRIVE_CHANNELS:
+            result[drive + '_current'] = [round(i, 4) for i in self.currents[drive][:count]]
+            result[drive + '_bus_voltage'] = [round(v, 3) for v in self.voltages[drive][:count]]
+        return result
+
+
+class BurstCapture:
+
+    def __init__(self, burstConfig, sensor, sensorLock):
+        self.sensor = sensor
+        # Shared with the power collector, a capture holds it for its duration
+        self.sensorLock = sensorLock
+        self.seconds = burstConfig.get('seconds', DEFAULT_BURST_SECONDS)
+        self.stepAmps = burstConfig.get('stepAmps', DEFAULT_STEP_AMPS)
+        self.idleSeconds = burstConfig.get('idleSeconds', DEFAULT_IDLE_SECONDS)
+        # drive name -> kname, for the wake trigger
+        self.drives = burstConfig.get('drives', {})
+        maxSamples = burstConfig.get('maxSamples', DEFAULT_MAX_SAMPLES)
+        self.buffers = [BurstBuffer(maxSamples) for x in range(burstConfig.get('keep', DEFAULT_KEEP_CAPTURES))]
+        self.nextBuffer = 0
+        self.nextId = 1
+
+        self.lock = threading.Lock()
+        # Averaged current per drive from the power collector
+        self.baseline = {}
+        self.driveStats = {drive: {'spinups': 0, 'lastPeakCurrent': None, 'lastEnergy': None,
+                                   'lastSpinupEpoc': None, 'maxPeakCurrent': None}
+                           for drive, channel in DRIVE_CHANNELS}
+        # kname -> (io_ticks, monotonic time they last changed)
+        self.lastIo = {}
+        self.cooldownUntil = 0
+        self.pendingTrigger = None
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        self.thread = threading.Thread(target=self.burstThread, name='inaBurst')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+
+    def trigger(self, reason):
+        if time.monotonic() < self.cooldownUntil:
+            return
+        self.pendingTrigger = reason
+        self.wakeup.set()
+
+    def noteCurrents(self, currents, now):
+        """Averaged drive currents from the power collector ({drive: amps})"""
+        for drive, current in currents.items():
+            baseline = self.baseline.get(drive)
+            self.baseline[drive] = current
+            if baseline is not None and current - baseline >= self.stepAmps:
+                self.trigger('current_step:' + drive)
+
+    def checkWake(self, monotonicNow):
+        """Trigger on I/O to a drive that had been idle long enough to be spun down"""
+        for drive, kname in self.drives.items():
+            blockStat = readBlockStat(kname)
+            if blockStat is None:
+                continue
+            inFlight, ioTicks = blockStat
+            last = self.lastIo.get(kname)
+            if last is None:
+                self.lastIo[kname] = (ioTicks, monotonicNow)
+                continue
+            lastTicks, idleSince = last
+            if inFlight == 0 and ioTicks == lastTicks:
+                continue
+            self.lastIo[kname] = (ioTicks, monotonicNow)
+            if monotonicNow - idleSince >= self.idleSeconds:
+                self.trigger('wake:' + drive)
+
+    def burstThread(self):
+        while not self.thread_stop.is_set():
+            if self.wakeup.wait(WAKE_POLL_SECONDS):
+                self.wakeup.clear()
+            if self.thread_stop.is_set():
+                break
+            if self.pendingTrigger is None:
+                self.checkWake(time.monotonic())
+            if self.pendingTrigger is not None:
+                reason = self.pendingTrigger
+                self.pendingTrigger = None
+                try:
+                    self.capture(reason)
+                except Exception as e:
+                    logger.error("Burst capture failed: %s", e)
+                self.cooldownUntil = time.monotonic() + BURST_COOLDOWN_SECONDS
+        logger.info('inaBurst thread EXITING')
+
+    def capture(self, reason):
+        buffer = self.buffers[self.nextBuffer]
+        with self.lock:
+            # Not served over HTTP while it is being overwritten
+            buffer.id = None
+        sensor = self.sensor
+        times = buffer.times
+        channels = [(channel, buffer.currents[drive], buffer.voltages[drive]) for drive, channel in DRIVE_CHANNELS]
+        count = 0
+        with self.sensorLock:
+            previousConfig = sensor.read(C_REG_CONFIG)
+            sensor.update(reg=C_REG_CONFIG, mask=CONFIG_MASK, value=BURST_CONFIG)
+            try:
+                begin = time.monotonic()
+                end = begin + self.seconds
+                while count < buffer.maxSamples:
+                    now = time.monotonic()
+                    if now >= end:
+                        break
+                    times[count] = now - begin
+                    for channel, currents, voltages in channels:
+                        currents[count] = sensor.current(channel)
+                        voltages[count] = sensor.bus_voltage(channel)
+                    count += 1
+            finally:
+                # Back to the averaging the power collector expects
+                sensor.update(reg=C_REG_CONFIG, mask=CONFIG_MASK, value=previousConfig)
+
+        now = time.time()
+        summary = {}
+        with self.lock:
+            buffer.id = self.nextId
+            buffer.timestampEpoc = now
+            buffer.trigger = reason
+            buffer.count = count
+            self.nextId += 1
+            self.nextBuffer = (self.nextBuffer + 1) % len(self.buffers)
+            for drive, channel in DRIVE_CHANNELS:
+                peak, energy = self.analyze(times, buffer.currents[drive], buffer.voltages[drive], count)
+                summary[drive] = {'peakCurrent': round(peak, 3), 'energy': round(energy, 3)}
+                baseline = self.baseline.get(drive, 0)
+                if peak - baseline >= self.stepAmps:
+                    stats = self.driveStats[drive]
+                    stats['spinups'] += 1
+                    stats['lastPeakCurrent'] = round(peak, 3)
+                    stats['lastEnergy'] = round(energy, 3)
+                    stats['lastSpinupEpoc'] = now
+                    if stats['maxPeakCurrent'] is None or peak > stats['maxPeakCurrent']:
+                        stats['maxPeakCurrent'] = round(peak, 3)
+            buffer.summary = summary
+        logger.info("Burst capture %d (%s): %d samples %s", buffer.id, reason, count, summary)
+
+    @staticmethod
+    def analyze(times, currents, voltages, count):
+        """Peak current (A) and energy (J) of a capture"""
+        if count == 0:
+            return 0.0, 0.0
+        peak = max(currents[:count])
+        energy = 0.0
+        for i in range(1, count):
+            energy += currents[i] * voltages[i] * (times[i] - times[i - 1])
+        return peak, energy
+
+    def getStats(self):
+        with self.lock:
+            return {drive: dict(stats) for drive, stats in self.driveStats.items()}
+
+    def restoreStats(self, saved):
+        """Continue the spin-up counters of a previous run"""
+        with self.lock:
+            for drive, stats in self.driveStats.items():
+                stats.update((saved or {}).get(drive, {}))
+
+    def getCaptures(self):
+        with self.lock:
+            captures = [b.getSummary() for b in self.buffers if b.id is not None]
+        return sorted(captures, key=lambda c: c['id'], reverse=True)
+
+    def getWaveform(self, captureId):
+        with self.lock:
+            for buffer in self.buffers:
+                if buffer.id == captureId:
+                    return buffer.getWaveform()
+        return None
@@ -0,0 +1,315 @@
+# InfluxDB exporter
+#
+# Turns every snapshot into line-protocol points and writes them to InfluxDB
+# in batches (one gzip compressed HTTP write per batch).
+#
+# Line protocol: https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/
+#
+# Numeric fields are all floats, booleans are booleans, anything else is skipped.
+#
+# Points written (all tagged with node=<hostname>):
+#   nas_os                             cpuPercent, cpuTemperature, ...
+#   nas_enclosure                      temperature1, humidity1, ...
+#   nas_sampling                       os, enclosure, power, filesystem (interval seconds)
+#   nas_power,channel=rpi|drive1|drive2  psu_voltage, current, bus_voltage
+#   nas_power_total                    watts
+#   nas_filesystem,label=<label>       spaceused, read_bytes, temperature_current, ...
+#   nas_nfs                            threads, calls_per_sec, read_bytes_per_sec, ...
+#   nas_nfs_ops                        read, write, getattr, ... (per second)
+#   nas_smb                            sessions, users, machines, open_files
+#   nas_smb_share,share=<name>         connections
+#   nas_cgroup,kind=services|containers,name=<name>  cpu_percent, memory_bytes, ...
+#
+# Config (config.yml):
+#   influxdb:
+#     url: http://influxdb.local:8086
+#     # InfluxDB 2.x
+#     org: home
+#     bucket: nas
+#     token: 'ABCDEF'
+#     # or InfluxDB 1.x
+#     # database: nas
+
+import logging
+import math
+import time
+import os
+import gzip
+import threading
+import http.client
+import urllib.parse
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+# A batch is sent when it reaches this size ...
+INFLUX_BATCH_BYTES = 64 * 1024
+# ... or when its oldest point is this old (unless failed batches are waiting for a retry)
+INFLUX_FLUSH_SECONDS = 10
+# Failed batches kept for retry (oldest dropped first)
+INFLUX_MAX_RETRY_BATCHES = 120
+# Backoff between attempts while InfluxDB is failing, doubled up to the max
+INFLUX_BACKOFF_BASE_SECONDS = 2
+INFLUX_BACKOFF_MAX_SECONDS = 300
+INFLUX_TIMEOUT_SECONDS = 10
+
+# Sections written as one point each, with their numeric fields
+FLAT_SECTIONS = (
+    ('os', 'nas_os'),
+    ('enclosure', 'nas_enclosure'),
+    ('sampling', 'nas_sampling'),
+)
+POWER_CHANNELS = ('rpi', 'drive1', 'drive2')
+POWER_FIELDS = ('psu_voltage', 'current', 'bus_voltage')
+
+_TAG_ESCAPES = str.maketrans({',': '\\,', '=': '\\=', ' ': '\\ '})
+
+
+def escapeTag(value):
+    return str(value).translate(_TAG_ESCAPES)
+
+
+def formatFieldValue(value):
+    """Line protocol field value, or None for values that can't be written"""
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    # Every number is written as a float: a field type is fixed per shard, and
+    # the same value comes as an int or a float (5 vs 5.5, round() of an int)
+    if isinstance(value, (int, float)):
+        value = float(value)
+        # nan and inf are not valid line protocol
+        if not math.isfinite(value):
+            return None
+        return repr(value)
+    return None
+
+
+def appendFields(out, fields):
+    """Append 'k=v,k=v' for the writable values of fields, returning False if there were none"""
+    first = True
+    for key, value in fields:
+        formatted = formatFieldValue(value)
+        if formatted is None:
+            continue
+        if not first:
+            out.append(',')
+        out.append(escapeTag(key))
+        out.append('=')
+        out.append(formatted)
+        first = False
+    return not first
+
+
+def appendPoint(lines, measurementAndTags, fields, timestamp):
+    out = [measurementAndTags, ' ']
+    if appendFields(out, fields):
+        out.append(' ')
+        out.append(timestamp)
+        out.append('\n')
+        lines.append(''.join(out))
+
+
+def snapshotToLines(stats, nodeTag):
+    """
+    Serialize a snapshot straight into line-protocol strings, reading the
+    snapshot in place (no intermediate point dicts).
+    """
+    lines = []
+    timestampEpoc = stats.get('timestampEpoc')
+    if timestampEpoc is None:
+        return lines
+    timestamp = str(int(timestampEpoc * 1e9))
+    tags = ',node=' + nodeTag
+
+    for section, measurement in FLAT_SECTIONS:
+        values = stats.get(section)
+        if values:
+            appendPoint(lines, measurement + tags, values.items(), timestamp)
+
+    power = stats.get('power')
+    if power:
+        for channel in POWER_CHANNELS:
+            appendPoint(lines, 'nas_power' + tags + ',channel=' + channel,
+                        ((field, power.get(channel + '_' + field)) for field in POWER_FIELDS), timestamp)
+        appendPoint(lines, 'nas_power_total' + tags, (('watts', power.get('watts')),), timestamp)
+
+    for label, filesystem in (stats.get('filesystem') or {}).items():
+        appendPoint(lines, 'nas_filesystem' + tags + ',label=' + escapeTag(label),
+                    filesystem.items(), timestamp)
+
+    services = stats.get('services') or {}
+    nfs = services.get('nfs')
+    if nfs:
+        appendPoint(lines, 'nas_nfs' + tags, nfs.items(), timestamp)
+        if nfs.get('ops'):
+            appendPoint(lines, 'nas_nfs_ops' + tags, nfs['ops'].items(), timestamp)
+    smb = services.get('smb')
+    if smb:
+        appendPoint(lines, 'nas_smb' + tags, smb.items(), timestamp)
+        for share, connections in (smb.get('shares') or {}).items():
+            appendPoint(lines, 'nas_smb_share' + tags + ',share=' + escapeTag(share),
+                        (('connections', connections),), timestamp)
+
+    for kind, cgroups in (stats.get('cgroups') or {}).items():
+        for name, values in cgroups.items():
+            appendPoint(lines, 'nas_cgroup' + tags + ',kind=' + kind + ',name=' + escapeTag(name),
+                        values.items(), timestamp)
+    return lines
+
+
+class InfluxExporter:
+
+    def __init__(self, influxConfig, nodeName=None):
+        if nodeName is None:
+            nodeName = os.uname().nodename.partition('.')[0]
+        self.nodeTag = escapeTag(nodeName)
+        self.batchBytes = influxConfig.get('batchBytes', INFLUX_BATCH_BYTES)
+        self.flushSeconds = influxConfig.get('flushSeconds', INFLUX_FLUSH_SECONDS)
+
+        parsed = urllib.parse.urlsplit(influxConfig['url'])
+        self.https = parsed.scheme == 'https'
+        self.host = parsed.hostname
+        self.port = parsed.port
+        basePath = parsed.path.rstrip('/')
+        self.headers = {
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Content-Encoding': 'gzip',
+        }
+        if 'bucket' in influxConfig:
+            query = urllib.parse.urlencode({'org': influxConfig.get('org', ''),
+                                            'bucket': influxConfig['bucket'], 'precision': 'ns'})
+            self.writePath = basePath + '/api/v2/write?' + query
+            if 'token' in influxConfig:
+                self.headers['Authorization'] = 'Token ' + influxConfig['token']
+        else:
+            params = {'db': influxConfig['database'], 'precision': 'ns'}
+            if 'username' in influxConfig:
+                params['u'] = influxConfig['username']
+                params['p'] = influxConfig.get('password', '')
+            self.writePath = basePath + '/write?' + urllib.parse.urlencode(params)
+
+        self.conn = None
+        self.lock = threading.Lock()
+        # Lines waiting to be batched
+        self.buffer = []
+        self.bufferBytes = 0
+        self.bufferTime = None
+        # Compressed batches that failed to send
+        self.retryBatches = deque(maxlen=influxConfig.get('maxRetryBatches', INFLUX_MAX_RETRY_BATCHES))
+        self.droppedBatches = 0
+        # Consecutive failed writes, and when the next attempt is due
+        self.failures = 0
+        self.retryTime = 0
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        self.thread = threading.Thread(target=self.senderThread, name='influx')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+        # Last attempt for whatever is buffered
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+
+    def publish(self, stats):
+        lines = snapshotToLines(stats, self.nodeTag)
+        size = sum(len(line) for line in lines)
+        with self.lock:
+            if not self.buffer:
+                self.bufferTime = time.monotonic()
+            self.buffer.extend(lines)
+            self.bufferBytes += size
+            full = self.bufferBytes >= self.batchBytes
+        if full:
+            self.wakeup.set()
+
+    def senderThread(self):
+        while not self.thread_stop.is_set():
+            self.wakeup.wait(1.0)
+            self.wakeup.clear()
+            # While failed batches are queued the points only go into full
+            # sized batches, so the retry buffer covers as much time as it can
+            with self.lock:
+                due = self.buffer and (self.bufferBytes >= self.batchBytes or
+                                       (not self.retryBatches and
+                                        (time.monotonic() - self.bufferTime) >= self.flushSeconds))
+            if due:
+                self.queueBatch()
+            # After a failure nothing is sent until the backoff has passed
+            if self.retryBatches and time.monotonic() >= self.retryTime:
+                self.sendBatches()
+
+    def takeBatch(self):
+        with self.lock:
+            if not self.buffer:
+                return None
+            data = ''.join(self.buffer).encode('utf-8')
+            self.buffer = []
+            self.bufferBytes = 0
+            self.bufferTime = None
+        return gzip.compress(data, compresslevel=6)
+
+    def queueBatch(self):
+        batch = self.takeBatch()
+        if batch is None:
+            return
+        if len(self.retryBatches) == self.retryBatches.maxlen:
+            self.droppedBatches += 1
+            logger.warning("InfluxDB retry buffer full, dropped oldest batch (%d dropped total)", self.droppedBatches)
+        self.retryBatches.append(batch)
+
+    def sendBatches(self):
+        """Send the queued batches oldest first, so points arrive in order; stop at the first failure"""
+        while self.retryBatches:
+            if not self.writeBatch(self.retryBatches[0]):
+                backoff = min(INFLUX_BACKOFF_BASE_SECONDS * (2 ** self.failures), INFLUX_BACKOFF_MAX_SECONDS)
+                self.failures += 1
+                self.retryTime = time.monotonic() + backoff
+                logger.info("InfluxDB retry in %d sec, %d batches queued", backoff, len(self.retryBatches))
+                return False
+            self.retryBatches.popleft()
+        self.failures = 0
+        return True
+
+    def flush(self):
+        self.queueBatch()
+        return self.sendBatches()
+
+    def writeBatch(self, batch):
+        if self.conn is None:
+            if self.https:
+                self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=INFLUX_TIMEOUT_SECONDS)
+            else:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=INFLUX_TIMEOUT_SECONDS)
+        try:
+            self.conn.request('POST', self.writePath, batch, self.headers)
+            response = self.conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            logger.error("InfluxDB write failed: %s", e)
+            self.conn.close()
+            self.conn = None
+            return False
+        if response.will_close:
+            self.conn.close()
+            self.conn = None
+        if response.status >= 500 or response.status == 429:
+            logger.error("InfluxDB write status %d, will retry", response.status)
+            return False
+        if response.status >= 400:
+            # Bad data will never be accepted, don't keep it
+            logger.error("InfluxDB rejected batch with status %d: %s", response.status, body[:200])
+        return True
@@ -0,0 +1,187 @@
+# Non-blocking logging
+#
+# The collection, MQTT and HTTP threads only put log records on a queue; a
+# single writer thread (QueueListener) formats them and writes them out.
+# Writes to the SD card are batched: the buffered handlers flush when enough
+# records are pending, after a time interval (also when no new record comes
+# in), or right away for errors.
+#
+# Docs: https://docs.python.org/3/library/logging.handlers.html#queuehandler
+
+import logging
+import logging.handlers
+import time
+import queue
+import threading
+
+
+# Records buffered before a write is forced
+LOG_BATCH_SIZE = 50
+# Maximum time a record waits in the buffer
+LOG_FLUSH_INTERVAL_SECONDS = 5
+# Rate limit window for RateLimitFilter
+RATE_LIMIT_INTERVAL_SECONDS = 60
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that does not format the record on the calling thread.
+    The stock prepare() merges msg and args (i.e., formats the payload) before
+    enqueueing; since the queue never leaves this process we hand the record
+    over as-is and let the writer thread do the formatting.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BatchingHandler(logging.handlers.MemoryHandler):
+    """
+    Buffer records for a target handler and flush them in batches: when the
+    buffer is full, when the oldest record is older than flushInterval or when
+    a record at flushLevel (or above) arrives.
+    """
+
+    def __init__(self, target, capacity=LOG_BATCH_SIZE, flushInterval=LOG_FLUSH_INTERVAL_SECONDS,
+                 flushLevel=logging.ERROR):
+        super().__init__(capacity, flushLevel=flushLevel, target=target)
+        self.flushInterval = flushInterval
+        self.firstBufferedTime = None
+
+    def shouldFlush(self, record):
+        if self.firstBufferedTime is None:
+            self.firstBufferedTime = time.monotonic()
+        return (super().shouldFlush(record) or
+                (time.monotonic() - self.firstBufferedTime) >= self.flushInterval)
+
+    def secondsUntilFlush(self, now):
+        """Time left before the buffer is due, None if it is empty"""
+        if self.firstBufferedTime is None:
+            return None
+        return max(0.0, self.firstBufferedTime + self.flushInterval - now)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.target is not None and self.buffer:
+                if isinstance(self.target, logging.StreamHandler):
+                    self.writeBatch(self.buffer)
+                else:
+                    for record in self.buffer:
+                        self.target.handle(record)
+                self.buffer.clear()
+            self.firstBufferedTime = None
+        finally:
+            self.release()
+
+    def writeBatch(self, records):
+        """Format the records and write them to the target stream with one write and one flush"""
+        target = self.target
+        target.acquire()
+        try:
+            lines = []
+            for record in records:
+                if record.levelno < target.level or not target.filter(record):
+                    continue
+                try:
+                    if isinstance(target, logging.handlers.BaseRotatingHandler) and target.shouldRollover(record):
+                        # Pending lines belong to the old file
+                        target.stream.write(''.join(lines))
+                        lines = []
+                        target.doRollover()
+                    lines.append(target.format(record) + target.terminator)
+                except Exception:
+                    target.handleError(record)
+            if lines:
+                target.stream.write(''.join(lines))
+            target.stream.flush()
+        finally:
+            target.release()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that also flushes the BatchingHandlers when their interval
+    has passed and no new record arrives: the wait for the next record times
+    out when the first buffer is due.
+    """
+
+    def dequeue(self, block):
+        while True:
+            timeout = self.secondsUntilFlush() if block else None
+            try:
+                return self.queue.get(block, timeout)
+            except queue.Empty:
+                if not block:
+                    raise
+            self.flushDue()
+
+    def batchingHandlers(self):
+        return [handler for handler in self.handlers if isinstance(handler, BatchingHandler)]
+
+    def secondsUntilFlush(self):
+        now = time.monotonic()
+        due = [seconds for seconds in (handler.secondsUntilFlush(now) for handler in self.batchingHandlers())
+               if seconds is not None]
+        return min(due) if due else None
+
+    def flushDue(self):
+        now = time.monotonic()
+        for handler in self.batchingHandlers():
+            if handler.secondsUntilFlush(now) == 0:
+                handler.flush()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per-logger rate limiting.  Each logger listed in limits may emit at most
+    limit records per interval; beyond that only every sampleEvery-th record is
+    let through.  The number of suppressed records is reported on the next
+    record that passes.  WARNING and above are never limited.
+    """
+
+    def __init__(self, limits, interval=RATE_LIMIT_INTERVAL_SECONDS, sampleEvery=0):
+        super().__init__()
+        self.limits = limits
+        self.interval = interval
+        self.sampleEvery = sampleEvery
+        # logger name -> [window start, count, suppressed]
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        limit = self.limits.get(record.name)
+        if limit is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(record.name)
+            if window is None or (now - window[0]) >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                window = [now, 0, 0]
+                self.windows[record.name] = window
+                if suppressed:
+                    record.msg = "(" + str(suppressed) + " messages suppressed) " + str(record.msg)
+            window[1] += 1
+            if window[1] <= limit:
+                return True
+            if self.sampleEvery and (window[1] - limit) % self.sampleEvery == 0:
+                return True
+            window[2] += 1
+            return False
+
+
+def startQueueLogging(handlers, rateLimits=None, sampleEvery=0):
+    """
+    Route all records through a queue to a writer thread feeding handlers.
+    Returns (queueHandler, listener); stop the listener on shutdown to flush.
+    """
+    logQueue = queue.SimpleQueue()
+    queueHandler = LazyQueueHandler(logQueue)
+    if rateLimits:
+        queueHandler.addFilter(RateLimitFilter(rateLimits, sampleEvery=sampleEvery))
+    listener = BatchingQueueListener(logQueue, *handlers, respect_handler_level=True)
+    listener.start()
+    return queueHandler, listener
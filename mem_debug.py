@@ -0,0 +1,89 @@
+"""
+Memory instrumentation for /v1/debug/memory
+
+Uses tracemalloc snapshots to show which source lines allocate the most
+and how that changed since the previous report (or since the baseline).
+Tracing costs memory and CPU, so it is off unless debug.tracemalloc is set
+in config.yml or it is switched on with a POST of {"tracing": true} to
+/v1/debug/memory.
+
+Docs: https://docs.python.org/3/library/tracemalloc.html
+"""
+
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+TRACEMALLOC_FRAMES = 1
+DEFAULT_TOP_LIMIT = 20
+
+
+def getRss():
+    """Resident set size in bytes from /proc/self/statm"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryDebug:
+
+    def __init__(self, enabled=False):
+        self.lock = threading.Lock()
+        self.previous = None
+        self.previousTime = None
+        if enabled:
+            self.start()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            logger.info("Starting tracemalloc")
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.previous = None
+            self.previousTime = None
+
+    def takeSnapshot(self):
+        # Leave out the allocations made by tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def report(self, limit=DEFAULT_TOP_LIMIT, reset=False):
+        now = time.time()
+        result = {
+            'timestampEpoc': now,
+            'rss': getRss(),
+            'tracing': tracemalloc.is_tracing(),
+        }
+        if not tracemalloc.is_tracing():
+            return result
+
+        current, peak = tracemalloc.get_traced_memory()
+        result['traced'] = current
+        result['tracedPeak'] = peak
+
+        with self.lock:
+            snapshot = self.takeSnapshot()
+            result['top'] = [{'location': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                             for stat in snapshot.statistics('lineno')[:limit]]
+            if self.previous is not None:
+                result['diffSinceSeconds'] = round(now - self.previousTime, 1)
+                result['diff'] = [{'location': str(stat.traceback), 'sizeDiff': stat.size_diff,
+                                   'size': stat.size, 'countDiff': stat.count_diff}
+                                  for stat in snapshot.compare_to(self.previous, 'lineno')[:limit]]
+            # Keep the first snapshot as baseline unless asked to move it forward
+            if self.previous is None or reset:
+                self.previous = snapshot
+                self.previousTime = now
+        return result
@@ -23,25 +23,66 @@ sudo i2cdetect -y 1
 
 import logging
 import time
-import datetime
-import pytz
 import threading
 import sys
 import subprocess
 import json
+import types
 
 import psutil
 import os
 
-import board
 import adafruit_si7021
 import adafruit_bme280
 from barbudor_ina3221.full import *
 
+from smart_scheduler import SmartScheduler, SMART_MIN_INTERVAL_SECONDS, SMART_MAX_STALENESS_SECONDS, SMARTCTL_STANDBY_EXIT_CODE, STATE_ACTIVE
+from SMART import SMART, FULL_SMART_INTERVAL_SECONDS
+from dir_index import DirIndex
+from alerts import AlertEngine
+from pi_throttle import ThrottleMonitor
+from ina_burst import BurstCapture
+from rolling_stats import RollingStats
+from collector import CollectorSet
+from adaptive_rate import AdaptiveRate
+from uevent_listener import UeventListener
+from services_stats import ServicesMonitor
+from cgroup_stats import CgroupMonitor
+from i2c_transport import openBus, DEFAULT_BUS, TRANSPORT_DEV
+from snapshot import Snapshot, OsStats, EnclosureStats, PowerStats, FilesystemStats, formatTimestamp
+
 logger = logging.getLogger(__name__)
 
 
 MAX_CACHE_TIME_SECONDS = 10
+# Upper bound for the stats thread sleep, even if no collector is due sooner
+STATS_MAX_WAIT_SECONDS = 30
+# Shutdown does not wait longer than this for a collection in progress
+STATS_THREAD_JOIN_SECONDS = 5
+
+# Warm restart state (collectors.stateFile)
+STATE_FILE_VERSION = 1
+# An older state is not restored, the counters and rates would not continue anyway
+STATE_MAX_AGE_SECONDS = 900
+DISK_IO_FIELDS = ('read_count', 'write_count', 'read_bytes', 'write_bytes', 'read_time', 'write_time')
+
+# With the uevent listener running, lsblk is only run for this long after a
+# block device event (labels and mounts settle after the kernel event) ...
+INVENTORY_SETTLE_SECONDS = 60
+# ... and at least this often, mounting a filesystem sends no block uevent
+INVENTORY_MAX_AGE_SECONDS = 300
+
+# Default sampling of each collector: (minSeconds, maxSeconds, metrics watched for changes)
+# Override in config.yml under collectors.sampling.<name>
+SAMPLING_DEFAULTS = {
+    'os': (10, 30, ('cpuTemperature', 'memoryUsedPercent')),
+    'enclosure': (10, 30, ('temperature1', 'humidity1', 'temperature2', 'humidity2')),
+    # A power sample takes ~6 sec (128 sample averaging on 3 channels)
+    'power': (5, 30, ('rpi_current', 'drive1_current', 'drive2_current', 'rpi_psu_voltage')),
+    'filesystem': (30, 300, ('spaceusedpercent', 'temperature_current')),
+    'services': (10, 60, ('calls_per_sec', 'read_bytes_per_sec', 'write_bytes_per_sec', 'sessions')),
+    'cgroups': (10, 60, ('cpu_percent', 'memory_bytes')),
+}
 
 # Ref: http://theorangeduck.com/page/synchronized-python
 def synchronized_method(method):
@@ -68,11 +109,84 @@ class NasStats:
         self.tempHumSensor1 = None
         self.tempHumSensor2 = None
         self.voltCurrentSensor = None
+        self.i2cBus = None
 
         self.stats_cache = None
         self.stats_cache_timestamp = 0
         self.filesystemDict_cache = {}
+        self.diskIoCounters_cache = {}
         self.deviceSupportsSmart = {}
+        # Mounted filesystems from lsblk, relisted when a block device uevent says it changed
+        self.mountedFilesystems = None
+        self.mountedFilesystemsTime = 0
+        self.inventoryDirtyUntil = 0
+        # Device names (sdb, sdb1) with a uevent since the last filesystem collection,
+        # None when events were lost
+        self.changedDevices = set()
+        self.deviceLock = threading.Lock()
+        self.ueventListener = UeventListener(self.handleUevent)
+
+        smartConfig = {}
+        sharesConfig = {}
+        servicesConfig = {}
+        cgroupsConfig = {}
+        alertsConfig = []
+        if self.nasMon is not None:
+            smartConfig = self.nasMon.config.get('smart', {})
+            sharesConfig = self.nasMon.config.get('shares', {})
+            servicesConfig = self.nasMon.config.get('services', {})
+            cgroupsConfig = self.nasMon.config.get('cgroups', {})
+            alertsConfig = self.nasMon.config.get('alerts', [])
+        self.smartScheduler = SmartScheduler(
+            minInterval=smartConfig.get('minIntervalSeconds', SMART_MIN_INTERVAL_SECONDS),
+            maxStaleness=smartConfig.get('maxStalenessSeconds', SMART_MAX_STALENESS_SECONDS),
+            useStandbyProbe=smartConfig.get('standbyProbe', False))
+        self.smart = SMART(fullInterval=smartConfig.get('fullIntervalSeconds', FULL_SMART_INTERVAL_SECONDS))
+        self.dirIndex = DirIndex(sharesConfig)
+        self.alertEngine = AlertEngine(alertsConfig, onTransition=self.publishAlert)
+        self.throttleMonitor = ThrottleMonitor()
+        self.servicesMonitor = ServicesMonitor(servicesConfig)
+        self.cgroupMonitor = CgroupMonitor(cgroupsConfig) if cgroupsConfig.get('enabled', True) else None
+        self.rollingStats = RollingStats(self.nasMon.config.get('rollingStats', {}) if self.nasMon is not None else {})
+        # Spin-up transient capture, created once the INA3221 is set up
+        self.burstCapture = None
+        self.burstConfig = {}
+        if self.nasMon is not None:
+            self.burstConfig = self.nasMon.config.get('burstCapture', {})
+        # Held by the power collector and by a burst capture (which reconfigures the INA3221)
+        self.powerLock = threading.Lock()
+
+        self.stats_lock = threading.Lock()
+        self.process = psutil.Process(os.getpid())
+        collectorsConfig = {}
+        if self.nasMon is not None:
+            collectorsConfig = self.nasMon.config.get('collectors', {})
+        self.stateFile = collectorsConfig.get('stateFile')
+        deadlines = collectorsConfig.get('deadlines', {})
+        sampling = collectorsConfig.get('sampling', {})
+        self.collectors = CollectorSet()
+        self.collectors.add('os', self.collectOs, deadlines.get('os', 5),
+                            self.buildRate('os', sampling))
+        self.collectors.add('enclosure', self.collectEnclosure, deadlines.get('enclosure', 5),
+                            self.buildRate('enclosure', sampling))
+        # 3 channels at ~1 sec per conversion plus the ready wait
+        self.collectors.add('power', self.collectPower, deadlines.get('power', 10),
+                            self.buildRate('power', sampling))
+        # May include a smartctl call
+        self.collectors.add('filesystem', self.collectFilesystem, deadlines.get('filesystem', 60),
+                            self.buildRate('filesystem', sampling))
+        # nfsd counters only, smbstatus runs in the background
+        self.collectors.add('services', self.collectServices, deadlines.get('services', 5),
+                            self.buildRate('services', sampling))
+        # One pread per file of each cgroup, mkdir/rmdir come from inotify
+        self.collectors.add('cgroups', self.collectCgroups, deadlines.get('cgroups', 5),
+                            self.buildRate('cgroups', sampling))
+
+    def buildRate(self, name, samplingConfig):
+        minSeconds, maxSeconds, metrics = SAMPLING_DEFAULTS[name]
+        config = samplingConfig.get(name, {})
+        return AdaptiveRate(config.get('minSeconds', minSeconds), config.get('maxSeconds', maxSeconds),
+                            config.get('metrics', metrics), change=config.get('change', 0.05))
 
     def startup(self):
         logger.info('NasStats Startup...')
@@ -80,13 +194,15 @@ class NasStats:
         now = time.time()
         stats = { 
             'timestampEpoc': now,
-            'timestamp': datetime.datetime.fromtimestamp(now,pytz.timezone("America/Denver")).strftime('%Y-%m-%d %H:%M:%S.%f%z'),
+            'timestamp': formatTimestamp(now),
             'state': 'starting'
         }
         self.nasMon.pubsub.setDeviceBirthMsg( stats )
 
 
-        i2c_bus = board.I2C()
+        i2cConfig = self.nasMon.config.get('i2c', {})
+        i2c_bus = openBus(i2cConfig.get('bus', DEFAULT_BUS), i2cConfig.get('transport', TRANSPORT_DEV))
+        self.i2cBus = i2c_bus
         # The si7021 has a i2c address of 0x40
         # We try to init the sensor multiple times because sometimes we get the following error on init:
         #   adafruit_si7021.py", line 100: RuntimeError("bad USER1 register (%x!=%x)" % (value, _USER1_VAL))
@@ -121,17 +237,45 @@ class NasStats:
         self.voltCurrentSensor.enable_channel(2)
         self.voltCurrentSensor.enable_channel(3)
 
+        if self.burstConfig.get('enabled', False):
+            self.burstCapture = BurstCapture(self.burstConfig, self.voltCurrentSensor, self.powerLock)
+            self.burstCapture.startup()
+
+        self.dirIndex.startup()
+        self.throttleMonitor.startup()
+        self.servicesMonitor.startup()
+        if self.cgroupMonitor is not None:
+            self.cgroupMonitor.startup()
+        self.ueventListener.startup()
+        restored = self.loadState()
+        if restored is not None:
+            # Dashboards get the last known values right away instead of after the first
+            # collection.  MQTT is probably not connected yet, so it goes out as the birth.
+            self.nasMon.pubsub.setDeviceBirthMsg( restored.toDict() )
         self.startStatsThread()
 
     def shutdown(self):
         logger.info('Shutdown...')
         self.stopStatsThread()
+        self.saveState()
+        self.collectors.shutdown()
+        self.dirIndex.shutdown()
+        self.throttleMonitor.shutdown()
+        self.servicesMonitor.shutdown()
+        if self.cgroupMonitor is not None:
+            self.cgroupMonitor.shutdown()
+        self.ueventListener.shutdown()
+        if self.burstCapture is not None:
+            self.burstCapture.shutdown()
+        # A hung collector may still be in an I2C transfer, then the fd is left to process exit
+        if self.i2cBus is not None and not self.collectors.anyRunning():
+            self.i2cBus.deinit()
         #data = self.getStats()
 
         now = time.time()
         stats = { 
             'timestampEpoc': now,
-            'timestamp': datetime.datetime.fromtimestamp(now,pytz.timezone("America/Denver")).strftime('%Y-%m-%d %H:%M:%S.%f%z'),
+            'timestamp': formatTimestamp(now),
             'state': 'shutdown'
         }
         self.nasMon.pubsub.publishCurrentState( stats )
@@ -151,41 +295,221 @@ class NasStats:
         if self.stats_thread is not None:
             logger.info('stats thread stop request')
             self.stats_thread_stop.set()
-            self.stats_thread.join()
+            # A collection in progress can take up to its collector deadline, don't wait for it
+            self.stats_thread.join(STATS_THREAD_JOIN_SECONDS)
+            if self.stats_thread.is_alive():
+                logger.warning('stats thread still collecting, not waiting for it')
+            else:
+                logger.info('stats thread stopped')
             self.stats_thread = None
-            logger.info('stats thread stopped')
 
     def statsThread(self):
        
+        published = None
         while not self.stats_thread_stop.isSet():
             #now = time.time() * 1000
           
-            data = self.getStats()
-            self.nasMon.pubsub.publishCurrentState( data )
-
-            self.stats_thread_stop.wait(30)
+            # Samples whichever collectors are due at their adaptive rate
+            with self.stats_lock:
+                data = self.collectStats(useCache=False)
+            if data is not None and data is published:
+                # Nothing was due (woken early), don't publish the same snapshot twice
+                self.stats_thread_stop.wait(1)
+                continue
+            published = data
+            # Converted here, at the edge, once for MQTT and all the exporters
+            stats = data.toDict() if data is not None else {}
+            self.nasMon.pubsub.publishCurrentState( stats )
+            for exporter in self.nasMon.exporters:
+                exporter.publish( stats )
+
+            # Only a cycle that produced fresh data keeps the systemd watchdog happy
+            if data is not None and len(data.stale) < len(self.collectors.collectors):
+                self.nasMon.watchdog.progress("stale: {}".format(','.join(data.stale) or 'none'))
+
+            # Until the next collector is due (sensors not initialised: old fixed cycle)
+            wait = self.collectors.getNextDue() - time.monotonic() if data is not None else STATS_MAX_WAIT_SECONDS
+            self.stats_thread_stop.wait(min(max(wait, 1), STATS_MAX_WAIT_SECONDS))
             #time.sleep(5)
         logger.info('stats thread EXITING')
 
 
 
-    # Only one thread can call at a time
-    @synchronized_method
-    def getStats(self):
+    def getStats(self, sections=None, maxAge=None):
+        """
+        sections: the collectors (os, enclosure, ...) the caller needs, a
+        collection triggered by this call leaves the others alone.
+        maxAge: the requested sections older than this (seconds) are
+        collected now, the others come from the last snapshot.
+        """
+        snapshot = self.getSnapshot(sections, maxAge)
+        return snapshot.toDict() if snapshot is not None else {}
+
+    def getSnapshot(self, sections=None, maxAge=None):
+        """The Snapshot behind getStats(), None until the sensors are set up"""
 
-        logger.info('in getStats')
+        logger.debug('in getStats')
         now = time.time()
 
+        if maxAge is not None:
+            if self.stats_cache is not None and not self.collectors.getOlderThan(maxAge, now, sections):
+                return self.stats_cache
+            # The caller asked for fresh data, so wait for a collection in progress
+            # (which may already bring what is needed)
+            with self.stats_lock:
+                refresh = self.collectors.getOlderThan(maxAge, time.time(), sections)
+                if self.stats_cache is not None and not refresh:
+                    return self.stats_cache
+                return self.collectStats(useCache=False, only=refresh, force=True)
+
         if self.stats_cache is not None and ((now - self.stats_cache_timestamp) < MAX_CACHE_TIME_SECONDS):
             logger.debug('in getStats returning value from cache')
             return self.stats_cache 
 
+        # Only one thread collects at a time.  Other callers (e.g., HTTP requests)
+        # get the last snapshot instead of queueing up behind the collection.
+        if not self.stats_lock.acquire(blocking=self.stats_cache is None):
+            return self.stats_cache
+        try:
+            return self.collectStats(only=sections)
+        finally:
+            self.stats_lock.release()
+
+    def collectStats(self, useCache=True, only=None, force=False):
+
+        now = time.time()
+        if useCache and self.stats_cache is not None and ((now - self.stats_cache_timestamp) < MAX_CACHE_TIME_SECONDS):
+            return self.stats_cache
+        if self.stats_cache is not None and not force and not self.collectors.anyDue(only):
+            # Nothing new to sample yet
+            return self.stats_cache
+
         if self.tempHumSensor1 is None:
-            return {}
+            return None
 
        
         beginTime = now
 
+        # Each collector runs with its own deadline, a hung one only makes its own section stale
+        results, stale = self.collectors.collect(now, only=only, force=force)
+
+        endTime = time.time()
+        collectStatsDuration = endTime-beginTime
+
+
+        logger.info("Time to get stats: %0.3fms",  collectStatsDuration)
+        snapshot = Snapshot(now, round(collectStatsDuration, 3),
+                            results['os'], results['enclosure'], results['power'], results['filesystem'],
+                            self.throttleMonitor.getStats(), stale,
+                            spinup=self.burstCapture.getStats() if self.burstCapture is not None else None,
+                            services=results['services'], cgroups=results['cgroups'],
+                            previous=self.stats_cache)
+        # Kept as is, converted only when a consumer asks (getStats(), statsThread), and the
+        # core only converts the sections it reads.  Everything is set before that.
+
+        # Window statistics are fed at each collector's own sample rate
+        sampled = self.collectors.getSampled()
+        for name in sampled:
+            self.rollingStats.observeSection(name, snapshot.get(name), now)
+        snapshot.rolling = self.rollingStats.getSummary(now)
+
+        # Sample faster while the signals move or get close to an alert threshold
+        self.collectors.adapt(snapshot, self.alertEngine.isNearThreshold)
+        snapshot.sampling = self.collectors.getIntervals()
+
+        # Rules only publish on state transitions.  A reused (not sampled again) section
+        # would feed its old values again with a new time, which skews the rates.
+        self.alertEngine.evaluateSnapshot(snapshot, now,
+                                          skip={c.name for c in self.collectors.collectors} - set(sampled))
+        snapshot.alerts = self.alertEngine.getFiring()
+
+        self.stats_cache = snapshot
+        self.stats_cache_timestamp = now
+
+        return snapshot
+
+
+    ######################################################################
+    # Warm restart
+    ######################################################################
+    def saveState(self):
+        """Checkpoint the collector state so a restart continues where we stopped"""
+        if self.stateFile is None:
+            return
+        state = {
+            'version': STATE_FILE_VERSION,
+            'savedEpoc': time.time(),
+            # Kernel counters only continue within the same boot
+            'bootTimestampEpoc': psutil.boot_time(),
+            'snapshot': self.stats_cache.toDict() if self.stats_cache is not None else None,
+            'diskIo': {kname: {field: getattr(io, field) for field in DISK_IO_FIELDS}
+                       for kname, io in self.diskIoCounters_cache.items()},
+            'smartCapable': self.deviceSupportsSmart,
+            'sampling': {c.name: c.rate.getState() for c in self.collectors.collectors if c.rate is not None},
+            'spinup': self.burstCapture.getStats() if self.burstCapture is not None else None,
+        }
+        tmpFile = self.stateFile + '.tmp'
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmpFile, self.stateFile)
+        except (OSError, TypeError, ValueError) as e:
+            logger.error("Unable to save state to %s: %s", self.stateFile, e)
+            return
+        logger.info("State saved to %s", self.stateFile)
+
+    def loadState(self):
+        """
+        Restore the state saved by the previous run.  Returns the last
+        snapshot of that run (to publish right away) or None.
+        """
+        if self.stateFile is None:
+            return None
+        try:
+            with open(self.stateFile, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        age = time.time() - state.get('savedEpoc', 0)
+        if state.get('version') != STATE_FILE_VERSION or age > STATE_MAX_AGE_SECONDS:
+            logger.info("Not restoring state from %s (age %d sec)", self.stateFile, age)
+            return None
+
+        for collector in self.collectors.collectors:
+            saved = state.get('sampling', {}).get(collector.name)
+            if collector.rate is not None and saved is not None:
+                collector.rate.restoreState(saved)
+        if self.burstCapture is not None:
+            self.burstCapture.restoreStats(state.get('spinup'))
+
+        snapshot = state.get('snapshot')
+        # boot_time() can differ by a second between calls
+        sameBoot = abs(state.get('bootTimestampEpoc', 0) - psutil.boot_time()) < 2
+        if sameBoot:
+            # Same drives (sda/sdb) and kernel counters: baselines are still valid
+            self.deviceSupportsSmart.update(state.get('smartCapable', {}))
+            self.diskIoCounters_cache = {kname: types.SimpleNamespace(**io)
+                                         for kname, io in state.get('diskIo', {}).items()}
+            if snapshot:
+                self.filesystemDict_cache = {label: FilesystemStats.fromDict(fs)
+                                             for label, fs in (snapshot.get('filesystem') or {}).items()}
+
+        if not snapshot or 'os' not in snapshot:
+            return None
+        snapshot = Snapshot.fromDict(snapshot)
+        snapshot.restored = True
+        # Used (as stale values) until each collector has a new one
+        self.collectors.restoreValues({name: getattr(snapshot, name)
+                                       for name in ('os', 'enclosure', 'power', 'filesystem')
+                                       if getattr(snapshot, name)})
+
+        self.stats_cache = snapshot
+        self.stats_cache_timestamp = 0
+        logger.info("State restored from %s (age %d sec, same boot: %s)", self.stateFile, age, sameBoot)
+        return snapshot
+
+    def collectOs(self, now):
+
         cpuPercent = psutil.cpu_percent()
         cpuFreq = psutil.cpu_freq().current
         cpuTemperature = round(self.celsius2fahrenheit(psutil.sensors_temperatures()['cpu_thermal'][0].current), 1)
@@ -194,8 +518,7 @@ class NasStats:
         osStartTime = psutil.boot_time()
         osUptime = now - osStartTime
 
-        p = psutil.Process(os.getpid())
-        appStartTime = p.create_time()
+        appStartTime = self.process.create_time()
         appUptime = now - appStartTime
 
         # TOOD: Look at example to get more stats:  https://gist.github.com/nathants/8e3b26e769abf86ece8d
@@ -203,7 +526,11 @@ class NasStats:
         # Another example to build JSON from disk stats:
         #   https://python.hotexamples.com/site/file?hash=0x6f656f01be305c953664bc327ab3befbaa9cd4b3ac919f77dcb27692d33b3ddf&fullName=SchoolZillaDevOpsHomework-master/server.py&project=xoho/SchoolZillaDevOpsHomework
 
+        return OsStats(cpuPercent=cpuPercent, cpuFreq=cpuFreq, cpuTemperature=cpuTemperature,
+                       memoryUsedPercent=memoryUsedPercent, bootTimestampEpoc=osStartTime,
+                       uptime=round(osUptime,3), monUptime=round(appUptime,3))
 
+    def collectEnclosure(self, now):
 
         enclosure_tempCelsius1 = self.tempHumSensor1.temperature
         enclosure_humidity1 = round(self.tempHumSensor1.relative_humidity,1)
@@ -213,10 +540,24 @@ class NasStats:
         enclosure_pressure = self.tempHumSensor2.pressure
 
         #print('Temperature: %0.1f C (%0.1f F)  humidity: %0.1f %%' % (tempCelsius, celsius2fahrenheit(tempCelsius), humidity))
+        return EnclosureStats(temperature1=round(self.celsius2fahrenheit(enclosure_tempCelsius1), 1),
+                              humidity1=enclosure_humidity1,
+                              temperature2=round(self.celsius2fahrenheit(enclosure_tempCelsius2), 1),
+                              humidity2=enclosure_humidity2,
+                              pressure=round(enclosure_pressure, 2))
+
+    def collectPower(self, now):
+        # Waits for a running burst capture to restore the averaging config
+        with self.powerLock:
+            power = self.readPower(now)
+        if self.burstCapture is not None:
+            self.burstCapture.noteCurrents({'drive1': power.drive1_current, 'drive2': power.drive2_current}, now)
+        return power
+
+    def readPower(self, now):
+
         while not self.voltCurrentSensor.is_ready:
-            print(".",end='')
             time.sleep(0.1)
-        print("")
 
 
         # WARNING: These method calls can take 2 seconds total to complete (because of sample size)
@@ -238,65 +579,37 @@ class NasStats:
         drive2_current = round(self.voltCurrentSensor.current(channel),3)
         drive2_psu_voltage = round(drive2_bus_voltage + drive2_shunt_voltage,2)
 
-        #filesystemInfo = self.runFilesystemInfoScript()
-        filesystemInfo = self.getFilesystemInfo()
+        # Correlate under-voltage transitions with the measured supply voltage
+        self.throttleMonitor.noteVoltage(rpi_psu_voltage, now)
 
-        endTime = time.time()
-        collectStatsDuration = endTime-beginTime
+        return PowerStats(rpi_psu_voltage=rpi_psu_voltage,
+                          rpi_current=rpi_current,
+                          rpi_bus_voltage=rpi_bus_voltage,
 
+                          drive1_psu_voltage=drive1_psu_voltage,
+                          drive1_current=drive1_current,
+                          drive1_bus_voltage=drive1_bus_voltage,
 
-        logger.info("Time to get stats: %0.3fms",  collectStatsDuration)
-        stats = { 
-            'timestampEpoc': now,
-            'timestamp': datetime.datetime.fromtimestamp(now,pytz.timezone("America/Denver")).strftime('%Y-%m-%d %H:%M:%S.%f%z'),
-            'collectStatsDuration': round(collectStatsDuration, 3),
-
-            'os': {
-                "cpuPercent": cpuPercent,
-                "cpuFreq": cpuFreq,
-                "cpuTemperature": cpuTemperature,
-                "memoryUsedPercent": memoryUsedPercent,
-                "bootTimestampEpoc": osStartTime,
-                "uptime": round(osUptime,3),
-                "uptimeFmt": str(datetime.timedelta(seconds=round(osUptime))),
-                "monUptime": round(appUptime,3),
-                "monUptimeFmt": str(datetime.timedelta(seconds=round(appUptime))),
-            },
-
-            'enclosure': {
-                'temperature1': round(self.celsius2fahrenheit(enclosure_tempCelsius1), 1),
-                'humidity1': enclosure_humidity1,
-                'temperature2': round(self.celsius2fahrenheit(enclosure_tempCelsius2), 1),
-                'humidity2': enclosure_humidity2,
-                'pressure': round(enclosure_pressure, 2)
-            },
-
-            'power': {
-                'rpi_psu_voltage':rpi_psu_voltage,
-                'rpi_current': rpi_current,
-                'rpi_bus_voltage': rpi_bus_voltage,
-
-                'drive1_psu_voltage':drive1_psu_voltage,
-                'drive1_current': drive1_current,
-                'drive1_bus_voltage': drive1_bus_voltage,
-
-                'drive2_psu_voltage':drive2_psu_voltage,
-                'drive2_current': drive2_current,
-                'drive2_bus_voltage': drive2_bus_voltage,
-
-                'watts': round((rpi_current * rpi_bus_voltage) + (drive1_current * drive1_bus_voltage) + (drive2_current * drive2_bus_voltage), 1),
-                
-            },
-
-            'filesystem': filesystemInfo
+                          drive2_psu_voltage=drive2_psu_voltage,
+                          drive2_current=drive2_current,
+                          drive2_bus_voltage=drive2_bus_voltage,
 
-        }
+                          watts=round((rpi_current * rpi_bus_voltage) + (drive1_current * drive1_bus_voltage) + (drive2_current * drive2_bus_voltage), 1))
 
-        self.stats_cache = stats
-        self.stats_cache_timestamp = now
+    def collectFilesystem(self, now):
+        #return self.runFilesystemInfoScript()
+        return self.getFilesystemInfo()
+
+    def collectServices(self, now):
+        return self.servicesMonitor.collect()
 
-        return stats
+    def collectCgroups(self, now):
+        if self.cgroupMonitor is None:
+            return None
+        return self.cgroupMonitor.collect()
 
+    def publishAlert(self, event):
+        self.nasMon.pubsub.publishAlert(event)
 
     def celsius2fahrenheit(self, celsius):
         return (celsius * 1.8) + 32
@@ -325,10 +638,65 @@ class NasStats:
 
 
 
+    def handleUevent(self, event):
+        """A block device was added, removed or changed (uevent thread)"""
+        devname = event.get('DEVNAME')
+        with self.deviceLock:
+            # udev creates the links and reads the labels after the kernel event,
+            # and the automount comes later still: keep relisting for a while
+            self.inventoryDirtyUntil = time.monotonic() + INVENTORY_SETTLE_SECONDS
+            if event['ACTION'] == 'overflow':
+                self.changedDevices = None
+            elif devname and self.changedDevices is not None:
+                self.changedDevices.add(devname)
+        if devname and event.get('DEVTYPE') == 'disk' and event['ACTION'] == 'remove':
+            # Whatever shows up under this name next may be another drive.  A 'change'
+            # (partition rescan, media change) is still the same drive, its history stays.
+            self.smartScheduler.forgetDrive(devname)
+            self.smart.forgetDevice("/dev/{}".format(devname))
+
+    def applyDeviceChanges(self):
+        """Drop what is cached about the devices that changed (collection thread)"""
+        with self.deviceLock:
+            changed = self.changedDevices
+            self.changedDevices = set()
+        if changed is None:
+            # Events were lost, start over
+            for deviceName in self.deviceSupportsSmart:
+                self.smartScheduler.forgetDrive(deviceName[len('/dev/'):])
+                self.smart.forgetDevice(deviceName)
+            self.deviceSupportsSmart = {}
+            self.filesystemDict_cache = {}
+            self.diskIoCounters_cache = {}
+            return
+        if not changed:
+            return
+        for devname in changed:
+            self.deviceSupportsSmart.pop("/dev/{}".format(devname), None)
+        gone = set(changed)
+        gone.update(filesystem.kname for filesystem in self.filesystemDict_cache.values()
+                    if filesystem.pkname in changed)
+        self.filesystemDict_cache = {label: filesystem for label, filesystem in self.filesystemDict_cache.items()
+                                     if filesystem.kname not in gone}
+        self.diskIoCounters_cache = {kname: io for kname, io in self.diskIoCounters_cache.items()
+                                     if kname not in gone}
+
+    def getInventory(self):
+        """Mounted filesystems, lsblk only runs when the uevents say something changed"""
+        now = time.monotonic()
+        with self.deviceLock:
+            dirty = now < self.inventoryDirtyUntil
+        if (dirty or self.mountedFilesystems is None or not self.ueventListener.running or
+                now - self.mountedFilesystemsTime > INVENTORY_MAX_AGE_SECONDS):
+            self.mountedFilesystems = getMountedFilesystems()
+            self.mountedFilesystemsTime = now
+        return self.mountedFilesystems
+
     def getFilesystemInfo(self):
 
+        self.applyDeviceChanges()
         diskIoCounters = psutil.disk_io_counters(perdisk=True)
-        filesystems = getMountedFilesystems()
+        filesystems = self.getInventory()
         # for filesystem in filesystems:
         #     io = diskIoCounters[filesystem['kname']]
         #     filesystem['read_bytes'] = io.read_bytes
@@ -341,26 +709,40 @@ class NasStats:
         #     filesystem['spaceusedpercent'] = round( ((usage.used / usage.total) * 100), 3)
 
         filesystemDict = {}
-        for filesystem in filesystems:
-            label = filesystem['label']
+        for blockdevice in filesystems:
+            label = blockdevice['label']
+            filesystem = FilesystemStats(label=label, kname=blockdevice['kname'], path=blockdevice['path'],
+                                         mountpoint=blockdevice['mountpoint'], pkname=blockdevice['pkname'])
+            io = diskIoCounters.get(filesystem.kname)
+            if io is None:
+                # Unplugged since the last listing
+                logger.warning("Filesystem %s: %s is gone", label, filesystem.kname)
+                self.mountedFilesystems = None
+                continue
             filesystemDict[label] = filesystem
+            extra = {}
 
-            io = diskIoCounters[filesystem['kname']]
-            filesystem['read_bytes'] = io.read_bytes
-            filesystem['write_bytes'] = io.write_bytes
-            
-            usage = psutil.disk_usage(filesystem['mountpoint'])
-            filesystem['spacetotal'] = usage.total
-            filesystem['spaceused'] = usage.used
-            filesystem['spaceavail'] = usage.free
-            filesystem['spaceusedpercent'] = round( ((usage.used / usage.total) * 100), 3)
+            filesystem.read_bytes = io.read_bytes
+            filesystem.write_bytes = io.write_bytes
             
+            usage = psutil.disk_usage(filesystem.mountpoint)
+            filesystem.spacetotal = usage.total
+            filesystem.spaceused = usage.used
+            filesystem.spaceavail = usage.free
+            filesystem.spaceusedpercent = round( ((usage.used / usage.total) * 100), 3)
+
+            # Per-share usage from the incremental index (no disk access here)
+            shares = self.dirIndex.getSharesForMountpoint(filesystem.mountpoint)
+            if shares:
+                extra['shares'] = shares
+
             filesystem_cache = self.filesystemDict_cache.get(label)
             activity_read = False
             activity_write = False
-            if filesystem_cache is not None:
-                readDiff = io.read_bytes - filesystem_cache['read_bytes']
-                writeDiff = io.write_bytes - filesystem_cache['write_bytes']
+            # Same label on another device (re-enumerated): no baseline to compare with
+            if filesystem_cache is not None and filesystem_cache.kname == filesystem.kname:
+                readDiff = io.read_bytes - filesystem_cache.read_bytes
+                writeDiff = io.write_bytes - filesystem_cache.write_bytes
                 # TODO: This is an issue as it depends on the call
                 # e.g., if its consistant at every 30 seconds then it would be a reliable
                 # We cache this upon every call -- Need to think about it
@@ -374,30 +756,48 @@ class NasStats:
                 activity_read = readDiff > 0 
                 activity_write = writeDiff > 0
         
-            filesystem['activity_read'] = activity_read
-            filesystem['activity_write'] = activity_write
-            if activity_read or activity_write:
-                # Since there has been activity lately the drive is already spun-up so we can get the drive temperature
-                deviceName = "/dev/{}".format(filesystem['pkname'])
-                smartCapable = self.deviceSupportsSmart.get(deviceName)
-                if smartCapable is None:
-                    # Check if device is SMART capable and cache the answer
-                    smartCapable = isSMARTCapable(deviceName)
+            filesystem.activity_read = activity_read
+            filesystem.activity_write = activity_write
+
+            # Average time per I/O (ms) since the last sample
+            previousIo = self.diskIoCounters_cache.get(filesystem.kname)
+            if previousIo is not None:
+                ops = (io.read_count + io.write_count) - (previousIo.read_count + previousIo.write_count)
+                if ops > 0:
+                    ioTime = (io.read_time + io.write_time) - (previousIo.read_time + previousIo.write_time)
+                    extra['await_ms'] = round(ioTime / ops, 2)
+
+            # The scheduler only runs smartctl when the drive is already spinning
+            # and publishes the last known values (with their age) otherwise
+            deviceName = "/dev/{}".format(filesystem.pkname)
+            smartCapable = self.deviceSupportsSmart.get(deviceName)
+            if smartCapable is None:
+                # Check if device is SMART capable and cache the answer
+                smartCapable = isSMARTCapable(deviceName)
+                if smartCapable is not None:
                     self.deviceSupportsSmart[deviceName] = smartCapable
-                if smartCapable:
-                    tempCurrent,tempMax,tempMin = runSmartCmdForTemperature(deviceName)
-                    filesystem['temperature_current'] = tempCurrent
-                    filesystem['temperature_max'] = tempMax
-                    filesystem['temperature_min'] = tempMin
+            if smartCapable:
+                driveInfo = self.smartScheduler.getDriveInfo(filesystem.pkname)
+                extra.update(driveInfo)
+                # Full SMART pull (attributes, health, error counter trends) on a slow cadence
+                smartReport = self.smart.GetDeviceReport(deviceName, driveInfo['drive_state'] == STATE_ACTIVE)
+                if smartReport is not None:
+                    extra['smart'] = smartReport
 
+            filesystem.extra = extra or None
 
         #print(filesystemDict)
         self.filesystemDict_cache = filesystemDict
+        self.diskIoCounters_cache = diskIoCounters
         return filesystemDict
 
 def isSMARTCapable(dev):
-    cmd="smartctl -i {}".format(dev)
+    # "-n standby" so the check does not spin up a sleeping drive.
+    # Returns None (unknown, ask again later) if the drive is in standby.
+    cmd="smartctl -n standby,{} -i {}".format(SMARTCTL_STANDBY_EXIT_CODE, dev)
     exitcode, output = subprocess.getstatusoutput(cmd)
+    if exitcode == SMARTCTL_STANDBY_EXIT_CODE:
+        return None
     return exitcode==0
 
 def getMountedFilesystems():
@@ -13,6 +13,9 @@ import signal
 import sys
 import os
 import threading
+import argparse
+
+import yaml
 
 #import RPi.GPIO as GPIO
 #import board
@@ -21,29 +24,73 @@ import threading
 from pubsub import Pubsub
 from nas_stats import NasStats
 from http_request import HttpServer
+from fleet import FleetAggregator
+from ha_publisher import HaPublisher
+from influx_exporter import InfluxExporter
+from sd_watchdog import Watchdog
+from sensor_worker import SensorWorker
+from mem_debug import MemoryDebug
+from log_queue import BatchingHandler, startQueueLogging
 
 
 logger = logging.getLogger(__name__)
 
+# Shutdown is forced after this long, below TimeoutStopSec in setup/nasmon.service
+SHUTDOWN_DEADLINE_SECONDS = 20
 
 class NasMon:
     """Handle NAS stats publish via MQTT"""
 
-    def __init__(self):
+    def __init__(self, aggregator=False):
         self.pubsub = None
         self.server = None
         self.nasStats = None
+        self.fleet = None
+        # Optional exporters, each gets every new snapshot via publish(stats)
+        self.exporters = []
+        self.watchdog = Watchdog()
+
+        ymlfile = open("config.yml", 'r')
+        self.config = yaml.safe_load(ymlfile)
+        # tracemalloc for /v1/debug/memory, started first so it sees startup allocations
+        self.memoryDebug = MemoryDebug(self.config.get('debug', {}).get('tracemalloc', False))
+        # Aggregator mode: no local sensors, collect the status of all nodes instead
+        self.aggregatorMode = aggregator or self.config.get('aggregator', {}).get('enabled', False)
 
         # Docs: https://docs.python.org/3/library/logging.html
         # Docs on config: https://docs.python.org/3/library/logging.config.html
+        # All records go through a queue to a single writer thread (see log_queue.py)
+        logConfig = self.config.get('logging', {})
         FORMAT = '%(asctime)-15s %(threadName)-10s %(levelname)6s %(message)s'
-        logging.basicConfig(level=logging.NOTSET, format=FORMAT)
-  
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(logging.Formatter(FORMAT))
+        self.logHandlers = [BatchingHandler(consoleHandler)]
+
+        payloadLog = logConfig.get('payloadLog')
+        if payloadLog is not None:
+            self.logHandlers.append(self.__setup_logger('payload', payloadLog))
+            # Payload records only go to their own file
+            consoleHandler.addFilter(lambda record: record.name != 'payload')
+
+        self.logQueueHandler, self.logListener = startQueueLogging(
+            self.logHandlers, rateLimits=logConfig.get('rateLimits'),
+            sampleEvery=logConfig.get('sampleEvery', 0))
+        rootLogger = logging.getLogger()
+        rootLogger.setLevel(logConfig.get('level', 'INFO'))
+        rootLogger.addHandler(self.logQueueHandler)
+        if payloadLog is None:
+            # Nobody reads the payload dumps, don't even format them
+            logging.getLogger('payload').setLevel(logging.WARNING)
+
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
 
 
     def __setup_logger(self, logger_name, log_file, level=logging.INFO):
+        """
+        Send the records of logger_name to their own rotating file.  Returns
+        the (batched) handler to run on the log writer thread.
+        """
         l = logging.getLogger(logger_name)
         FORMAT = '%(asctime)-15s %(message)s'
         formatter = logging.Formatter(FORMAT)
@@ -51,9 +98,15 @@ class NasMon:
         fileHandler = logging.handlers.RotatingFileHandler(log_file, mode='a',
                                                            maxBytes=1000000, backupCount=2)
         fileHandler.setFormatter(formatter)
+        fileHandler.addFilter(logging.Filter(logger_name))
         l.setLevel(level)
-        l.addHandler(fileHandler)
-        l.propagate = False
+        return BatchingHandler(fileHandler)
+
+    def stopLogging(self):
+        # Drain the queue and write out whatever is still buffered
+        self.logListener.stop()
+        for handler in self.logHandlers:
+            handler.flush()
   
     def signal_handler(self, signal, frame):
         logger.info('Shutdown...')
@@ -65,21 +118,65 @@ class NasMon:
     def startup(self):
         logger.info('Startup...')
 
-        self.nasStats = NasStats(self)
+        if self.aggregatorMode:
+            logger.info('Running in fleet aggregator mode')
+            self.fleet = FleetAggregator(self.config, onProgress=self.watchdog.progress)
+            self.server = HttpServer(self, self.config.get('aggregator', {}).get('httpPort', HttpServer.AGGREGATOR_PORT))
+            # Type=notify unit: READY=1, then keep-alives while the heartbeat comes back
+            self.watchdog.startup()
+            # the following is a blocking call
+            self.server.run()
+            return
+
+        if self.config.get('worker', {}).get('enabled', False):
+            # Sensor I/O in its own process, snapshots shared through shared memory
+            self.nasStats = SensorWorker(self)
+        else:
+            self.nasStats = NasStats(self)
         self.pubsub = Pubsub(self)
+        if self.config.get('homeassistant', {}).get('entities'):
+            self.exporters.append(HaPublisher(self.config['homeassistant']))
+        if 'influxdb' in self.config:
+            self.exporters.append(InfluxExporter(self.config['influxdb'], self.pubsub.nodeName))
+        for exporter in self.exporters:
+            exporter.startup()
         self.nasStats.startup()
 
         self.server = HttpServer(self)
+        self.watchdog.startup()
         # the following is a blocking call
         self.server.run()
 
     def shutdown(self):
+        # Whatever hangs (an I2C read, a smartctl call), exit before systemd has to kill us
+        deadline = threading.Timer(self.config.get('shutdownDeadlineSeconds', SHUTDOWN_DEADLINE_SECONDS),
+                                   self.forceExit)
+        deadline.daemon = True
+        deadline.start()
+        self.watchdog.shutdown()
         if self.server is not None:
             self.server.shutdown()
         if self.nasStats is not None:
             self.nasStats.shutdown()
         if self.pubsub is not None:
             self.pubsub.shutdown()
+        for exporter in self.exporters:
+            exporter.shutdown()
+        if self.fleet is not None:
+            self.fleet.shutdown()
+        # The deadline stays armed through interpreter exit, which still joins
+        # the collector threads (a hung one blocks it).  The timer thread is a
+        # daemon, a clean exit does not wait for it.
+        self.stopLogging()
+
+    def forceExit(self):
+        # Straight to the handlers, the log writer thread may never get to a queued record.
+        # At ERROR the batching handlers write it out together with what they buffered.
+        record = logger.makeRecord(logger.name, logging.ERROR, __file__, 0,
+                                   'Shutdown did not finish within the deadline, exiting now', None, None)
+        for handler in self.logHandlers:
+            handler.handle(record)
+        os._exit(1)
 
 
 def main():
@@ -87,7 +184,12 @@ def main():
     The main function
     :return:
     """
-    if os.geteuid() != 0:
+    parser = argparse.ArgumentParser(description='Raspberry Pi NAS monitor')
+    parser.add_argument('--aggregator', action='store_true',
+                        help='consume the status of all nasmon nodes over MQTT and serve /v1/fleet')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0 and not args.aggregator:
         exit("You need to have root privileges to run this script.\nPlease try again, this time using 'sudo'. Exiting.")
 
     # f = open("/proc/net/wireless", "rt")
@@ -97,7 +199,7 @@ def main():
     # noise = int(data[187:192])
     # print("Link:{} Level:{} Noise:{}".format(link, level, noise))
 
-    nasMon = NasMon()
+    nasMon = NasMon(aggregator=args.aggregator)
     nasMon.startup()
 
 
@@ -0,0 +1,222 @@
+# Payload encoding for MQTT and HTTP
+#
+# JSON is always available and is the default.  MessagePack and CBOR are used
+# when the optional packages are installed:
+#   sudo pip3 install msgpack
+#   sudo pip3 install cbor2
+#
+# The binary encodings replace the well known key names with small integers
+# from FIELD_SCHEMA, so a snapshot is mostly numbers.  Keys not in the schema
+# (e.g., filesystem labels) stay as strings.  The schema is versioned and only
+# ever appended to, so consumers can cache it.
+
+import json
+import logging
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+logger = logging.getLogger(__name__)
+
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+ENCODING_CBOR = 'cbor'
+
+CONTENT_TYPES = {
+    ENCODING_JSON: 'application/json',
+    ENCODING_MSGPACK: 'application/msgpack',
+    ENCODING_CBOR: 'application/cbor',
+}
+# Accept header values mapped to an encoding
+ACCEPT_TYPES = {
+    'application/json': ENCODING_JSON,
+    'application/msgpack': ENCODING_MSGPACK,
+    'application/x-msgpack': ENCODING_MSGPACK,
+    'application/vnd.msgpack': ENCODING_MSGPACK,
+    'application/cbor': ENCODING_CBOR,
+}
+
+SCHEMA_VERSION = 1
+# NEVER reorder or remove entries, only append (the index is the wire key)
+FIELD_SCHEMA = (
+    'timestampEpoc', 'timestamp', 'collectStatsDuration', 'state',
+    'os', 'cpuPercent', 'cpuFreq', 'cpuTemperature', 'memoryUsedPercent',
+    'bootTimestampEpoc', 'uptime', 'uptimeFmt', 'monUptime', 'monUptimeFmt',
+    'enclosure', 'temperature1', 'humidity1', 'temperature2', 'humidity2', 'pressure',
+    'power', 'rpi_psu_voltage', 'rpi_current', 'rpi_bus_voltage',
+    'drive1_psu_voltage', 'drive1_current', 'drive1_bus_voltage',
+    'drive2_psu_voltage', 'drive2_current', 'drive2_bus_voltage', 'watts',
+    'filesystem', 'label', 'kname', 'path', 'mountpoint', 'pkname',
+    'read_bytes', 'write_bytes', 'spacetotal', 'spaceused', 'spaceavail', 'spaceusedpercent',
+    'activity_read', 'activity_write', 'drive_state',
+    'temperature_current', 'temperature_max', 'temperature_min', 'temperature_age',
+    'smart', 'smart_health', 'smart_failing', 'smart_timestamp',
+    'reallocated', 'reallocated_per_day', 'pending', 'pending_per_day',
+    'crc_errors', 'crc_errors_per_day',
+    'shares', 'bytes', 'directories', 'top',
+    'alerts',
+    'throttle', 'value', 'flags', 'transitions', 'underVoltageMinPsu', 'events',
+    'now', 'occurred', 'under_voltage', 'freq_capped', 'throttled', 'soft_temp_limit',
+    'flag', 'active', 'psuVoltage',
+    'stale',
+    'sampling',
+    'spinup', 'drive1', 'drive2', 'spinups', 'lastPeakCurrent', 'lastEnergy',
+    'lastSpinupEpoc', 'maxPeakCurrent',
+    'rolling', '1m', '5m', '15m', '1h', 'min', 'max', 'mean', 'count', 'p50', 'p95', 'p99',
+    'await_ms',
+    'restored',
+    'services', 'nfs', 'smb', 'threads', 'calls_per_sec', 'read_bytes_per_sec', 'write_bytes_per_sec',
+    'ops', 'queued_percent', 'sessions', 'users', 'machines', 'open_files', 'age',
+    'cgroups', 'containers', 'cpu_percent', 'memory_bytes',
+)
+FIELD_IDS = {name: index for index, name in enumerate(FIELD_SCHEMA)}
+
+
+def availableEncodings():
+    encodings = [ENCODING_JSON]
+    if msgpack is not None:
+        encodings.append(ENCODING_MSGPACK)
+    if cbor2 is not None:
+        encodings.append(ENCODING_CBOR)
+    return encodings
+
+
+def getSchema():
+    return {'version': SCHEMA_VERSION, 'fields': list(FIELD_SCHEMA)}
+
+
+def compactKeys(obj):
+    """Replace schema key names with their integer ids (recursively)"""
+    if isinstance(obj, dict):
+        return {FIELD_IDS.get(k, k): compactKeys(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [compactKeys(v) for v in obj]
+    return obj
+
+
+def expandKeys(obj):
+    """Inverse of compactKeys, for consumers and tests"""
+    if isinstance(obj, dict):
+        return {(FIELD_SCHEMA[k] if isinstance(k, int) else k): expandKeys(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [expandKeys(v) for v in obj]
+    return obj
+
+
+def encodePayload(obj, encoding=ENCODING_JSON):
+    """Return the bytes for obj in the requested encoding"""
+    if encoding == ENCODING_MSGPACK and msgpack is not None:
+        return msgpack.packb(compactKeys(obj), use_bin_type=True)
+    if encoding == ENCODING_CBOR and cbor2 is not None:
+        return cbor2.dumps(compactKeys(obj))
+    return json.dumps(obj).encode('utf-8')
+
+
+def projectFields(obj, fields):
+    """
+    Subset of obj with only the dotted paths in fields (e.g., 'power',
+    'filesystem.data1.spaceusedpercent').  Selected values are the same
+    objects as in obj, paths that don't exist are left out.
+    """
+    result = {}
+    for field in fields:
+        keys = field.split('.')
+        value = obj
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = result
+            source = obj
+            for key in keys[:-1]:
+                source = source[key]
+                target = target.setdefault(key, {})
+                if target is source:
+                    # A parent was selected as a whole, don't write into the snapshot
+                    break
+            else:
+                target[keys[-1]] = value
+    return result
+
+
+class SectionCache:
+    """
+    JSON of the top level sections of the latest snapshot, so a projection
+    (?fields=) only encodes the parts that are not whole sections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The snapshot itself is kept, so its id can't be reused
+        self.snapshot = None
+        self.sections = {}
+
+    def encodeFields(self, snapshot, fields, encoding=ENCODING_JSON):
+        projection = projectFields(snapshot, fields)
+        # Always there, so the client can tell how fresh the values are
+        if 'timestampEpoc' in snapshot:
+            projection['timestampEpoc'] = snapshot['timestampEpoc']
+        if encoding != ENCODING_JSON:
+            return encodePayload(projection, encoding)
+
+        with self.lock:
+            if self.snapshot is not snapshot:
+                self.snapshot = snapshot
+                self.sections = {}
+            parts = []
+            for key, value in projection.items():
+                if value is snapshot.get(key):
+                    data = self.sections.get(key)
+                    if data is None:
+                        data = self.sections[key] = json.dumps(value).encode('utf-8')
+                else:
+                    data = json.dumps(value).encode('utf-8')
+                # Same separators as json.dumps
+                parts.append(json.dumps(key).encode('utf-8') + b': ' + data)
+        return b'{' + b', '.join(parts) + b'}'
+
+
+def decodePayload(data, encoding=ENCODING_JSON):
+    if encoding == ENCODING_MSGPACK:
+        return expandKeys(msgpack.unpackb(data, raw=False, strict_map_key=False))
+    if encoding == ENCODING_CBOR:
+        return expandKeys(cbor2.loads(data))
+    return json.loads(data)
+
+
+def negotiateEncoding(acceptHeader):
+    """
+    Pick the encoding from an HTTP Accept header, honouring q values.
+    Falls back to JSON when nothing acceptable (and installed) is listed.
+    """
+    if not acceptHeader:
+        return ENCODING_JSON
+    available = availableEncodings()
+    best = None
+    bestQ = 0.0
+    for item in acceptHeader.split(','):
+        mediaType, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encoding = ACCEPT_TYPES.get(mediaType.strip().lower())
+        if encoding in available and q > bestQ:
+            best = encoding
+            bestQ = q
+    return best if best is not None else ENCODING_JSON
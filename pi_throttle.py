@@ -0,0 +1,222 @@
+"""
+Raspberry Pi throttling and under-voltage monitor
+
+Reads the firmware throttled state without forking "vcgencmd get_throttled":
+  - sysfs attribute exposed by the raspberrypi firmware driver
+      /sys/devices/platform/soc/soc:firmware/get_throttled
+  - or the firmware mailbox property interface through /dev/vcio
+    (tag GET_THROTTLED 0x00030046), for kernels without the attribute
+
+Throttled bits:
+   0 - Under-voltage detected
+   1 - ARM frequency capped
+   2 - Currently throttled
+   3 - Soft temperature limit active
+  16 - Under-voltage has occurred
+  17 - ARM frequency capping has occurred
+  18 - Throttling has occurred
+  19 - Soft temperature limit has occurred
+
+Ref: https://www.raspberrypi.com/documentation/computers/os.html#get_throttled
+"""
+
+import logging
+import time
+import threading
+import struct
+import array
+import fcntl
+import os
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+THROTTLED_SYSFS_PATH = '/sys/devices/platform/soc/soc:firmware/get_throttled'
+VCIO_DEVICE = '/dev/vcio'
+# Poll often so short under-voltage dips are seen as they happen (a sysfs read is cheap)
+THROTTLE_POLL_SECONDS = 1
+# Number of transitions kept with their correlated PSU voltage
+THROTTLE_EVENT_HISTORY = 20
+# A PSU voltage sample older than this is not used for correlation
+VOLTAGE_MAX_AGE_SECONDS = 60
+
+FLAGS = {
+    0: 'under_voltage',
+    1: 'freq_capped',
+    2: 'throttled',
+    3: 'soft_temp_limit',
+}
+OCCURRED_SHIFT = 16
+
+# Mailbox property interface
+MBOX_TAG_GET_THROTTLED = 0x00030046
+MBOX_REQUEST = 0x00000000
+MBOX_RESPONSE_SUCCESS = 0x80000000
+
+
+def _IOWR(type, nr, size):
+    return (3 << 30) | (size << 16) | (ord(type) << 8) | nr
+
+# IOCTL_MBOX_PROPERTY = _IOWR(100, 0, char *)
+IOCTL_MBOX_PROPERTY = _IOWR('d', 0, struct.calcsize('P'))
+
+
+def decodeThrottled(value):
+    """Return a dict of flag name -> {'now': bool, 'occurred': bool}"""
+    result = {}
+    for bit, name in FLAGS.items():
+        result[name] = {
+            'now': bool(value & (1 << bit)),
+            'occurred': bool(value & (1 << (bit + OCCURRED_SHIFT))),
+        }
+    return result
+
+
+class FileThrottledSource:
+    """Read the throttled value from a file holding a hex number (sysfs or a fake file for tests)"""
+
+    def __init__(self, path=THROTTLED_SYSFS_PATH):
+        self.path = path
+
+    def available(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        with open(self.path, 'r') as f:
+            return int(f.read().strip(), 16)
+
+
+class MailboxThrottledSource:
+    """Read the throttled value through the firmware mailbox (/dev/vcio)"""
+
+    def __init__(self, device=VCIO_DEVICE):
+        self.device = device
+        self.fd = None
+
+    def available(self):
+        return os.path.exists(self.device)
+
+    def read(self):
+        if self.fd is None:
+            self.fd = os.open(self.device, os.O_RDWR)
+        # buffer size, request code, tag, value buffer size, tag request code, value, end tag
+        buf = array.array('I', [7 * 4, MBOX_REQUEST, MBOX_TAG_GET_THROTTLED, 4, 0, 0, 0])
+        fcntl.ioctl(self.fd, IOCTL_MBOX_PROPERTY, buf, True)
+        if buf[1] != MBOX_RESPONSE_SUCCESS:
+            raise OSError("mailbox GET_THROTTLED failed: 0x{:08x}".format(buf[1]))
+        return buf[5]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def defaultThrottledSource():
+    for source in (FileThrottledSource(), MailboxThrottledSource()):
+        if source.available():
+            return source
+    return None
+
+
+class ThrottleMonitor:
+    """
+    Poll the throttled state, count transitions of each flag and record the
+    latest PSU voltage (from the INA3221) at each transition.
+    """
+
+    def __init__(self, source=None, pollInterval=THROTTLE_POLL_SECONDS):
+        self.source = source if source is not None else defaultThrottledSource()
+        self.pollInterval = pollInterval
+        self.lock = threading.Lock()
+        self.value = None
+        self.lastReadTime = None
+        self.transitions = {name: 0 for name in FLAGS.values()}
+        self.events = deque(maxlen=THROTTLE_EVENT_HISTORY)
+        self.psuVoltage = None
+        self.psuVoltageTime = None
+        # Lowest PSU voltage seen while under-voltage was active
+        self.underVoltageMinPsu = None
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        if self.source is None:
+            logger.info("No throttled state source available (not a Raspberry Pi?)")
+            return
+        self.thread = threading.Thread(target=self.monitorThread, name='throttle')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def monitorThread(self):
+        while not self.thread_stop.is_set():
+            self.poll()
+            self.thread_stop.wait(self.pollInterval)
+
+    def noteVoltage(self, psuVoltage, now=None):
+        """Called by the stats collection with each new INA3221 rpi_psu_voltage sample"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.psuVoltage = psuVoltage
+            self.psuVoltageTime = now
+            if self.value is not None and self.value & 1:
+                if self.underVoltageMinPsu is None or psuVoltage < self.underVoltageMinPsu:
+                    self.underVoltageMinPsu = psuVoltage
+
+    def poll(self, now=None):
+        if now is None:
+            now = time.time()
+        try:
+            value = self.source.read()
+        except (OSError, ValueError) as e:
+            logger.error("Unable to read throttled state: %s", e)
+            return
+        with self.lock:
+            previous = self.value
+            self.value = value
+            self.lastReadTime = now
+            if previous is None:
+                return
+            changed = (previous ^ value) & 0xF
+            if not changed:
+                return
+            voltage = self.psuVoltage
+            if voltage is not None and (now - self.psuVoltageTime) > VOLTAGE_MAX_AGE_SECONDS:
+                voltage = None
+            for bit, name in FLAGS.items():
+                if changed & (1 << bit):
+                    active = bool(value & (1 << bit))
+                    if active:
+                        self.transitions[name] += 1
+                    self.events.append({
+                        'timestampEpoc': now,
+                        'flag': name,
+                        'active': active,
+                        'psuVoltage': voltage,
+                    })
+                    if bit == 0:
+                        logger.warning("Under-voltage %s (PSU voltage %s)", 'detected' if active else 'cleared', voltage)
+                        if active:
+                            self.underVoltageMinPsu = voltage
+
+    def getStats(self):
+        with self.lock:
+            if self.value is None:
+                return None
+            stats = {
+                'value': '0x{:x}'.format(self.value),
+                'flags': decodeThrottled(self.value),
+                'transitions': dict(self.transitions),
+                'underVoltageMinPsu': self.underVoltageMinPsu,
+                'events': list(self.events),
+            }
+            return stats
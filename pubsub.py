@@ -8,10 +8,12 @@ import json
 import os
 import sys
 
-import yaml
+from payload_encoding import encodePayload, availableEncodings, getSchema, ENCODING_JSON
 
 
 logger = logging.getLogger(__name__)
+# Full payload dumps go to their own logger (see logging.payloadLog in config.yml)
+payloadLogger = logging.getLogger('payload')
 
 #
 # Node: [NAMESPACE]/node/[NODE_NAME]/status
@@ -34,9 +36,7 @@ class Pubsub:
     def __init__(self, _nasMon):
         self.nasMon = _nasMon
 
-        ymlfile = open("config.yml", 'r')
-        cfg = yaml.safe_load(ymlfile)
-        mqttConfig = cfg['mqtt']
+        mqttConfig = self.nasMon.config['mqtt']
 
         self.mqttBrokerHost = mqttConfig['host']
         self.mqttBrokerPort = mqttConfig['port']
@@ -50,6 +50,16 @@ class Pubsub:
 
         self._deviceBirthMsg = None
 
+        # Optional binary encodings, published in addition to JSON on <topic>/<encoding>
+        self.extraEncodings = []
+        for encoding in mqttConfig.get('encodings', []):
+            if encoding == ENCODING_JSON:
+                continue
+            if encoding not in availableEncodings():
+                logger.error("MQTT encoding %s is not available (package not installed)", encoding)
+                continue
+            self.extraEncodings.append(encoding)
+
         # Node name example: yukon/node/rpibasalt1/status
         _nodeName = os.uname().nodename
         # Remove the domain part of the hostname if it exits
@@ -60,6 +70,8 @@ class Pubsub:
         # Device name example: yukon/device/basalt/driveway/basalt1/light/status
         self.queueDeviceStatus = self.queueNamespace + "/device/" + self.typeName + "/" + self.locationName + "/" + self.nodeName + "/" + self.deviceName + "/status"
         self.queueDeviceAllStatus = self.queueNamespace + "/device/" + self.typeName + "/" + self.locationName + "/ALL/" + self.deviceName + "/status"
+        # Alert state transitions: yukon/device/nas/room1/rpinas1/bnas01/alert
+        self.queueDeviceAlert = self.queueNamespace + "/device/" + self.typeName + "/" + self.locationName + "/" + self.nodeName + "/" + self.deviceName + "/alert"
 
 
         logger.info("Node name: %s Node MQTT: %s Device MQTT: %s", self.nodeName, self.queueNodeStatus, self.queueDeviceStatus )
@@ -85,10 +97,13 @@ class Pubsub:
         self.client.loop_start()
 
     ######################################################################
-    # Allow other classes to set the device birth msg prior to connecting
+    # Allow other classes to set the device birth msg, published on every
+    # (re)connect, and right away if already connected
     ######################################################################
     def setDeviceBirthMsg(self, msg):
         self._deviceBirthMsg = msg
+        if self.client.is_connected():
+            self.publishDeviceBirth()
 
     ######################################################################
     # Publish the BIRTH certificates
@@ -104,6 +119,9 @@ class Pubsub:
         logger.info("Publishing Node Birth")
         payload = "online"
         self.client.publish(self.queueNodeStatus, payload, 0, True)
+        if self.extraEncodings:
+            # Consumers of the binary encodings need the field schema to decode the keys
+            self.client.publish(self.queueDeviceStatus + "/schema", json.dumps(getSchema()), 0, True)
 
     ######################################################################
     # Publish the DEVICE BIRTH certificate
@@ -182,15 +200,28 @@ class Pubsub:
         #     "lightState": lightStateName,
         #     "time" : time.time()
         # }
+        # A reconnect republishes the current state, not the one from startup
+        self._deviceBirthMsg = jsonState
         self.publishEventObject(self.queueDeviceStatus, jsonState, True)
 
 
+    ######################################################################
+    # publish an alert state transition (not retained, edge-triggered)
+    ######################################################################
+    def publishAlert(self, alertEvent):
+        self.publishEventObject(self.queueDeviceAlert, alertEvent, False)
+
+
     def publishEventObject(self, eventQueue, eventData, retain=False):
         data_out=json.dumps(eventData) # encode object to JSON
+        for encoding in self.extraEncodings:
+            self.client.publish(eventQueue + "/" + encoding, encodePayload(eventData, encoding), qos=0, retain=retain)
         return self.publishEventString(eventQueue, data_out, retain)
 
     def publishEventString(self, eventQueue, eventString, retain=False):
-        logger.info("Publish to queue:[%s] data:[%s] retain:[%s]", eventQueue, eventString, retain)
+        logger.debug("Publish to queue:[%s] bytes:[%d] retain:[%s]", eventQueue, len(eventString), retain)
+        if payloadLogger.isEnabledFor(logging.INFO):
+            payloadLogger.info("queue:[%s] data:[%s]", eventQueue, eventString)
         msg_info = self.client.publish(eventQueue, eventString, qos=0, retain=retain)
         #msg_info.wait_for_publish()
         return msg_info
@@ -0,0 +1,269 @@
+"""
+Rolling window and streaming quantile statistics for every metric
+
+Every numeric value of the os, enclosure, power and filesystem sections is
+fed at its collector's sample rate (see adaptive_rate.py), so short spikes
+between two published snapshots are not lost.
+
+Per metric:
+  - min / max / mean / count over the last 1m, 5m, 15m and 1h.  Each window
+    is a ring of 12 slots, an update touches one slot (O(1)) and a query
+    combines 12 slots.
+  - p50 / p95 / p99 over the last 15m and 1h from a DDSketch (relative
+    error 2%) per 5 minute slot.  DDSketches merge exactly, so a window's
+    quantiles come from merging its slots.  Each sketch is capped at
+    SKETCH_MAX_BINS bins, so the memory per metric is fixed.
+
+The metrics listed in rollingStats.snapshotMetrics (fnmatch patterns) are
+added to every snapshot under 'rolling', all of them are available on
+/v1/stats/<metric> (e.g., /v1/stats/power.watts).
+
+DDSketch paper: https://arxiv.org/abs/1908.10693
+"""
+
+import fnmatch
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900), ('1h', 3600))
+WINDOW_SLOTS = 12
+SKETCH_SLOT_SECONDS = 300
+SKETCH_SLOTS = 12
+QUANTILE_WINDOWS = (('15m', 3), ('1h', SKETCH_SLOTS))
+QUANTILES = (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+
+# 128 bins at 2% cover values from x to ~160x
+SKETCH_RELATIVE_ACCURACY = 0.02
+SKETCH_MAX_BINS = 128
+# Values closer to 0 than this are counted as 0
+SKETCH_MIN_VALUE = 1e-9
+
+DEFAULT_MAX_METRICS = 200
+DEFAULT_SNAPSHOT_METRICS = ('power.watts', 'enclosure.temperature1', 'os.cpuTemperature',
+                            'filesystem.*.temperature_current', 'filesystem.*.await_ms')
+
+# Nested sections that are not metrics
+SKIP_KEYS = frozenset(('smart', 'shares', 'ops'))
+# Sections with a metric per service/container, they would use up maxMetrics
+SKIP_SECTIONS = frozenset(('cgroups',))
+# Counters, timestamps and constants: their distribution means nothing
+EXCLUDE_KEYS = frozenset(('bootTimestampEpoc', 'uptime', 'monUptime', 'read_bytes', 'write_bytes',
+                          'spacetotal', 'temperature_age', 'age'))
+
+
+class DDSketch:
+    """Quantile sketch with relative error guarantees, mergeable"""
+
+    __slots__ = ('gamma', 'logGamma', 'maxBins', 'positive', 'negative', 'zeroCount', 'count')
+
+    def __init__(self, relativeAccuracy=SKETCH_RELATIVE_ACCURACY, maxBins=SKETCH_MAX_BINS):
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.maxBins = maxBins
+        # bin key -> count, value v is in bin ceil(log(|v|) / log(gamma))
+        self.positive = {}
+        self.negative = {}
+        self.zeroCount = 0
+        self.count = 0
+
+    def clear(self):
+        self.positive.clear()
+        self.negative.clear()
+        self.zeroCount = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value > SKETCH_MIN_VALUE:
+            store = self.positive
+        elif value < -SKETCH_MIN_VALUE:
+            store = self.negative
+            value = -value
+        else:
+            self.zeroCount += 1
+            return
+        key = math.ceil(math.log(value) / self.logGamma)
+        store[key] = store.get(key, 0) + 1
+        if len(store) > self.maxBins:
+            self.collapse(store)
+
+    def collapse(self, store):
+        # Fold the two bins of the smallest magnitude together, only the
+        # accuracy for the values closest to 0 suffers
+        keys = sorted(store)
+        store[keys[1]] += store.pop(keys[0])
+
+    def merge(self, other):
+        for store, otherStore in ((self.positive, other.positive), (self.negative, other.negative)):
+            for key, count in otherStore.items():
+                store[key] = store.get(key, 0) + count
+            while len(store) > self.maxBins:
+                self.collapse(store)
+        self.zeroCount += other.zeroCount
+        self.count += other.count
+
+    def binValue(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        # Most negative first
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.binValue(key)
+        seen += self.zeroCount
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.binValue(key)
+        return self.binValue(max(self.positive)) if self.positive else 0.0
+
+
+class WindowStats:
+    """min / max / sum / count of a time window as a ring of slots"""
+
+    __slots__ = ('slotSeconds', 'index', 'count', 'total', 'minimum', 'maximum')
+
+    def __init__(self, windowSeconds):
+        self.slotSeconds = windowSeconds / WINDOW_SLOTS
+        self.index = [-1] * WINDOW_SLOTS
+        self.count = [0] * WINDOW_SLOTS
+        self.total = [0.0] * WINDOW_SLOTS
+        self.minimum = [0.0] * WINDOW_SLOTS
+        self.maximum = [0.0] * WINDOW_SLOTS
+
+    def add(self, value, now):
+        index = int(now // self.slotSeconds)
+        slot = index % WINDOW_SLOTS
+        if self.index[slot] != index:
+            # Slot of an expired period, start over
+            self.index[slot] = index
+            self.count[slot] = 1
+            self.total[slot] = value
+            self.minimum[slot] = value
+            self.maximum[slot] = value
+            return
+        self.count[slot] += 1
+        self.total[slot] += value
+        if value < self.minimum[slot]:
+            self.minimum[slot] = value
+        if value > self.maximum[slot]:
+            self.maximum[slot] = value
+
+    def get(self, now):
+        oldest = int(now // self.slotSeconds) - WINDOW_SLOTS
+        count = 0
+        total = 0.0
+        minimum = math.inf
+        maximum = -math.inf
+        for slot in range(WINDOW_SLOTS):
+            if self.index[slot] <= oldest or self.count[slot] == 0:
+                continue
+            count += self.count[slot]
+            total += self.total[slot]
+            minimum = min(minimum, self.minimum[slot])
+            maximum = max(maximum, self.maximum[slot])
+        if count == 0:
+            return None
+        return {'min': minimum, 'max': maximum, 'mean': round(total / count, 4), 'count': count}
+
+
+class MetricStats:
+
+    __slots__ = ('windows', 'sketchIndex', 'sketches')
+
+    def __init__(self):
+        self.windows = [WindowStats(seconds) for name, seconds in WINDOWS]
+        self.sketchIndex = [-1] * SKETCH_SLOTS
+        self.sketches = [DDSketch() for x in range(SKETCH_SLOTS)]
+
+    def add(self, value, now):
+        for window in self.windows:
+            window.add(value, now)
+        index = int(now // SKETCH_SLOT_SECONDS)
+        slot = index % SKETCH_SLOTS
+        if self.sketchIndex[slot] != index:
+            self.sketchIndex[slot] = index
+            self.sketches[slot].clear()
+        self.sketches[slot].add(value)
+
+    def getQuantiles(self, now, slots):
+        current = int(now // SKETCH_SLOT_SECONDS)
+        merged = DDSketch()
+        for slot in range(SKETCH_SLOTS):
+            if current - slots < self.sketchIndex[slot] <= current:
+                merged.merge(self.sketches[slot])
+        if merged.count == 0:
+            return None
+        return {name: round(merged.quantile(q), 4) for name, q in QUANTILES}
+
+    def get(self, now):
+        result = {}
+        for (name, seconds), window in zip(WINDOWS, self.windows):
+            result[name] = window.get(now)
+        for name, slots in QUANTILE_WINDOWS:
+            quantiles = self.getQuantiles(now, slots)
+            if quantiles is not None and result.get(name) is not None:
+                result[name].update(quantiles)
+        return result
+
+
+class RollingStats:
+
+    def __init__(self, rollingConfig=None):
+        rollingConfig = rollingConfig or {}
+        self.maxMetrics = rollingConfig.get('maxMetrics', DEFAULT_MAX_METRICS)
+        self.snapshotPatterns = rollingConfig.get('snapshotMetrics', DEFAULT_SNAPSHOT_METRICS)
+        self.metrics = {}
+        # metric name -> included in the snapshot, decided once per metric
+        self.inSnapshot = {}
+        self.lock = threading.Lock()
+
+    def observe(self, metric, value, now):
+        with self.lock:
+            stats = self.metrics.get(metric)
+            if stats is None:
+                if len(self.metrics) >= self.maxMetrics:
+                    return
+                stats = self.metrics[metric] = MetricStats()
+                self.inSnapshot[metric] = any(fnmatch.fnmatchcase(metric, p) for p in self.snapshotPatterns)
+            stats.add(value, now)
+
+    def observeSection(self, prefix, section, now):
+        """Feed every numeric value of a (converted) snapshot section"""
+        if not isinstance(section, dict) or prefix in SKIP_SECTIONS:
+            return
+        for key, value in section.items():
+            if key in SKIP_KEYS or key in EXCLUDE_KEYS:
+                continue
+            metric = prefix + '.' + key
+            if isinstance(value, dict):
+                self.observeSection(metric, value, now)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.observe(metric, float(value), now)
+
+    def getMetricNames(self):
+        with self.lock:
+            return sorted(self.metrics)
+
+    def getMetric(self, metric, now):
+        with self.lock:
+            stats = self.metrics.get(metric)
+            if stats is None:
+                return None
+            return stats.get(now)
+
+    def getSummary(self, now):
+        """Window statistics of the snapshot metrics, for the 'rolling' section"""
+        with self.lock:
+            return {metric: stats.get(now) for metric, stats in self.metrics.items() if self.inSnapshot[metric]}
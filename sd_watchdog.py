@@ -0,0 +1,84 @@
+"""
+systemd notify / watchdog support
+
+With Type=notify and WatchdogSec= in the unit file, systemd sets
+NOTIFY_SOCKET and WATCHDOG_USEC and restarts the service if it does not get
+a WATCHDOG=1 message in time.  The keep-alive is only sent while the stats
+collection (or in aggregator mode the fleet heartbeat) reports progress,
+so a wedged pipeline gets the service restarted even though the process
+is still alive.
+
+Ref: https://www.freedesktop.org/software/systemd/man/sd_notify.html
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def sd_notify(message):
+    """Send a notification to systemd, returns False when not running under systemd"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address[0] == '@':
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.connect(address)
+            sock.sendall(message.encode('utf-8'))
+    except OSError as e:
+        logger.error("sd_notify failed: %s", e)
+        return False
+    return True
+
+
+class Watchdog:
+
+    def __init__(self):
+        watchdogUsec = os.environ.get('WATCHDOG_USEC')
+        watchdogPid = os.environ.get('WATCHDOG_PID')
+        self.timeout = None
+        if watchdogUsec and (not watchdogPid or int(watchdogPid) == os.getpid()):
+            self.timeout = int(watchdogUsec) / 1e6
+        self.lastProgress = time.monotonic()
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        sd_notify("READY=1")
+        if self.timeout is None:
+            return
+        logger.info("systemd watchdog enabled, timeout %0.1f sec", self.timeout)
+        self.thread = threading.Thread(target=self.watchdogThread, name='watchdog')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        sd_notify("STOPPING=1")
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def progress(self, status=None):
+        """Called each time a stats cycle produced fresh data (or the fleet heartbeat came back)"""
+        self.lastProgress = time.monotonic()
+        if status is not None:
+            sd_notify("STATUS=" + status)
+
+    def watchdogThread(self):
+        # Ping at half the timeout as recommended by sd_watchdog_enabled(3)
+        interval = self.timeout / 2
+        while not self.thread_stop.wait(interval):
+            sinceProgress = time.monotonic() - self.lastProgress
+            if sinceProgress < self.timeout:
+                sd_notify("WATCHDOG=1")
+            else:
+                logger.error("No stats progress for %0.0f sec, withholding watchdog keep-alive", sinceProgress)
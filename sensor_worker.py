@@ -0,0 +1,299 @@
+"""
+Run the collectors in a separate worker process
+
+All the sensor I/O (I2C, smartctl, psutil) runs in a child process, so a
+burst of HTTP requests can't slow down sampling and a hung or crashing
+sensor driver can't take the HTTP/MQTT side down with it.  The worker
+writes every snapshot into a shared memory block protected by a seqlock;
+the serving process reads it without locks, pipes or pickling and decodes
+it only once per new snapshot.
+
+Shared memory layout (fixed, little endian):
+
+    offset 0   uint64  seq            odd while the worker is writing
+    offset 8   double  timestampEpoc
+    offset 16  uint32  length         of the payload
+    offset 20  bytes   payload        JSON encoded snapshot
+
+Alert transitions, watchdog progress and the birth message are rare and
+small, they are sent to the serving process over a multiprocessing queue.
+
+Config (config.yml):
+    worker:
+      enabled: true
+      shmSize: 1048576
+"""
+
+import logging
+import os
+import signal
+import struct
+import threading
+import time
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+from nas_stats import NasStats
+from payload_encoding import encodePayload, decodePayload
+from snapshot import formatTimestamp
+
+logger = logging.getLogger(__name__)
+
+
+SHM_HEADER = struct.Struct('<QdI')
+SHM_SEQ = struct.Struct('<Q')
+DEFAULT_SHM_SIZE = 1024 * 1024
+# A reader gives up (and keeps its previous copy) after this many torn reads
+SEQLOCK_MAX_RETRIES = 100
+
+WORKER_STOP_TIMEOUT_SECONDS = 15
+WORKER_RESTART_MIN_SECONDS = 5
+WORKER_RESTART_MAX_SECONDS = 300
+
+
+class SharedSnapshot:
+    """Single writer, many readers snapshot buffer in shared memory"""
+
+    def __init__(self, name=None, size=DEFAULT_SHM_SIZE, create=False):
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            SHM_HEADER.pack_into(self.shm.buf, 0, 0, 0.0, 0)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.capacity = self.shm.size - SHM_HEADER.size
+        self.seq = SHM_SEQ.unpack_from(self.shm.buf, 0)[0]
+
+    def write(self, payload, timestampEpoc):
+        """Writer side, returns False if the payload does not fit"""
+        length = len(payload)
+        if length > self.capacity:
+            logger.error("Snapshot of %d bytes does not fit in shared memory (%d bytes)", length, self.capacity)
+            return False
+        buf = self.shm.buf
+        # Odd: readers retry until the write is complete
+        self.seq += 1
+        SHM_SEQ.pack_into(buf, 0, self.seq)
+        buf[SHM_HEADER.size:SHM_HEADER.size + length] = payload
+        SHM_HEADER.pack_into(buf, 0, self.seq, timestampEpoc, length)
+        self.seq += 1
+        SHM_SEQ.pack_into(buf, 0, self.seq)
+        return True
+
+    def read(self, lastSeq=None):
+        """
+        Reader side.  Returns (seq, timestampEpoc, payload bytes), or None if
+        nothing new has been written since lastSeq (or no consistent copy
+        could be taken).
+        """
+        buf = self.shm.buf
+        for attempt in range(SEQLOCK_MAX_RETRIES):
+            seq, timestampEpoc, length = SHM_HEADER.unpack_from(buf, 0)
+            if seq == 0 or seq == lastSeq:
+                return None
+            if seq & 1:
+                time.sleep(0)
+                continue
+            payload = bytes(buf[SHM_HEADER.size:SHM_HEADER.size + min(length, self.capacity)])
+            if SHM_SEQ.unpack_from(buf, 0)[0] == seq:
+                return seq, timestampEpoc, payload
+        logger.warning("No consistent snapshot after %d attempts", SEQLOCK_MAX_RETRIES)
+        return None
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class _WorkerPubsub:
+    """Stands in for Pubsub inside the worker process"""
+
+    def __init__(self, snapshot, events):
+        self.snapshot = snapshot
+        self.events = events
+
+    def setDeviceBirthMsg(self, msg):
+        self.events.put(('pubsub', 'setDeviceBirthMsg', msg))
+
+    def publishCurrentState(self, stats):
+        self.snapshot.write(encodePayload(stats), stats.get('timestampEpoc', time.time()))
+
+    def publishAlert(self, event):
+        self.events.put(('pubsub', 'publishAlert', event))
+
+
+class _WorkerWatchdog:
+    """Progress is passed on to the serving process, which pings systemd"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def progress(self, status=None):
+        self.events.put(('watchdog', 'progress', status))
+
+
+class _WorkerHost:
+    """The parts of NasMon that NasStats uses, for the worker process"""
+
+    def __init__(self, config, pubsub, events):
+        self.config = config
+        self.pubsub = pubsub
+        self.exporters = []
+        self.watchdog = _WorkerWatchdog(events)
+
+
+def runWorker(config, shmName, events, stop):
+    """Entry point of the worker process"""
+
+    logConfig = config.get('logging', {})
+    logging.basicConfig(level=logConfig.get('level', 'INFO'),
+                        format='%(asctime)-15s worker %(threadName)-10s %(levelname)6s %(message)s')
+    # The serving process decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    snapshot = SharedSnapshot(name=shmName)
+    parentPid = os.getppid()
+    nasStats = NasStats(_WorkerHost(config, _WorkerPubsub(snapshot, events), events))
+    nasStats.startup()
+    # Also exit if the serving process went away without telling us
+    while not stop.wait(5):
+        if os.getppid() != parentPid:
+            logger.error("Serving process is gone, worker exiting")
+            break
+    nasStats.shutdown()
+    snapshot.close()
+
+
+class SensorWorker:
+    """
+    Drop-in for NasStats in the serving process: starts (and restarts) the
+    worker process, forwards its snapshots to MQTT and the exporters, and
+    serves getStats() from shared memory.
+    """
+
+    def __init__(self, _nasMon):
+        self.nasMon = _nasMon
+        workerConfig = self.nasMon.config.get('worker', {})
+        # spawn: a clean interpreter, none of our threads or sockets are inherited
+        self.context = multiprocessing.get_context('spawn')
+        self.snapshot = SharedSnapshot(size=workerConfig.get('shmSize', DEFAULT_SHM_SIZE), create=True)
+        self.events = None
+        self.stop = None
+        self.process = None
+        self.restartDelay = WORKER_RESTART_MIN_SECONDS
+        self.restartTime = None
+
+        # Spin-up waveforms stay in the worker process, /v1/power/bursts is not available
+        self.burstCapture = None
+        # Same for the full window statistics (the snapshot still has 'rolling')
+        self.rollingStats = None
+
+        self.stats_lock = threading.Lock()
+        self.stats_cache = None
+        self.stats_seq = None
+        self.published_seq = None
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        logger.info('SensorWorker Startup...')
+        self.startProcess()
+        self.thread = threading.Thread(target=self.forwardThread, name='sensorWorker')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        logger.info('SensorWorker Shutdown...')
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+        self.stopProcess()
+        self.snapshot.close()
+        self.snapshot.unlink()
+
+        now = time.time()
+        stats = {
+            'timestampEpoc': now,
+            'timestamp': formatTimestamp(now),
+            'state': 'shutdown'
+        }
+        self.nasMon.pubsub.publishCurrentState( stats )
+
+    def startProcess(self):
+        # New ones for every process: a worker that died while holding the
+        # queue lock or waiting on the event leaves them unusable
+        self.events = self.context.Queue()
+        self.stop = self.context.Event()
+        self.process = self.context.Process(target=runWorker, name='nasmon-worker',
+                                            args=(self.nasMon.config, self.snapshot.name, self.events, self.stop))
+        self.process.daemon = True
+        self.process.start()
+        logger.info("Sensor worker started pid:%d", self.process.pid)
+
+    def stopProcess(self):
+        if self.process is None:
+            return
+        self.stop.set()
+        self.process.join(WORKER_STOP_TIMEOUT_SECONDS)
+        if self.process.is_alive():
+            logger.error("Sensor worker did not stop, killing it")
+            self.process.kill()
+            self.process.join()
+        self.process = None
+
+    def checkProcess(self, now):
+        """Restart a dead worker, backing off while it keeps dying"""
+        if self.process.is_alive():
+            return
+        if self.restartTime is None:
+            logger.error("Sensor worker exited with code %s, restarting in %d sec",
+                         self.process.exitcode, self.restartDelay)
+            self.restartTime = now + self.restartDelay
+            self.restartDelay = min(self.restartDelay * 2, WORKER_RESTART_MAX_SECONDS)
+        elif now >= self.restartTime:
+            self.restartTime = None
+            self.startProcess()
+
+    def forwardThread(self):
+        while not self.thread_stop.is_set():
+            try:
+                # ('pubsub', 'publishAlert', event), ('watchdog', 'progress', status), ...
+                target, method, payload = self.events.get(timeout=1.0)
+                getattr(getattr(self.nasMon, target), method)(payload)
+                if target == 'watchdog':
+                    # Worker is producing fresh data again
+                    self.restartDelay = WORKER_RESTART_MIN_SECONDS
+            except queue.Empty:
+                pass
+
+            seq, data = self.readSnapshot()
+            if data is not None and seq != self.published_seq:
+                self.published_seq = seq
+                self.nasMon.pubsub.publishCurrentState( data )
+                for exporter in self.nasMon.exporters:
+                    exporter.publish( data )
+
+            self.checkProcess(time.monotonic())
+        logger.info('sensorWorker thread EXITING')
+
+    def readSnapshot(self):
+        """Returns (seq, stats) of the latest snapshot, decoding it only if it is new"""
+        with self.stats_lock:
+            result = self.snapshot.read(self.stats_seq)
+            if result is not None:
+                seq, timestampEpoc, payload = result
+                self.stats_seq = seq
+                self.stats_cache = decodePayload(payload)
+            return self.stats_seq, self.stats_cache
+
+    def getStats(self, sections=None, maxAge=None):
+        # Readers never trigger a collection (sections and maxAge are ignored),
+        # they get the worker's latest snapshot
+        seq, stats = self.readSnapshot()
+        return stats if stats is not None else {}
@@ -0,0 +1,273 @@
+"""
+NFS and SMB server activity, for the 'services' section
+
+NFS: the nfsd counters in /proc/net/rpc/nfsd are read every collection and
+turned into rates against the previous sample (like the diskstats), no
+subprocess involved:
+
+    io <bytes read> <bytes written>
+    th <threads> ...
+    rpc <calls> <bad calls> ...
+    proc3 22 <null> <getattr> ...        one counter per NFSv3 procedure
+    proc4ops 76 <0> <0> <0> <access> ... one counter per NFSv4 operation
+
+Thread utilization comes from /proc/fs/nfsd/pool_stats: queued_percent is
+the share of incoming requests that found no idle nfsd thread and had to
+wait (the kernel no longer fills the 'th' histogram).
+
+SMB: "smbstatus --json" (Samba 4.16+) takes a while and scales with the
+number of open files, so it is never run by the collection: a background
+thread runs it at most every sambaIntervalSeconds and the collection only
+picks up the last counts (with their age).
+
+Config (config.yml):
+    services:
+      samba: true
+      sambaIntervalSeconds: 60
+
+Ref: https://www.kernel.org/doc/html/latest/filesystems/nfs/knfsd-stats.html
+"""
+
+import json
+import logging
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+NFSD_STATS_PATH = '/proc/net/rpc/nfsd'
+NFSD_POOL_STATS_PATH = '/proc/fs/nfsd/pool_stats'
+SMBSTATUS_CMD = ['smbstatus', '--json']
+SMBSTATUS_TIMEOUT_SECONDS = 30
+SAMBA_INTERVAL_SECONDS = 60
+
+# Procedure / operation names by index, from <linux/nfs3.h> and <linux/nfs4.h>
+NFS3_PROCEDURES = (
+    'null', 'getattr', 'setattr', 'lookup', 'access', 'readlink', 'read', 'write', 'create',
+    'mkdir', 'symlink', 'mknod', 'remove', 'rmdir', 'rename', 'link', 'readdir', 'readdirplus',
+    'fsstat', 'fsinfo', 'pathconf', 'commit',
+)
+NFS4_OPERATIONS = (
+    None, None, None, 'access', 'close', 'commit', 'create', 'delegpurge', 'delegreturn',
+    'getattr', 'getfh', 'link', 'lock', 'lockt', 'locku', 'lookup', 'lookupp', 'nverify',
+    'open', 'openattr', 'open_confirm', 'open_downgrade', 'putfh', 'putpubfh', 'putrootfh',
+    'read', 'readdir', 'readlink', 'remove', 'rename', 'renew', 'restorefh', 'savefh',
+    'secinfo', 'setattr', 'setclientid', 'setclientid_confirm', 'verify', 'write',
+    'release_lockowner',
+    # NFSv4.1
+    'backchannel_ctl', 'bind_conn_to_session', 'exchange_id', 'create_session',
+    'destroy_session', 'free_stateid', 'get_dir_delegation', 'getdeviceinfo', 'getdevicelist',
+    'layoutcommit', 'layoutget', 'layoutreturn', 'secinfo_no_name', 'sequence', 'set_ssv',
+    'test_stateid', 'want_delegation', 'destroy_clientid', 'reclaim_complete',
+    # NFSv4.2
+    'allocate', 'copy', 'copy_notify', 'deallocate', 'io_advise', 'layouterror', 'layoutstats',
+    'offload_cancel', 'offload_status', 'read_plus', 'seek', 'write_same', 'clone',
+    'getxattr', 'setxattr', 'listxattrs', 'removexattr',
+)
+# Session bookkeeping, not client work
+NFS4_HOUSEKEEPING = frozenset(('putfh', 'putrootfh', 'putpubfh', 'savefh', 'restorefh', 'getfh', 'sequence'))
+
+
+def parseNfsdStats(text):
+    """
+    Counters of /proc/net/rpc/nfsd: {'calls', 'read_bytes', 'write_bytes',
+    'threads', 'ops': {name: count}}, NFSv3 and NFSv4 counts of the same
+    operation (read, write, getattr, ...) are added up
+    """
+    counters = {'calls': 0, 'read_bytes': 0, 'write_bytes': 0, 'threads': 0}
+    ops = counters['ops'] = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        tag = fields[0]
+        if tag == 'io':
+            counters['read_bytes'] = int(fields[1])
+            counters['write_bytes'] = int(fields[2])
+        elif tag == 'th':
+            counters['threads'] = int(fields[1])
+        elif tag == 'rpc':
+            counters['calls'] = int(fields[1])
+        elif tag in ('proc3', 'proc4ops'):
+            # proc3 <count> <counter>...
+            names = NFS3_PROCEDURES if tag == 'proc3' else NFS4_OPERATIONS
+            for index, value in enumerate(fields[2:]):
+                name = names[index] if index < len(names) else 'op{}'.format(index)
+                if name is None or name == 'null' or name in NFS4_HOUSEKEEPING:
+                    continue
+                ops[name] = ops.get(name, 0) + int(value)
+    return counters
+
+
+def parsePoolStats(text):
+    """(packets arrived, sockets enqueued) of /proc/fs/nfsd/pool_stats, all pools"""
+    arrived = 0
+    enqueued = 0
+    for line in text.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        # pool packets-arrived sockets-enqueued threads-woken threads-timedout
+        fields = line.split()
+        arrived += int(fields[1])
+        enqueued += int(fields[2])
+    return arrived, enqueued
+
+
+def readFile(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class NfsdStats:
+    """nfsd rates since the previous sample"""
+
+    def __init__(self, statsPath=NFSD_STATS_PATH, poolStatsPath=NFSD_POOL_STATS_PATH):
+        self.statsPath = statsPath
+        self.poolStatsPath = poolStatsPath
+        self.previous = None
+        self.previousPool = None
+        self.previousTime = None
+
+    def sample(self):
+        """The 'nfs' dict, None if the NFS server is not running"""
+        text = readFile(self.statsPath)
+        if text is None:
+            self.previous = None
+            return None
+        now = time.monotonic()
+        counters = parseNfsdStats(text)
+        poolText = readFile(self.poolStatsPath)
+        pool = parsePoolStats(poolText) if poolText is not None else None
+
+        result = {'threads': counters['threads']}
+        previous = self.previous
+        elapsed = now - self.previousTime if previous is not None else 0
+        # Counters going backwards: nfsd was restarted, no baseline
+        if elapsed > 0 and counters['calls'] >= previous['calls']:
+            for name in ('calls', 'read_bytes', 'write_bytes'):
+                result[name + '_per_sec'] = round((counters[name] - previous[name]) / elapsed, 2)
+            previousOps = previous['ops']
+            result['ops'] = {name: round((count - previousOps.get(name, 0)) / elapsed, 2)
+                             for name, count in counters['ops'].items()
+                             if count > previousOps.get(name, 0)}
+            if pool is not None and self.previousPool is not None:
+                arrived = pool[0] - self.previousPool[0]
+                if arrived > 0:
+                    result['queued_percent'] = round((pool[1] - self.previousPool[1]) / arrived * 100, 1)
+        self.previous = counters
+        self.previousPool = pool
+        self.previousTime = now
+        return result
+
+
+def parseSmbstatus(data):
+    """Session and share counts from "smbstatus --json" output"""
+    status = json.loads(data)
+    sessions = (status.get('sessions') or {}).values()
+    tcons = (status.get('tcons') or {}).values()
+    shares = {}
+    for tcon in tcons:
+        service = tcon.get('service')
+        # Every session connects to IPC$
+        if service is not None and service != 'IPC$':
+            shares[service] = shares.get(service, 0) + 1
+    return {
+        'sessions': len(sessions),
+        'users': len({session.get('username') for session in sessions}),
+        'machines': len({session.get('remote_machine') for session in sessions}),
+        'open_files': sum(len(openFile.get('opens') or {})
+                          for openFile in (status.get('open_files') or {}).values()),
+        'shares': shares,
+    }
+
+
+class SambaStatus:
+    """Runs smbstatus in the background, the collection gets the last counts"""
+
+    def __init__(self, interval=SAMBA_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stats = None
+        self.statsTime = None
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    def startup(self):
+        self.thread = threading.Thread(target=self.smbstatusThread, name='smbstatus')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+
+    def smbstatusThread(self):
+        while not self.thread_stop.is_set():
+            if not self.refresh():
+                break
+            self.thread_stop.wait(self.interval)
+        logger.info('smbstatus thread EXITING')
+
+    def refresh(self):
+        """Returns False if smbstatus can't be run at all"""
+        try:
+            p = subprocess.run(SMBSTATUS_CMD, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               timeout=SMBSTATUS_TIMEOUT_SECONDS)
+        except FileNotFoundError:
+            logger.info("No smbstatus, Samba is not reported")
+            return False
+        except subprocess.TimeoutExpired:
+            logger.error("smbstatus did not finish within %d sec", SMBSTATUS_TIMEOUT_SECONDS)
+            return True
+        if p.returncode != 0:
+            logger.error("smbstatus returncode: %d %s", p.returncode, p.stderr.strip()[:200])
+            return True
+        try:
+            stats = parseSmbstatus(p.stdout)
+        except (ValueError, AttributeError) as e:
+            # Samba before 4.16 has no --json
+            logger.error("Unable to parse smbstatus output: %s", e)
+            return True
+        with self.lock:
+            self.stats = stats
+            self.statsTime = time.monotonic()
+        return True
+
+    def getStats(self):
+        """The last counts with their age in seconds, None if there are none"""
+        with self.lock:
+            if self.stats is None:
+                return None
+            return dict(self.stats, age=round(time.monotonic() - self.statsTime, 1))
+
+
+class ServicesMonitor:
+
+    def __init__(self, config):
+        self.nfsd = NfsdStats()
+        self.samba = None
+        if config.get('samba', True):
+            self.samba = SambaStatus(config.get('sambaIntervalSeconds', SAMBA_INTERVAL_SECONDS))
+
+    def startup(self):
+        if self.samba is not None:
+            self.samba.startup()
+
+    def shutdown(self):
+        if self.samba is not None:
+            self.samba.shutdown()
+
+    def collect(self):
+        """The 'services' section"""
+        return {
+            'nfs': self.nfsd.sample(),
+            'smb': self.samba.getStats() if self.samba is not None else None,
+        }
@@ -0,0 +1,220 @@
+"""
+Spin-state-aware SMART polling
+
+USB drives on the NAS spin down when idle.  Running smartctl against a
+drive in standby will spin it back up, so we only query SMART when we can
+tell the drive is already spinning.
+
+The spin state is inferred from /sys/block/<dev>/stat:
+   field 9  - I/Os currently in flight
+   field 10 - io_ticks, milliseconds spent doing I/Os
+If anything is in flight, or io_ticks advanced since the last look, the
+drive has done real I/O recently and is spinning.
+
+Optionally smartctl is asked for the power mode with "-n standby", which
+returns without issuing any command that would wake the drive.
+
+Ref: https://www.kernel.org/doc/Documentation/block/stat.txt
+"""
+
+import logging
+import time
+import subprocess
+import json
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Never query SMART more often than this for a single drive
+SMART_MIN_INTERVAL_SECONDS = 300
+# If the last SMART sample is older than this, try to refresh it as soon as
+# the drive is known to be spinning (or a standby probe says it is active)
+SMART_MAX_STALENESS_SECONDS = 1800
+# If no I/O has happened for this long we assume the drive may have spun down
+IDLE_ASSUME_STANDBY_SECONDS = 600
+
+# smartctl exit code used when "-n standby,N" finds the drive in standby
+SMARTCTL_STANDBY_EXIT_CODE = 3
+
+STATE_ACTIVE = 'active'
+STATE_IDLE = 'idle'
+STATE_STANDBY = 'standby'
+STATE_UNKNOWN = 'unknown'
+
+
+def readBlockStat(kname):
+    """
+    Return (in_flight, io_ticks) for the block device kname (e.g., 'sda')
+    or None if the device does not exist.
+    """
+    try:
+        with open("/sys/block/{}/stat".format(kname), 'r') as f:
+            fields = f.read().split()
+    except OSError:
+        return None
+    return int(fields[8]), int(fields[9])
+
+
+def probeStandby(deviceName):
+    """
+    Ask the drive for its power mode without waking it.
+    Returns True if the drive is in standby, False if it is spinning and
+    None if it could not be determined.
+    """
+    cmd = ["smartctl", "-n", "standby,{}".format(SMARTCTL_STANDBY_EXIT_CODE), "-i", deviceName]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error("probeStandby %s failed: %s", deviceName, e)
+        return None
+    if p.returncode == SMARTCTL_STANDBY_EXIT_CODE:
+        return True
+    # Bit 0 and 1 of the exit status mean the command line or the device open failed
+    if p.returncode & 0x03:
+        return None
+    return False
+
+
+def readSmartTemperature(deviceName):
+    """
+    Read current, highest and lowest temperature from the device statistics log.
+    The query itself carries "-n standby" so it can never be the thing that
+    spins a sleeping drive up.  Returns None if the drive was in standby or
+    the values could not be read.
+    """
+    cmd = ["smartctl", "-n", "standby,{}".format(SMARTCTL_STANDBY_EXIT_CODE),
+           "-l", "devstat,0x05", "--json", deviceName]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           universal_newlines=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error("readSmartTemperature %s failed: %s", deviceName, e)
+        return None
+    if p.returncode == SMARTCTL_STANDBY_EXIT_CODE:
+        return None
+    try:
+        output = json.loads(p.stdout)
+    except ValueError:
+        logger.error("readSmartTemperature %s returned invalid json", deviceName)
+        return None
+
+    values = {}
+    for page in output.get('ata_device_statistics', {}).get('pages', []):
+        for entry in page.get('table', []):
+            values[entry.get('name')] = entry.get('value')
+
+    current = values.get('Current Temperature')
+    if current is None:
+        # Fall back to the generic temperature block (e.g., some USB bridges)
+        current = output.get('temperature', {}).get('current')
+        if current is None:
+            return None
+    return current, values.get('Highest Temperature'), values.get('Lowest Temperature')
+
+
+class DriveState:
+    """Per-drive scheduling state"""
+
+    def __init__(self, deviceName):
+        self.deviceName = deviceName
+        self.state = STATE_UNKNOWN
+        self.lastIoTicks = None
+        self.lastIoTime = None
+        self.lastPollTime = 0
+        self.lastSampleTime = None
+        self.temperature = None
+
+
+class SmartScheduler:
+    """
+    Decide when each drive may be queried via SMART and keep the last known values.
+    """
+
+    def __init__(self, minInterval=SMART_MIN_INTERVAL_SECONDS,
+                 maxStaleness=SMART_MAX_STALENESS_SECONDS,
+                 useStandbyProbe=False,
+                 readStat=readBlockStat,
+                 readTemperature=readSmartTemperature,
+                 isStandby=probeStandby):
+        self.minInterval = minInterval
+        self.maxStaleness = maxStaleness
+        self.useStandbyProbe = useStandbyProbe
+        self.readStat = readStat
+        self.readTemperature = readTemperature
+        self.isStandby = isStandby
+        self.drives = {}
+        self.lock = threading.Lock()
+
+    def updateSpinState(self, drive, kname, now):
+        stat = self.readStat(kname)
+        if stat is None:
+            drive.state = STATE_UNKNOWN
+            return
+        inFlight, ioTicks = stat
+        if inFlight > 0 or (drive.lastIoTicks is not None and ioTicks != drive.lastIoTicks):
+            drive.state = STATE_ACTIVE
+            drive.lastIoTime = now
+        elif drive.lastIoTime is None:
+            # First look at the drive and no I/O in flight, we can't tell yet
+            drive.state = STATE_UNKNOWN
+        elif (now - drive.lastIoTime) >= IDLE_ASSUME_STANDBY_SECONDS:
+            drive.state = STATE_STANDBY
+        else:
+            drive.state = STATE_IDLE
+        drive.lastIoTicks = ioTicks
+
+    def shouldPoll(self, drive, now):
+        sinceLastPoll = now - drive.lastPollTime
+        if sinceLastPoll < self.minInterval:
+            return False
+        if drive.state == STATE_ACTIVE:
+            return True
+        stale = drive.lastSampleTime is None or (now - drive.lastSampleTime) >= self.maxStaleness
+        if stale and drive.state == STATE_IDLE:
+            # Drive did I/O within the standby window so it is still spinning
+            return True
+        if stale and self.useStandbyProbe:
+            drive.lastPollTime = now
+            standby = self.isStandby(drive.deviceName)
+            if standby is False:
+                drive.state = STATE_ACTIVE
+                return True
+            if standby is True:
+                drive.state = STATE_STANDBY
+        return False
+
+    def getDriveInfo(self, kname, now=None):
+        """
+        Update the drive state for the block device kname (e.g., 'sda') and
+        return a dict with the last known SMART values and their age.
+        """
+        if now is None:
+            now = time.time()
+        deviceName = "/dev/{}".format(kname)
+        with self.lock:
+            drive = self.drives.get(kname)
+            if drive is None:
+                drive = DriveState(deviceName)
+                self.drives[kname] = drive
+
+            self.updateSpinState(drive, kname, now)
+            if self.shouldPoll(drive, now):
+                drive.lastPollTime = now
+                temperature = self.readTemperature(deviceName)
+                if temperature is not None:
+                    drive.temperature = temperature
+                    drive.lastSampleTime = now
+
+            info = {'drive_state': drive.state}
+            if drive.temperature is not None:
+                tempCurrent, tempMax, tempMin = drive.temperature
+                info['temperature_current'] = tempCurrent
+                info['temperature_max'] = tempMax
+                info['temperature_min'] = tempMin
+                info['temperature_age'] = round(now - drive.lastSampleTime, 1)
+            return info
+
+    def forgetDrive(self, kname):
+        with self.lock:
+            self.drives.pop(kname, None)
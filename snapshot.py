@@ -0,0 +1,208 @@
+"""
+Fixed-schema stats snapshot
+
+The collectors fill small __slots__ objects (no per-instance __dict__)
+instead of building nested dicts every cycle.  The snapshot itself is what
+NasStats keeps; formatted values such as 'timestamp' and 'uptimeFmt' are
+only produced when a consumer at the edges (MQTT, HTTP, exporters) asks for
+the dict with toDict(), which is done once per snapshot and cached, so all
+consumers share the same dict.
+
+The core (rolling statistics, sampling rates, alerts) reads single sections
+with get().  A section is converted at most once, and a section the
+collector did not sample again (the same object as in the previous
+snapshot) reuses the previous snapshot's dict, so unchanged sections are
+shared between consecutive snapshots.
+"""
+
+import datetime
+
+import pytz
+
+
+TIMEZONE = pytz.timezone("America/Denver")
+
+
+def formatTimestamp(epoc):
+    return datetime.datetime.fromtimestamp(epoc, TIMEZONE).strftime('%Y-%m-%d %H:%M:%S.%f%z')
+
+
+class StatsSection:
+    """Base for a fixed set of fields, all initialised to None"""
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def toDict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def fromDict(cls, values):
+        """Rebuild from toDict() output (e.g., a saved snapshot), derived values are ignored"""
+        return cls(**values)
+
+
+class OsStats(StatsSection):
+
+    __slots__ = ('cpuPercent', 'cpuFreq', 'cpuTemperature', 'memoryUsedPercent',
+                 'bootTimestampEpoc', 'uptime', 'monUptime')
+
+    def toDict(self):
+        return {
+            "cpuPercent": self.cpuPercent,
+            "cpuFreq": self.cpuFreq,
+            "cpuTemperature": self.cpuTemperature,
+            "memoryUsedPercent": self.memoryUsedPercent,
+            "bootTimestampEpoc": self.bootTimestampEpoc,
+            "uptime": self.uptime,
+            "uptimeFmt": str(datetime.timedelta(seconds=round(self.uptime))),
+            "monUptime": self.monUptime,
+            "monUptimeFmt": str(datetime.timedelta(seconds=round(self.monUptime))),
+        }
+
+
+class EnclosureStats(StatsSection):
+
+    __slots__ = ('temperature1', 'humidity1', 'temperature2', 'humidity2', 'pressure')
+
+
+class PowerStats(StatsSection):
+
+    __slots__ = ('rpi_psu_voltage', 'rpi_current', 'rpi_bus_voltage',
+                 'drive1_psu_voltage', 'drive1_current', 'drive1_bus_voltage',
+                 'drive2_psu_voltage', 'drive2_current', 'drive2_bus_voltage',
+                 'watts')
+
+
+class FilesystemStats(StatsSection):
+    """
+    One mounted filesystem.  Optional values that only some drives have
+    (SMART temperatures, share usage, ...) go in 'extra'.
+    """
+
+    __slots__ = ('label', 'kname', 'path', 'mountpoint', 'pkname',
+                 'read_bytes', 'write_bytes',
+                 'spacetotal', 'spaceused', 'spaceavail', 'spaceusedpercent',
+                 'activity_read', 'activity_write', 'extra')
+
+    def toDict(self):
+        result = {name: getattr(self, name) for name in self.__slots__[:-1]}
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    @classmethod
+    def fromDict(cls, values):
+        extra = {key: value for key, value in values.items() if key not in cls.__slots__}
+        filesystem = cls(**values)
+        filesystem.extra = extra or None
+        return filesystem
+
+
+# Sections held as StatsSection objects, the others are plain values
+OBJECT_SECTIONS = ('os', 'enclosure', 'power')
+
+
+def convertSection(name, value):
+    if value is None:
+        return None
+    if name in OBJECT_SECTIONS:
+        return value.toDict()
+    if name == 'filesystem':
+        return {label: fs.toDict() for label, fs in value.items()}
+    return value
+
+
+class Snapshot:
+
+    __slots__ = ('timestampEpoc', 'collectStatsDuration', 'os', 'enclosure', 'power',
+                 'filesystem', 'throttle', 'stale', 'sampling', 'spinup', 'rolling', 'services', 'cgroups',
+                 'alerts', 'restored', '_sections', '_previousSections', '_dict')
+
+    def __init__(self, timestampEpoc, collectStatsDuration, os, enclosure, power,
+                 filesystem, throttle, stale, sampling=None, spinup=None, services=None, cgroups=None,
+                 previous=None):
+        self.timestampEpoc = timestampEpoc
+        self.collectStatsDuration = collectStatsDuration
+        self.os = os
+        self.enclosure = enclosure
+        self.power = power
+        # label -> FilesystemStats
+        self.filesystem = filesystem
+        self.throttle = throttle
+        self.stale = stale
+        # collector name -> current sampling interval (seconds)
+        self.sampling = sampling
+        # drive -> spin-up counters (burst capture)
+        self.spinup = spinup
+        # metric -> window statistics (rolling_stats.py)
+        self.rolling = None
+        # NFS and SMB server activity (services_stats.py)
+        self.services = services
+        # Per service and container CPU, memory and I/O (cgroup_stats.py)
+        self.cgroups = cgroups
+        # Firing alert rules (alerts.py)
+        self.alerts = None
+        # Last snapshot of the previous run (warm restart)
+        self.restored = False
+        # name -> (value, converted value)
+        self._sections = {}
+        # Only the previous snapshot's conversions are kept, not the snapshot (no chain)
+        self._previousSections = previous._sections if previous is not None else None
+        self._dict = None
+
+    def get(self, name, default=None):
+        """One section converted like in toDict(), e.g. for flattenMetrics()"""
+        value = getattr(self, name, None)
+        cached = self._sections.get(name)
+        if cached is None and self._previousSections is not None:
+            cached = self._previousSections.get(name)
+        if cached is not None and cached[0] is value:
+            converted = cached[1]
+        else:
+            converted = convertSection(name, value)
+        self._sections[name] = (value, converted)
+        return converted if converted is not None else default
+
+    def toDict(self):
+        """Convert for the edges, done once and shared by all consumers"""
+        if self._dict is None:
+            result = {
+                'timestampEpoc': self.timestampEpoc,
+                'timestamp': formatTimestamp(self.timestampEpoc),
+                'collectStatsDuration': self.collectStatsDuration,
+                'os': self.get('os'),
+                'enclosure': self.get('enclosure'),
+                'power': self.get('power'),
+                'filesystem': self.get('filesystem', {}),
+                'throttle': self.throttle,
+                'stale': self.stale,
+                'sampling': self.sampling,
+                'spinup': self.spinup,
+                'rolling': self.rolling,
+                'services': self.get('services'),
+                'cgroups': self.get('cgroups'),
+                'alerts': self.alerts,
+            }
+            if self.restored:
+                result['restored'] = True
+            self._dict = result
+        return self._dict
+
+    @classmethod
+    def fromDict(cls, values):
+        """Rebuild from toDict() output (a saved snapshot)"""
+        sections = {}
+        for name, sectionClass in (('os', OsStats), ('enclosure', EnclosureStats), ('power', PowerStats)):
+            sections[name] = sectionClass.fromDict(values[name]) if values.get(name) else None
+        filesystem = {label: FilesystemStats.fromDict(fs) for label, fs in (values.get('filesystem') or {}).items()}
+        snapshot = cls(values['timestampEpoc'], values.get('collectStatsDuration'),
+                       sections['os'], sections['enclosure'], sections['power'], filesystem,
+                       values.get('throttle'), values.get('stale'), sampling=values.get('sampling'),
+                       spinup=values.get('spinup'), services=values.get('services'), cgroups=values.get('cgroups'))
+        snapshot.rolling = values.get('rolling')
+        snapshot.alerts = values.get('alerts')
+        return snapshot
@@ -0,0 +1,153 @@
+"""
+In-memory cache of the dashboard files in static/
+
+Each file is read once and kept with a gzip variant (and a brotli one when
+the package is installed) if it compresses well, so a request costs no
+open(), stat() or compression.  Every variant has a strong ETag, a
+matching If-None-Match gets a 304.  Files above SENDFILE_MIN_BYTES are not
+kept in memory, their uncompressed variant is sent from the file with
+sendfile (zero copy).  The files are stat'ed at most every
+ASSET_RECHECK_SECONDS, so an edited file is picked up without a restart.
+
+Optional: sudo pip3 install brotli
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+SENDFILE_MIN_BYTES = 64 * 1024
+ASSET_RECHECK_SECONDS = 10
+# A compressed variant is only kept if it is at least this much smaller
+MIN_COMPRESSION_SAVING = 0.1
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.json': 'application/json',
+    '.svg': 'image/svg+xml',
+    '.ico': 'image/x-icon',
+    '.png': 'image/png',
+}
+COMPRESSIBLE_EXTENSIONS = frozenset(('.html', '.js', '.css', '.json', '.svg'))
+# The page is revalidated (a 304 most of the time) so a new version shows up at once
+CACHE_CONTROL = {
+    '.html': 'no-cache',
+}
+DEFAULT_CACHE_CONTROL = 'public, max-age=86400'
+
+ENCODING_IDENTITY = 'identity'
+ENCODING_GZIP = 'gzip'
+ENCODING_BROTLI = 'br'
+# Preferred first
+ENCODING_PREFERENCE = (ENCODING_BROTLI, ENCODING_GZIP, ENCODING_IDENTITY)
+
+
+class AssetVariant:
+
+    __slots__ = ('encoding', 'data', 'size', 'etag')
+
+    def __init__(self, encoding, data, size, etag):
+        self.encoding = encoding
+        # None: too large to keep, sent from the file
+        self.data = data
+        self.size = size
+        self.etag = etag
+
+
+class Asset:
+
+    def __init__(self, path):
+        self.path = path
+        extension = os.path.splitext(path)[1].lower()
+        self.contentType = CONTENT_TYPES.get(extension, 'application/octet-stream')
+        self.cacheControl = CACHE_CONTROL.get(extension, DEFAULT_CACHE_CONTROL)
+        self.compressible = extension in COMPRESSIBLE_EXTENSIONS
+        self.size = None
+        self.mtime = None
+        self.checked = 0
+        self.variants = {}
+
+    def load(self, stat):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:20]
+        variants = {ENCODING_IDENTITY: AssetVariant(ENCODING_IDENTITY, data if len(data) < SENDFILE_MIN_BYTES else None,
+                                                    len(data), '"{}"'.format(digest))}
+        if self.compressible:
+            # mtime=0: the same file always compresses to the same bytes
+            compressed = [(ENCODING_GZIP, gzip.compress(data, 9, mtime=0))]
+            if brotli is not None:
+                compressed.append((ENCODING_BROTLI, brotli.compress(data)))
+            for encoding, body in compressed:
+                if len(body) <= len(data) * (1 - MIN_COMPRESSION_SAVING):
+                    variants[encoding] = AssetVariant(encoding, body, len(body), '"{}-{}"'.format(digest, encoding))
+        self.variants = variants
+        self.size = len(data)
+        self.mtime = stat.st_mtime_ns
+        logger.info("Loaded %s (%d bytes, %s)", self.path, self.size, ', '.join(variants))
+
+    def refresh(self, now):
+        """Reload if the file changed, returns False if it is gone"""
+        if self.size is not None and now - self.checked < ASSET_RECHECK_SECONDS:
+            return True
+        self.checked = now
+        try:
+            stat = os.stat(self.path)
+            if stat.st_size != self.size or stat.st_mtime_ns != self.mtime:
+                self.load(stat)
+        except OSError as e:
+            logger.error("Static file %s: %s", self.path, e)
+            return False
+        return True
+
+    def selectVariant(self, acceptEncoding):
+        """The best variant for an Accept-Encoding header"""
+        accepted = {}
+        for item in (acceptEncoding or '').split(','):
+            name, _, params = item.strip().partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        for encoding in ENCODING_PREFERENCE:
+            variant = self.variants.get(encoding)
+            if variant is not None and (encoding == ENCODING_IDENTITY or accepted.get(encoding, 0) > 0):
+                return variant
+        return self.variants[ENCODING_IDENTITY]
+
+
+class AssetCache:
+
+    def __init__(self, directory=STATIC_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.assets = {}
+
+    def get(self, name):
+        """The Asset for a file in the static directory, None if it does not exist"""
+        with self.lock:
+            asset = self.assets.get(name)
+            if asset is None:
+                asset = self.assets[name] = Asset(os.path.join(self.directory, name))
+            if not asset.refresh(time.monotonic()):
+                del self.assets[name]
+                return None
+            return asset
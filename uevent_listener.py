@@ -0,0 +1,127 @@
+"""
+Block device hotplug events from the kernel (netlink kobject uevents)
+
+A USB drive that is unplugged, or comes back as a different /dev/sdX after
+a brownout, has to be forgotten: its SMART capability, its spin state, its
+diskstats baseline and the label -> device mapping all belong to the old
+device.  Instead of polling lsblk, the kernel tells us about every add,
+remove and change of a block device on the NETLINK_KOBJECT_UEVENT socket.
+
+A kernel uevent is a datagram of NUL separated strings:
+
+    remove@/devices/.../block/sdb\0ACTION=remove\0DEVPATH=...\0
+    SUBSYSTEM=block\0DEVNAME=sdb\0DEVTYPE=disk\0SEQNUM=4321\0
+
+handleMessage() takes such a datagram, so synthetic events can be injected
+without a netlink socket (e.g., for testing).
+
+Ref: https://www.kernel.org/doc/html/latest/core-api/kobject.html#uevents
+"""
+
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# From <linux/netlink.h>, the socket module does not define it
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group of the kernel's own messages (udevd re-broadcasts on group 2)
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 64 * 1024
+# Enough for the burst of events when a hub with several drives comes back
+UEVENT_RECEIVE_BUFFER = 1024 * 1024
+RECEIVE_TIMEOUT_SECONDS = 1.0
+
+DEVICE_ACTIONS = frozenset(('add', 'remove', 'change', 'move'))
+
+
+def parseUevent(data):
+    """Returns the event as a dict (ACTION, DEVNAME, SUBSYSTEM, ...) or None"""
+    # udevd's own messages (libudev monitor format) are binary, we only want the kernel's
+    if data.startswith(b'libudev\0'):
+        return None
+    parts = data.split(b'\0')
+    header = parts[0].decode('utf-8', 'replace')
+    if '@' not in header:
+        return None
+    event = {}
+    for part in parts[1:]:
+        key, sep, value = part.decode('utf-8', 'replace').partition('=')
+        if sep:
+            event[key] = value
+    if 'ACTION' not in event:
+        event['ACTION'] = header.partition('@')[0]
+    return event
+
+
+class UeventListener:
+
+    def __init__(self, onEvent, subsystems=('block',)):
+        """onEvent(event dict) is called on the listener thread for each matching event"""
+        self.onEvent = onEvent
+        self.subsystems = frozenset(subsystems)
+        self.sock = None
+        self.thread = None
+        self.thread_stop = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def startup(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UEVENT_RECEIVE_BUFFER)
+            sock.bind((0, UEVENT_KERNEL_GROUP))
+            sock.settimeout(RECEIVE_TIMEOUT_SECONDS)
+        except (OSError, AttributeError) as e:
+            # Not Linux, or no netlink in this container: callers fall back to polling
+            logger.warning("No netlink uevents, device changes are polled: %s", e)
+            return
+        self.sock = sock
+        self.thread = threading.Thread(target=self.ueventThread, name='uevent')
+        self.thread.daemon = True
+        self.thread_stop.clear()
+        self.thread.start()
+
+    def shutdown(self):
+        if self.thread is not None:
+            self.thread_stop.set()
+            self.thread.join()
+            self.thread = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def ueventThread(self):
+        while not self.thread_stop.is_set():
+            try:
+                data = self.sock.recv(UEVENT_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                # ENOBUFS: events were lost, whoever listens has to resync
+                logger.error("uevent receive failed: %s", e)
+                self.dispatch({'ACTION': 'overflow'})
+                self.thread_stop.wait(RECEIVE_TIMEOUT_SECONDS)
+                continue
+            self.handleMessage(data)
+        logger.info('uevent thread EXITING')
+
+    def handleMessage(self, data):
+        event = parseUevent(data)
+        if event is None or event.get('SUBSYSTEM') not in self.subsystems:
+            return
+        if event['ACTION'] not in DEVICE_ACTIONS:
+            return
+        logger.info("uevent %s %s (%s)", event['ACTION'], event.get('DEVNAME'), event.get('DEVTYPE'))
+        self.dispatch(event)
+
+    def dispatch(self, event):
+        # A failing handler must not end the uevent thread
+        try:
+            self.onEvent(event)
+        except Exception as e:
+            logger.error("uevent handler failed for %s: %s", event, e)